@@ -0,0 +1,110 @@
+import argparse
+import collections
+import json
+
+import pytest
+
+import tt
+
+def options(**overrides):
+    return argparse.Namespace(**dict({'field': 4, 'subfield': 1, 'json_key': None, 'approximate': False,
+                                      'precision': tt.PRECISION, 'top': 0, 'top_capacity': tt.TOP_CAPACITY,
+                                      'workers': 1, 'chunk_size': tt.CHUNK_SIZE}, **overrides))
+
+def keys(pattern, data):
+    return pattern.findall(data)
+
+def test_default_key_is_the_second_part_of_the_fifth_field():
+    pattern = tt.key_pattern(4, 1, None)
+    data = (b"a b c d x\tid1\ty rest of line\n"
+            b"a b c d x\tid2\n"
+            b"short line\n"
+            b"a b c d nosubfield more\n"
+            b"a b c d x\tid3\r\n"
+            b"a b c d x\tid4")
+    assert keys(pattern, data) == [b"id1", b"id2", b"id3", b"id4"]
+
+def test_whole_field():
+    pattern = tt.key_pattern(1, -1, None)
+    assert keys(pattern, b"GET /a HTTP/1.1\nPOST /b\r\nX\n\nPUT  /c\n") == [b"/a", b"/b", b""]
+
+@pytest.mark.parametrize('line, key', [
+    ({'path': '/a', 'status': 200}, b'/a'),
+    ({'status': 200, 'path': '/b'}, b'/b'),
+    ({'path': 'say "hi"'}, b'say \\"hi\\"'),  # Escapes are kept as they are
+    ({'path': ''}, b''),
+    ({'path': 404}, b'404'),
+    ({'path': None}, b'null'),
+    ({'note': 'the "path": "/fake"', 'path': '/real'}, b'/real'),
+    ({'other': 1}, None),
+])
+def test_json_key(line, key):
+    found = keys(tt.key_pattern(0, 0, 'path'), json.dumps(line).encode() + b"\n")
+    assert found == ([] if key is None else [key])
+
+def test_json_key_with_compact_separators():
+    data = b'{"method":"GET","path":"/x","ms":1.5}\n{"path":"/y"}'
+    assert keys(tt.key_pattern(0, 0, 'path'), data) == [b'/x', b'/y']
+    assert keys(tt.key_pattern(0, 0, 'ms'), data) == [b'1.5']
+
+@pytest.mark.parametrize('data', [b"", b"no newline", b"a\nb\nc\n", b"\n\n\n", b"long line " * 50 + b"\nx\n"])
+@pytest.mark.parametrize('chunk_size', [1, 3, 16, 1000])
+def test_line_ranges_cover_the_data_on_line_boundaries(data, chunk_size):
+    ranges = list(tt.line_ranges(data, chunk_size))
+    assert b''.join(data[start:end] for start, end in ranges) == data
+    assert all(data[end - 1:end] == b"\n" for _, end in ranges[:-1])
+    assert all(start < end for start, end in ranges)
+
+def test_hyperloglog_estimate_and_merge():
+    first, second = tt.HyperLogLog(12), tt.HyperLogLog(12)
+    first.update(b"key-%d" % n for n in range(30_000))
+    second.update(b"key-%d" % n for n in range(20_000, 50_000))
+    assert abs(len(first) - 30_000) < 30_000 * 0.05
+    first.merge(second)
+    assert abs(len(first) - 50_000) < 50_000 * 0.05
+
+def test_hyperloglog_small_counts():
+    sketch = tt.HyperLogLog()
+    assert len(sketch) == 0
+    sketch.update([b"a", b"b", b"a", b"c"])
+    assert len(sketch) == 3
+
+def test_trim_keeps_lower_bounds():
+    counts = collections.Counter({'a': 10, 'b': 7, 'c': 3, 'd': 3, 'e': 1})
+    assert tt.trim(counts, 5) is counts
+    assert tt.trim(counts, 2) == {'a': 7, 'b': 4}
+    assert tt.trim(counts, 3) == {'a': 7, 'b': 4}  # c and d tie at the cut
+
+def test_summary_merge():
+    first, second = tt.Summary(False, 4, 10), tt.Summary(False, 4, 10)
+    first.add([b"a", b"b", b"a"])
+    second.add([b"b", b"c"])
+    first.merge(second)
+    assert (first.keys, first.distinct, first.counts) == (5, {b"a", b"b", b"c"}, {b"a": 2, b"b": 2, b"c": 1})
+
+@pytest.fixture
+def log(tmp_path):
+    path = tmp_path / 'log'
+    lines = [b"a b c d x\tuser%d\ty" % (n % 97 if n % 5 else 0) for n in range(20_000)]
+    path.write_bytes(b"\n".join(lines) + b"\n")
+    return path, collections.Counter(line.split(b"\t")[1] for line in lines)
+
+@pytest.mark.parametrize('workers, chunk_size', [(1, tt.CHUNK_SIZE), (1, 1000), (3, 1000)])
+def test_analyze_counts_exactly(log, workers, chunk_size):
+    path, expected = log
+    summary = tt.analyze(str(path), options(workers=workers, chunk_size=chunk_size, top=3))
+    assert summary.keys == 20_000 and summary.distinct == set(expected)
+    assert summary.counts == expected
+
+def test_analyze_approximately(log):
+    path, expected = log
+    summary = tt.analyze(str(path), options(workers=2, chunk_size=5000, approximate=True, top=1, top_capacity=5))
+    assert len(summary.distinct) == pytest.approx(len(expected), rel=0.05)
+    top, count = summary.counts.most_common(1)[0]
+    assert top == b"user0" and expected[top] - 20_000 / 6 <= count <= expected[top]
+
+def test_analyze_an_empty_log(tmp_path):
+    path = tmp_path / 'empty'
+    path.write_bytes(b"")
+    summary = tt.analyze(str(path), options(workers=4))
+    assert summary.keys == 0 and len(summary.distinct) == 0
@@ -1,14 +1,216 @@
+"""Counts the distinct IDs in a log, and optionally the most frequent ones.
+
+The log is memory-mapped and cut into line-aligned ranges of --chunk-size
+bytes, which a pool of --workers processes scans with one regular
+expression run straight over the mapping: lines are never read, split or
+decoded one at a time in Python. The list of every key matched, repeats and
+all, only exists for the range a process is on; what it keeps across its
+ranges is their Summary, which with exact counting grows with the distinct
+keys of all of them. The parent merges the processes' summaries. Logs larger
+than memory are fine; the kernel reads the mapping ahead and drops the
+pages behind it.
+
+By default the key is what this script always counted: the second
+tab-separated part of the fifth space-separated field of a line. --field
+and --subfield pick another one, and --json-key takes a value out of JSON
+lines instead, such as chapter_8's access log.
+
+Exact counting keeps every distinct key in memory. --approximate keeps a
+HyperLogLog sketch of 2**--precision one-byte registers instead (16 KiB and
+about 0.8% standard error at the default of 14), and for --top a
+Misra-Gries summary of --top-capacity keys, whose counts are lower bounds
+that are off by at most keys / (capacity + 1).
+
+    python tt.py access.log
+    python tt.py --approximate --top 20 huge.log
+    python tt.py --json-key path --top 10 ../../chapter_8/access.log
+"""
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import math
+import mmap
+import os
+import re
 import sys
+import time
+
+CHUNK_SIZE = 64 * 1024 * 1024  # Bytes of log per range; a process lists the keys matched in one at a time
+PRECISION = 14
+TOP_CAPACITY = 10000
+
+def key_pattern(field, subfield, json_key):
+    """The regular expression whose only group is the key of a line."""
+    if json_key is not None:
+        # A string value without its quotes (escapes are kept as they are), or a bare value.
+        # The name comes first so the engine can skip ahead to it; the lookbehind
+        # then rules out the name quoted inside a string.
+        key = re.escape(json_key.encode())
+        return re.compile(rb'"%s"(?<!\\"%s")\s*:\s*"?((?<=")(?:[^"\\\n]|\\.)*|[^,}\s"]+)' % (key, key))
+    pattern = rb'^(?:[^ \n]* ){%d}' % field
+    if subfield >= 0:
+        pattern += rb'(?:[^\t \r\n]*\t){%d}([^\t \r\n]*)' % subfield
+    else:
+        pattern += rb'([^ \r\n]*)'
+    # Matching the rest of the line too saves trying every position in it for a ^
+    return re.compile(pattern + rb'[^\n]*', re.MULTILINE)
+
+class HyperLogLog:
+    """Approximate distinct count in 2**precision bytes, however many keys
+    are added. Sketches with the same precision merge losslessly."""
+
+    def __init__(self, precision=PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def update(self, keys):
+        registers = self.registers
+        bits = 64 - self.precision
+        mask = (1 << bits) - 1
+        for key in keys:
+            # Not hash(): it is seeded differently in every worker process
+            h = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+            rank = bits - (h & mask).bit_length() + 1
+            index = h >> bits
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def __len__(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # Linear counting is better while registers are empty
+        return round(estimate)
+
+def trim(counts, capacity):
+    """The Misra-Gries step: if there are more than capacity keys, takes
+    the count of the (capacity + 1)th largest off every key and keeps those
+    still above zero. Summaries stay valid when added up and trimmed again."""
+    if len(counts) <= capacity:
+        return counts
+    cut = heapq.nlargest(capacity + 1, counts.values())[-1]
+    return collections.Counter({key: count - cut for key, count in counts.items() if count > cut})
+
+class Summary:
+    """What has been found in some ranges of the log: the distinct keys,
+    exactly or as a sketch, and per-key counts if --top was asked for."""
+
+    def __init__(self, approximate, precision, top_capacity):
+        self.keys = 0
+        self.distinct = HyperLogLog(precision) if approximate else set()
+        self.counts = collections.Counter() if top_capacity else None
+        self.top_capacity = top_capacity if approximate else None
+
+    def add(self, keys):
+        self.keys += len(keys)
+        if self.counts is not None:
+            counts = collections.Counter(keys)
+            self.add_counts(counts)
+            keys = counts.keys()
+        elif isinstance(self.distinct, HyperLogLog):
+            keys = set(keys)  # Hashing each key once is most of the sketch's cost
+        self.distinct.update(keys)
+
+    def add_counts(self, counts):
+        self.counts.update(counts)
+        if self.top_capacity:
+            self.counts = trim(self.counts, self.top_capacity)
+
+    def merge(self, other):
+        self.keys += other.keys
+        if isinstance(self.distinct, HyperLogLog):
+            self.distinct.merge(other.distinct)
+        else:
+            self.distinct |= other.distinct
+        if self.counts is not None:
+            self.add_counts(other.counts)
+
+def line_ranges(data, chunk_size):
+    """Splits data into ranges of about chunk_size bytes that end after a
+    newline, or at the end of data."""
+    size = len(data)
+    start = 0
+    while start < size:
+        end = start + chunk_size
+        if end >= size:
+            end = size
+        else:
+            newline = data.find(b'\n', end - 1)
+            end = size if newline == -1 else newline + 1
+        yield start, end
+        start = end
+
+def scan(path, ranges, options):
+    """Runs in a worker: returns the Summary of the given ranges of the log."""
+    pattern = key_pattern(options.field, options.subfield, options.json_key)
+    summary = Summary(options.approximate, options.precision, options.top and options.top_capacity)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if hasattr(data, 'madvise'):
+            data.madvise(mmap.MADV_SEQUENTIAL)
+        for start, end in ranges:
+            summary.add(pattern.findall(data, start, end))
+    return summary
+
+def analyze(path, options):
+    """Scans the log with options.workers processes; returns the merged Summary."""
+    summary = Summary(options.approximate, options.precision, options.top and options.top_capacity)
+    if os.path.getsize(path) == 0:
+        return summary  # An empty file cannot be mapped
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        ranges = list(line_ranges(data, options.chunk_size))
+    workers = max(1, min(options.workers, len(ranges)))
+    # Every worker gets every workers-th range, so they all move through the file together
+    shares = [ranges[i::workers] for i in range(workers)]
+    if workers == 1:
+        summary.merge(scan(path, shares[0], options))
+        return summary
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        for result in concurrent.futures.as_completed([pool.submit(scan, path, share, options) for share in shares]):
+            summary.merge(result.result())
+    return summary
 
-lines = open(sys.argv[1]).readlines()
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('log')
+    parser.add_argument('--field', type=int, default=4, help='space-separated field holding the key (from 0)')
+    parser.add_argument('--subfield', type=int, default=1,
+                        help='tab-separated part of that field (from 0; -1 for the whole field)')
+    parser.add_argument('--json-key', help='take the key from this member of JSON lines instead')
+    parser.add_argument('--approximate', action='store_true',
+                        help='count distinct keys with HyperLogLog and --top with Misra-Gries, in fixed memory')
+    parser.add_argument('--precision', type=int, default=PRECISION, choices=range(4, 19), metavar='4-18',
+                        help='HyperLogLog uses 2**precision registers')
+    parser.add_argument('--top', type=int, default=0, metavar='K', help='also list the K most frequent keys')
+    parser.add_argument('--top-capacity', type=int, default=TOP_CAPACITY,
+                        help='keys tracked for --top with --approximate')
+    parser.add_argument('--list', action='store_true', help='also list every distinct key')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    options = parser.parse_args()
+    if options.list and options.approximate:
+        parser.error("--list needs exact counting")
+    options.top_capacity = max(options.top_capacity, options.top)
 
-ids = set()
-for l in lines:
-    line = l.strip()
-    parts = line.split(" ")
-    v = parts[4].split("\t")
-    ids.add(v[1])
+    started = time.perf_counter()
+    summary = analyze(options.log, options)
+    elapsed = time.perf_counter() - started
 
-print(len(ids))
-print(ids)
+    print(len(summary.distinct))
+    for key, count in summary.counts.most_common(options.top) if options.top else ():
+        print(f"{count}\t{key.decode('utf-8', 'replace')}")
+    if options.list:
+        for key in sorted(summary.distinct):
+            print(key.decode('utf-8', 'replace'))
+    size = os.path.getsize(options.log)
+    print(f"{summary.keys} keys in {size} bytes, {elapsed:.2f}s ({size / max(elapsed, 1e-9) / 1e6:.0f} MB/s)",
+          file=sys.stderr)
 
+if __name__ == '__main__':
+    main()
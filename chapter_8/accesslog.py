@@ -0,0 +1,141 @@
+"""Structured access log, written off the request path.
+
+Servers call log() once a response has been sent. log() only appends a
+tuple to a bounded deque, whose append() and popleft() are atomic in
+CPython, so no lock is taken. A background thread wakes every
+FLUSH_INTERVAL, formats the queued records as JSON lines and writes them
+in batches. If the queue is full because the disk or terminal cannot keep
+up, new records are dropped and counted instead of making requests wait;
+the count is written to the log as a record of its own.
+"""
+import collections
+import datetime
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import metrics
+import settings
+
+FLUSH_INTERVAL = 0.2
+BATCH_SIZE = 1000  # Records formatted and written at a time
+
+class AccessLog:
+    """Queue of records and the thread that writes them; format_record
+    turns a record into its JSON line. capture uses one as well."""
+
+    def __init__(self, fd, capacity, format_record, name='access-log'):
+        self.fd = fd
+        self.capacity = capacity
+        self.format_record = format_record
+        self.records = collections.deque()
+        self.dropped = 0
+        self.reported_drops = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+
+    def append(self, record):
+        """Queues record; returns False if it was dropped instead."""
+        if len(self.records) >= self.capacity:
+            self.dropped += 1
+            return False
+        self.records.append(record)
+        return True
+
+    def run(self):
+        while not self.stopping.wait(FLUSH_INTERVAL):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        """Writes out every queued record, BATCH_SIZE at a time."""
+        records = self.records
+        while records:
+            lines = [self.format_record(records.popleft()) for _ in range(min(len(records), BATCH_SIZE))]
+            self.write(lines)
+        dropped = self.dropped - self.reported_drops
+        if dropped:
+            self.reported_drops += dropped
+            self.write([json.dumps({'time': format_time(time.time()), 'dropped': dropped})])
+
+    def write(self, lines):
+        data = ('\n'.join(lines) + '\n').encode()
+        try:
+            while data:
+                data = data[os.write(self.fd, data):]
+        except OSError as e:
+            print(f"{self.thread.name} write failed: {e!r}", file=sys.stderr)
+            self.dropped += len(lines)
+            self.reported_drops += len(lines)  # Reporting them would fail the same way
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        if self.fd != sys.stdout.fileno():
+            os.close(self.fd)
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat(timespec='milliseconds')
+
+def format_record(record):
+    timestamp, client, method, path, status, size, duration, body = record
+    entry = {
+        'time': format_time(timestamp),
+        'client': client[0] if client else None,
+        'method': method,
+        'path': path,
+        'status': status,
+        'bytes': size,
+        'ms': round(duration * 1000, 3),
+    }
+    if body is not None:
+        if isinstance(body, bytes):
+            entry['body'] = body.decode('utf-8', 'replace')
+        else:
+            entry['body'] = json.dumps(body)[:settings.LOG_BODY_BYTES]
+    return json.dumps(entry, separators=(',', ':'))
+
+access_log = None
+
+def open_output(path):
+    """Opens path for appending records, '-' meaning stdout."""
+    if path == '-':
+        return sys.stdout.fileno()
+    # O_APPEND keeps the batches of several workers from overwriting each other
+    return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+def start():
+    """Starts the writer thread; called in each process that serves requests."""
+    global access_log
+    if not settings.ACCESS_LOG:
+        return
+    access_log = AccessLog(open_output(settings.ACCESS_LOG), settings.ACCESS_LOG_BUFFER, format_record)
+    access_log.thread.start()
+
+def stop():
+    """Flushes what is queued and stops the writer thread."""
+    global access_log
+    if access_log is not None:
+        access_log.close()
+        access_log = None
+
+def log(request, client):
+    """Queues the access log record of a request whose response was sent."""
+    if access_log is not None:
+        access_log.append((time.time(), client, request.method, request.path, request.status,
+                           request.response_size, metrics.now() - request.started_at,
+                           request.body_sample))
+
+def sample_body(request, body=None):
+    """Keeps the start of a request body for the log, for a sampled fraction
+    of requests. body is bytes-like, something json.dumps() accepts, or
+    None for the request's own body."""
+    if settings.LOG_BODY_SAMPLE_RATE and random.random() < settings.LOG_BODY_SAMPLE_RATE:
+        if body is None:
+            body = next(request.body_stream(settings.LOG_BODY_BYTES), b'')
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            body = bytes(body[:settings.LOG_BODY_BYTES])  # request.body does not outlive the request
+        request.body_sample = body
@@ -0,0 +1,71 @@
+"""Admission control: per-client rate limiting and the connection cap.
+
+Both answer with responses encoded ahead of time and close the
+connection, so a server that is over its limits spends as little as
+possible on the clients it turns away.
+"""
+import time
+
+import metrics
+import settings
+
+PRUNE_INTERVAL = 10.0  # How often the buckets of clients that went quiet are dropped
+
+class RateLimiter:
+    """A token bucket per client IP.
+
+    Each client may make `burst` requests at once, and then `rate` a
+    second. Buckets are refilled lazily when the client is next seen, and
+    buckets that have filled up again are forgotten, so memory only grows
+    with the number of clients active in the last burst / rate seconds.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # IP -> [tokens, time of the last refill]
+        self.last_prune = time.monotonic()
+
+    def allow(self, ip):
+        now = time.monotonic()
+        if now - self.last_prune >= PRUNE_INTERVAL:
+            self.prune(now)
+        bucket = self.buckets.get(ip)
+        if bucket is None:
+            bucket = self.buckets[ip] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def prune(self, now):
+        full = self.burst / self.rate
+        self.buckets = {ip: bucket for ip, bucket in self.buckets.items() if now - bucket[1] < full}
+        self.last_prune = now
+
+limiter = None
+
+def allow_request(client):
+    """False if the client at address `client` is over the rate limit."""
+    global limiter
+    if not settings.RATE_LIMIT or client is None:
+        return True
+    if limiter is None:
+        limiter = RateLimiter(settings.RATE_LIMIT, settings.RATE_LIMIT_BURST)
+    return limiter.allow(client[0])
+
+def over_capacity(open_connections):
+    return open_connections >= settings.MAX_CONNECTIONS
+
+def turn_away(sock, response, status):
+    """Writes a pre-encoded response if the socket takes it right away, and
+    closes the socket; never waits for a client we are shedding."""
+    metrics.count_response(status)
+    try:
+        sock.send(response)
+    except OSError:
+        pass
+    sock.close()
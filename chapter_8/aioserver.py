@@ -0,0 +1,355 @@
+import asyncio
+import collections
+import inspect
+import socket
+import time
+
+import accesslog
+import capture
+import admission
+import eventloop
+import framing
+import metrics
+import settings
+
+SWEEP_INTERVAL = 1.0
+SENDFILE_SLICE = 256 * 1024  # Bytes per loop.sendfile() call; each one that completes is progress
+TCP_CORK = getattr(socket, 'TCP_CORK', None)
+
+class OffloadedConsumer:
+    """Runs a body consumer's feed() calls in the default executor.
+
+    Reading is paused while a feed() is in flight, so the calls happen one
+    at a time and in order, and a slow disk pushes back on the client.
+    Pieces that arrive meanwhile, as several chunks of a chunked body can
+    in one receive, wait in a backlog.
+    """
+
+    def __init__(self, consumer, protocol):
+        self.consumer = consumer
+        self.protocol = protocol
+        self.last = None
+        self.backlog = collections.deque()
+        self.error = None
+
+    def feed(self, data):
+        data = bytes(data)  # The receive buffer is reused as soon as we return
+        self.protocol.pause('consumer')
+        if self.last is not None and not self.last.done():
+            self.backlog.append(data)
+        else:
+            self.submit(data)
+
+    def submit(self, data):
+        self.last = asyncio.get_running_loop().run_in_executor(None, self.consumer.feed, data)
+        self.last.add_done_callback(self.fed)
+
+    def fed(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.error = future.exception()
+            self.backlog.clear()
+        if self.backlog:
+            self.submit(self.backlog.popleft())
+        else:
+            self.protocol.resume('consumer')
+
+    def close(self):
+        pass  # finish() closes the real consumer once every feed() is done
+
+    async def finish(self):
+        """Waits for the outstanding feed() calls and closes the real consumer."""
+        while self.last is not None and not self.last.done():
+            await asyncio.wait([self.last])
+        if self.error is not None:
+            raise self.error
+        await asyncio.get_running_loop().run_in_executor(None, self.consumer.close)
+        return self.consumer
+
+    def abort(self):
+        self.consumer.abort()
+
+class HTTPProtocol(asyncio.BufferedProtocol):
+    """One client connection, receiving straight into a framing.RequestReader."""
+
+    def __init__(self, server):
+        self.server = server
+        self.reader = framing.RequestReader(self.wrap_consumer)
+        self.transport = None
+        self.client = None
+        self.task = None
+        self.paused_by = set()
+        self.write_waiter = None
+        self.write_stalled_since = None  # When the client last took some of a response that waits for it
+        self.write_buffered = 0  # What the transport held then
+        self.served = 0
+        self.last_active = time.monotonic()
+        self.created = metrics.now()
+
+    def wrap_consumer(self, request):
+        consumer_for = self.server.consumer_for
+        consumer = consumer_for(request) if consumer_for else None
+        return OffloadedConsumer(consumer, self) if consumer is not None else None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client = self.reader.client = transport.get_extra_info('peername')
+        metrics.connection_opened(self.created)
+        if admission.over_capacity(len(self.server.connections)):
+            metrics.count_response(503)
+            transport.write(framing.SERVICE_UNAVAILABLE)
+            transport.close()
+            return
+        self.server.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        self.reader.close()
+        metrics.connection_closed()
+        if self.task is not None:
+            self.task.cancel()
+        if self.write_waiter is not None and not self.write_waiter.done():
+            self.write_waiter.set_exception(ConnectionError("Connection lost"))
+
+    def get_buffer(self, sizehint):
+        try:
+            return self.reader.recv_buffer()
+        except framing.BadRequest as e:
+            self.fail(e)
+            return bytearray(1)  # Whatever arrives now is discarded
+
+    def buffer_updated(self, nbytes):
+        self.last_active = time.monotonic()
+        try:
+            self.reader.received(nbytes)
+        except framing.BadRequest as e:
+            self.fail(e)
+            return
+        self.next_request()
+
+    def eof_received(self):
+        return False  # Close our side too
+
+    def pause(self, reason):
+        if not self.paused_by and not self.transport.is_closing():
+            self.transport.pause_reading()
+        self.paused_by.add(reason)
+
+    def resume(self, reason):
+        self.paused_by.discard(reason)
+        if not self.paused_by and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def pause_writing(self):
+        self.write_waiter = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        if self.write_waiter is not None and not self.write_waiter.done():
+            self.write_waiter.set_result(None)
+        self.write_waiter = None
+
+    def is_idle(self):
+        return self.task is None and not self.reader.has_partial_request()
+
+    def fail(self, error):
+        """Answers a request that could not be parsed and closes."""
+        metrics.count_response(error.status)
+        self.transport.write(error.response)
+        self.transport.close()
+
+    def next_request(self):
+        """Starts answering the next request if one is complete."""
+        if self.task is not None or self.transport.is_closing():
+            return
+        try:
+            request = self.reader.next_request()
+        except framing.BadRequest as e:
+            self.fail(e)
+            return
+        if request is not None:
+            self.pause('handler')  # Pipelined bytes wait in the socket meanwhile
+            self.task = asyncio.get_running_loop().create_task(self.respond(request))
+
+    async def respond(self, request):
+        self.served += 1
+        if self.served >= settings.MAX_REQUESTS_PER_CONNECTION or self.server.stopping:
+            request.keep_alive = False
+        writer = eventloop.ResponseWriter()
+        started = metrics.now()
+        try:
+            if isinstance(request.body_consumer, OffloadedConsumer):
+                request.body_consumer = await request.body_consumer.finish()
+            await self.server.dispatch(writer, request)
+        except asyncio.CancelledError:
+            writer.close()
+            raise
+        except framing.BadRequest as e:
+            metrics.count_response(e.status)
+            writer.close()
+            writer.sendall(e.response)
+            request.keep_alive = False
+        except Exception as e:
+            print(f"Error handling request: {e!r}")
+            metrics.count_response(500)
+            writer.close()
+            writer.sendall(framing.INTERNAL_ERROR)
+            request.keep_alive = False
+        request.handled_at = metrics.now()
+        metrics.observe('handle', request.handled_at - started)
+        try:
+            await self.flush(writer)
+        except ConnectionError:
+            writer.close()
+            self.transport.close()  # Lost already, or a Stream failed halfway
+            return
+        metrics.request_done(request)
+        accesslog.log(request, self.client)
+        capture.record(request)
+        self.last_active = time.monotonic()
+        self.task = None
+        if not request.keep_alive:
+            self.transport.close()
+            return
+        self.resume('handler')
+        self.next_request()
+
+    async def flush(self, writer):
+        """Writes the handler's output: each run of buffers with one
+        writelines(), file segments with loop.sendfile(). A Stream is pulled
+        from after the transport has drained what came before it, in the
+        executor, since producers such as a proxied response block on their
+        source.
+
+        The transport cannot pass MSG_MORE, so the socket is corked while a
+        head and the file after it are written, and they share packets.
+        """
+        loop = asyncio.get_running_loop()
+        queue = writer.queue
+        corked = False
+        try:
+            while queue:
+                if isinstance(queue[0], eventloop.FileSegment):
+                    item = queue.popleft()
+                    try:
+                        with open(item.fd, 'rb', closefd=False) as f:
+                            while item.count > 0:
+                                count = min(item.count, SENDFILE_SLICE)
+                                self.waiting_for_client()
+                                sent = await loop.sendfile(self.transport, f, item.offset, count)
+                                if not sent:
+                                    break
+                                item.offset += sent
+                                item.count -= sent
+                    finally:
+                        self.write_stalled_since = None
+                        item.close()
+                    continue
+                if isinstance(queue[0], eventloop.Stream):
+                    parts = await loop.run_in_executor(None, queue[0].pull)
+                    if parts is None:
+                        queue.popleft()
+                    else:
+                        queue.extendleft(reversed(parts))
+                    continue
+                buffers = []
+                while queue and isinstance(queue[0], memoryview):
+                    buffers.append(queue.popleft())
+                if queue and isinstance(queue[0], eventloop.FileSegment) and not corked and TCP_CORK:
+                    corked = self.set_cork(True)
+                self.transport.writelines(buffers)
+                if self.write_waiter is not None:
+                    self.waiting_for_client()
+                    try:
+                        await self.write_waiter
+                    finally:
+                        self.write_stalled_since = None
+        finally:
+            if corked:
+                self.set_cork(False)
+
+    def waiting_for_client(self):
+        self.write_stalled_since = time.monotonic()
+        self.write_buffered = self.transport.get_write_buffer_size()
+
+    def write_stalled(self, deadline):
+        """True if a response has waited for the client since before
+        deadline, without the transport's buffer draining meanwhile."""
+        if self.write_stalled_since is None:
+            return False
+        buffered = self.transport.get_write_buffer_size()
+        if buffered < self.write_buffered:
+            self.waiting_for_client()  # The client took some since the last sweep
+        return self.write_stalled_since < deadline
+
+    def set_cork(self, on):
+        try:
+            self.transport.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, TCP_CORK, on)
+        except OSError:
+            return False  # Already closed
+        return True
+
+class Server:
+    """Shared state of the protocols of one asyncio server."""
+
+    def __init__(self, dispatch, consumer_for):
+        self.handler = dispatch
+        self.consumer_for = consumer_for
+        self.connections = set()
+        self.stopping = False
+
+    async def dispatch(self, writer, request):
+        """Calls the handler; coroutine handlers are awaited, plain ones run
+        inline unless they are marked blocking (see router.blocking()), as in
+        eventloop. Only those may run in the executor: the file cache and the
+        compression cache the others use are the loop thread's alone. A
+        plain handler that returns a coroutine, as router.Router.dispatch()
+        does for coroutine route handlers, has it awaited here, in the loop."""
+        if inspect.iscoroutinefunction(self.handler):
+            await self.handler(writer, request)
+            return
+        if request.blocking:
+            pending = await asyncio.get_running_loop().run_in_executor(None, self.handler, writer, request)
+        else:
+            pending = self.handler(writer, request)
+        if inspect.iscoroutine(pending):
+            await pending
+
+    def sweep_connections(self):
+        """Closes idle keep-alive connections, times out requests that
+        missed their framing.RequestReader.deadline(), and drops connections
+        whose client took none of a response for WRITE_TIMEOUT."""
+        deadline = time.monotonic() - settings.KEEP_ALIVE_TIMEOUT
+        write_deadline = time.monotonic() - settings.WRITE_TIMEOUT
+        now = metrics.now()
+        for protocol in list(self.connections):
+            if protocol.is_idle():
+                if self.stopping or protocol.last_active < deadline:
+                    protocol.transport.close()
+            elif protocol.task is None and not protocol.paused_by and protocol.reader.deadline() < now:
+                protocol.fail(framing.RequestTimeout("Request was not received in time"))
+            elif protocol.write_stalled(write_deadline):
+                protocol.transport.abort()  # close() would wait for the client to take what is buffered
+
+async def run_server(server_socket, dispatch, stop, consumer_for):
+    loop = asyncio.get_running_loop()
+    server = Server(dispatch, consumer_for)
+    listener = await loop.create_server(lambda: HTTPProtocol(server), sock=server_socket,
+                                        backlog=socket.SOMAXCONN)
+    while not (stop is not None and stop.is_set()):
+        await asyncio.sleep(SWEEP_INTERVAL)
+        server.sweep_connections()
+    server.stopping = True
+    listener.close()
+    while server.connections:
+        server.sweep_connections()
+        await asyncio.sleep(0.1)
+
+def serve(server_socket, dispatch, stop=None, consumer_for=None):
+    """Serves connections with asyncio; same arguments as eventloop.serve().
+
+    dispatch may be a coroutine function, or return a coroutine to be
+    awaited, as router.Router.dispatch() does for coroutine handlers. Plain
+    handlers run in the event loop, or in the default executor if they are
+    marked blocking; request bodies are fed to their consumers in the
+    executor, so disk writes do not stall other connections. Files queued with sendfile() go out through loop.sendfile().
+    """
+    asyncio.run(run_server(server_socket, dispatch, stop, consumer_for))
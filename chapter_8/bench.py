@@ -0,0 +1,368 @@
+"""Load-testing harness for every server in this repository.
+
+Starts each server on a local port inside a scratch directory (so www/ and
+uploads/ are the harness's own), drives it with a concurrent asyncio client
+and writes requests/sec, latency percentiles, bytes/sec and the server's
+peak RSS to a JSON file. With --baseline the run is compared against an
+earlier file and the exit status is 1 if anything regressed by more than
+--max-regression.
+
+    python bench.py --duration 10 --concurrency 64 --output results.json
+    python bench.py --targets chapter_8-eventloop --baseline results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HOST = '127.0.0.1'
+LEGACY_PORT = 8000  # Chapters 2-7 always listen here
+
+LARGE_FILE_SIZE = 8 * 1024 * 1024
+UPLOAD_SIZE = 4 * 1024 * 1024
+
+SCENARIOS = ['tiny_get', 'large_static', 'urlencoded_post', 'multipart_upload']
+
+# name -> (script relative to the repo, extra arguments, scenarios it supports).
+# chapter_5/main.py stops in pdb and chapter_7/main.py never finishes reading
+# a body with a Content-Length, so neither can be benchmarked.
+TARGETS = {
+    'chapter_2': ('chapter_2/main.py', None, ['tiny_get']),
+    'chapter_3': ('chapter_3/main.py', None, ['tiny_get']),
+    'chapter_4': ('chapter_4/main.py', None, ['tiny_get', 'urlencoded_post']),
+    'chapter_5': ('chapter_5/main2.py', None, ['tiny_get', 'large_static']),
+    'chapter_6': ('chapter_6/main.py', None, ['tiny_get', 'large_static', 'urlencoded_post']),
+    'chapter_7': ('chapter_7/main2.py', None, ['urlencoded_post', 'multipart_upload']),
+    'chapter_8-blocking': ('chapter_8/main.py', ['--mode', 'blocking', '--workers', '1'], SCENARIOS),
+    'chapter_8-eventloop': ('chapter_8/main.py', ['--mode', 'eventloop', '--workers', '1'], SCENARIOS),
+    'chapter_8-asyncio': ('chapter_8/main.py', ['--mode', 'asyncio', '--workers', '1'], SCENARIOS),
+    'chapter_8-prefork': ('chapter_8/main.py', ['--mode', 'eventloop'], SCENARIOS),
+}
+
+def build_requests(keep_alive):
+    """Builds the raw request bytes of every scenario."""
+    connection = b'keep-alive' if keep_alive else b'close'
+    head = b"Host: localhost\r\nUser-Agent: bench\r\nConnection: " + connection + b"\r\n"
+    form = b"name=bench&value=" + b"x" * 512
+    boundary = uuid.uuid4().hex.encode()
+    upload = (b"--" + boundary + b"\r\n"
+              b'Content-Disposition: form-data; name="file"; filename="bench-upload.bin"\r\n'
+              b"Content-Type: application/octet-stream\r\n\r\n"
+              + os.urandom(UPLOAD_SIZE) + b"\r\n--" + boundary + b"--\r\n")
+    return {
+        'tiny_get': b"GET /index.html HTTP/1.1\r\n" + head + b"\r\n",
+        'large_static': b"GET /bench-large.bin HTTP/1.1\r\n" + head + b"\r\n",
+        'urlencoded_post': (b"POST /form HTTP/1.1\r\n" + head
+                            + b"Content-Type: application/x-www-form-urlencoded\r\n"
+                            + b"Content-Length: %d\r\n\r\n" % len(form) + form),
+        'multipart_upload': (b"POST /upload HTTP/1.1\r\n" + head
+                             + b"Content-Type: multipart/form-data; boundary=" + boundary + b"\r\n"
+                             + b"Content-Length: %d\r\n\r\n" % len(upload) + upload),
+    }
+
+def prepare_workdir():
+    """Creates the scratch directory the servers run in."""
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    www = os.path.join(workdir, 'www')
+    os.makedirs(www)
+    shutil.copy(os.path.join(REPO_ROOT, 'chapter_8', 'www', 'index.html'), www)
+    with open(os.path.join(www, 'bench-large.bin'), 'wb') as f:
+        f.write(os.urandom(LARGE_FILE_SIZE))
+    return workdir
+
+def port_is_free(port):
+    with socket.socket() as s:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind((HOST, port))
+        except OSError:
+            return False
+    return True
+
+def probe(port):
+    """Sends one complete request and reads the response to the end.
+
+    A bare connect-and-close is not enough: chapters 4-7 spin forever on a
+    connection that closes without a request, and die with a broken pipe if
+    the client hangs up before they finish sending.
+    """
+    with socket.create_connection((HOST, port), timeout=2) as s:
+        s.sendall(b"GET /index.html HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+        while s.recv(65536):
+            pass
+
+def start_server(target, port, workdir):
+    script, extra_args, _ = TARGETS[target]
+    command = [sys.executable, os.path.join(REPO_ROOT, script)]
+    if extra_args is not None:
+        command += extra_args + ['--port', str(port)]
+    else:
+        port = LEGACY_PORT
+    if not port_is_free(port):
+        raise RuntimeError(f"Port {port} is already in use")
+    process = subprocess.Popen(command, cwd=workdir, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{target} exited with status {process.returncode}")
+        try:
+            probe(port)
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    stop_server(process)
+    raise RuntimeError(f"{target} did not start listening on port {port}")
+
+def stop_server(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=35)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def process_tree_rss_kb(pid):
+    """Sums VmRSS over pid and its children (Linux only); None elsewhere."""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                pending.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            if current == pid:
+                return None
+    return total
+
+async def read_response(reader):
+    """Reads one response; returns (status, bytes read, connection reusable)."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed before the response")
+    status = int(status_line.split()[1])
+    received = len(status_line)
+    content_length = None
+    chunked = False
+    keep_alive = status_line.startswith(b'HTTP/1.1')
+    while True:
+        line = await reader.readline()
+        received += len(line)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'content-length':
+            content_length = int(value)
+        elif name == b'transfer-encoding':
+            chunked = value.strip().lower() == b'chunked'
+        elif name == b'connection':
+            keep_alive = value.strip().lower() == b'keep-alive'
+    if chunked:
+        return status, received + await read_chunked(reader), keep_alive
+    if content_length is None:
+        received += len(await reader.read())  # Legacy servers: body runs until close
+        return status, received, False
+    await reader.readexactly(content_length)
+    return status, received + content_length, keep_alive
+
+async def read_chunked(reader):
+    """Reads a chunked body up to and including its trailers; returns the
+    bytes read."""
+    received = 0
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed in a chunked body")
+        received += len(line)
+        size = int(line.split(b';')[0], 16)
+        if size == 0:
+            break
+        await reader.readexactly(size + 2)
+        received += size + 2
+    while True:
+        line = await reader.readline()
+        received += len(line)
+        if line in (b'\r\n', b'\n', b''):
+            return received
+
+async def exchange(reader, writer, request):
+    writer.write(request)
+    await writer.drain()
+    return await read_response(reader)
+
+async def client(port, request, keep_alive, deadline, timeout, stats):
+    reader = writer = None
+    while time.monotonic() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(HOST, port)
+            start = time.perf_counter()
+            status, received, reusable = await asyncio.wait_for(exchange(reader, writer, request), timeout)
+            stats['latencies'].append(time.perf_counter() - start)
+            stats['bytes'] += received + len(request)
+            if status >= 400:
+                stats['errors'] += 1
+        except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ValueError, IndexError):
+            stats['errors'] += 1
+            reusable = False
+        if not (keep_alive and reusable) and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+async def sample_rss(pid, stats, stop):
+    while not stop.is_set():
+        rss = process_tree_rss_kb(pid)
+        if rss is not None:
+            stats['peak_rss_kb'] = max(stats['peak_rss_kb'] or 0, rss)
+        await asyncio.sleep(0.1)
+
+async def drive(port, pid, request, concurrency, duration, keep_alive, timeout):
+    stats = {'latencies': [], 'bytes': 0, 'errors': 0, 'peak_rss_kb': None}
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_rss(pid, stats, stop))
+    started = time.monotonic()
+    deadline = started + duration
+    await asyncio.gather(*(client(port, request, keep_alive, deadline, timeout, stats)
+                           for _ in range(concurrency)))
+    elapsed = time.monotonic() - started
+    stop.set()
+    await sampler
+    return stats, elapsed
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+def summarize(target, scenario, stats, elapsed):
+    latencies = sorted(stats['latencies'])
+    return {
+        'target': target,
+        'scenario': scenario,
+        'requests': len(latencies),
+        'errors': stats['errors'],
+        'duration_s': round(elapsed, 3),
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+        'bytes_per_sec': round(stats['bytes'] / elapsed),
+        'latency_ms': {name: None if value is None else round(value * 1000, 3)
+                       for name, value in (('p50', percentile(latencies, 0.50)),
+                                           ('p95', percentile(latencies, 0.95)),
+                                           ('p99', percentile(latencies, 0.99)),
+                                           ('p999', percentile(latencies, 0.999)))},
+        'peak_rss_kb': stats['peak_rss_kb'],
+    }
+
+def run_benchmarks(args):
+    requests = build_requests(not args.no_keep_alive)
+    results = []
+    for target in args.targets:
+        scenarios = [s for s in TARGETS[target][2] if s in args.scenarios]
+        for scenario in scenarios:
+            workdir = prepare_workdir()
+            try:
+                process, port = start_server(target, args.port, workdir)
+                try:
+                    stats, elapsed = asyncio.run(drive(port, process.pid, requests[scenario],
+                                                       args.concurrency, args.duration,
+                                                       not args.no_keep_alive, args.timeout))
+                finally:
+                    stop_server(process)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            result = summarize(target, scenario, stats, elapsed)
+            results.append(result)
+            latency = result['latency_ms']
+            print(f"{target:22} {scenario:18} {result['requests_per_sec']:>10} req/s  "
+                  f"p50 {latency['p50']} ms  p99 {latency['p99']} ms  "
+                  f"{result['bytes_per_sec'] / 1e6:.1f} MB/s  errors {result['errors']}  "
+                  f"rss {result['peak_rss_kb']} kB")
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def find_regressions(baseline, results, max_regression):
+    """Lists the (target, scenario) pairs that got slower than the baseline allows."""
+    previous = {(r['target'], r['scenario']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get((result['target'], result['scenario']))
+        if old is None:
+            continue
+        key = f"{result['target']}/{result['scenario']}"
+        if result['requests_per_sec'] < old['requests_per_sec'] * (1 - max_regression):
+            regressions.append(f"{key}: {old['requests_per_sec']} -> {result['requests_per_sec']} req/s")
+        old_p99, new_p99 = old['latency_ms']['p99'], result['latency_ms']['p99']
+        if old_p99 and new_p99 and new_p99 > old_p99 * (1 + max_regression):
+            regressions.append(f"{key}: p99 {old_p99} -> {new_p99} ms")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--targets', nargs='+', choices=sorted(TARGETS), default=sorted(TARGETS))
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per scenario')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--port', type=int, default=8100, help='port for servers that take --port')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='seconds before a request counts as failed')
+    parser.add_argument('--no-keep-alive', action='store_true',
+                        help='open a new connection for every request')
+    parser.add_argument('--output', default='bench-results.json')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.10,
+                        help='allowed fractional drop in req/s or rise in p99 (default 0.10)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args)
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'duration_s': args.duration,
+            'concurrency': args.concurrency,
+            'keep_alive': not args.no_keep_alive,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(json.load(f), results, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
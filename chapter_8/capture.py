@@ -0,0 +1,127 @@
+"""Traffic capture: a sampled fraction of requests, appended as JSON lines
+for replay.py to send again.
+
+Servers call record() next to accesslog.log(). Like the access log, it only
+queues a tuple; an accesslog.AccessLog writer thread of its own formats and
+writes the records, and drops them rather than making requests wait. A
+line looks like
+
+    {"time":1700000000.123456,"method":"POST","path":"/submit","version":"HTTP/1.1",
+     "headers":{...},"body":"<base64>","status":200,"bytes":81,"ms":0.412}
+
+where time is when the first byte of the request arrived. Bodies of up to
+CAPTURE_BODY_BYTES are kept whole; larger ones only as body_size and
+body_sha256, and a multipart upload, which was stored while it arrived, as
+its form fields plus the name, size and SHA-256 of each file; any other
+streamed body, such as a proxied one, only as body_size. A spooled
+body is hashed by the writer thread, from a duplicate of the spool file's
+descriptor, so only bodies held in memory are hashed on the request path.
+Headers named in CAPTURE_REDACT are written as REDACTED.
+
+There is no default file: capture is off until CAPTURE_FILE (--capture)
+names one.
+"""
+import base64
+import hashlib
+import json
+import os
+import random
+import time
+
+import accesslog
+import metrics
+import settings
+
+REDACTED = 'REDACTED'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+capture_log = None
+
+def start():
+    """Starts the writer thread; called in each process that serves requests."""
+    global capture_log
+    if not settings.CAPTURE_FILE:
+        return
+    capture_log = accesslog.AccessLog(accesslog.open_output(settings.CAPTURE_FILE), settings.CAPTURE_BUFFER,
+                                      format_record, name='capture')
+    capture_log.thread.start()
+
+def stop():
+    """Flushes what is queued and stops the writer thread."""
+    global capture_log
+    if capture_log is not None:
+        capture_log.close()
+        capture_log = None
+
+def record(request):
+    """Queues a sampled request whose response was sent."""
+    if capture_log is None or random.random() >= settings.CAPTURE_SAMPLE_RATE:
+        return
+    arrived = time.time() - (metrics.now() - request.started_at)
+    body = body_of(request)
+    queued = capture_log.append((arrived, request.method, request.path, request.version, request.headers,
+                                 body, request.status, request.response_size,
+                                 metrics.now() - request.started_at))
+    if not queued and isinstance(body, int):
+        os.close(body)
+
+def body_of(request):
+    """What the record keeps of the body: None, the bytes themselves, a
+    (size, digest) pair, the descriptor of the spool file to hash later,
+    or for a streamed body a dict of its size and, for a multipart form,
+    its parts."""
+    consumer = request.body_consumer
+    if consumer is not None:
+        body = {'body_size': getattr(consumer, 'fed', None)}
+        if hasattr(consumer, 'files'):
+            body['fields'] = dict(consumer.fields)
+            body['files'] = [{'name': f.name, 'filename': f.filename, 'size': f.size, 'sha256': f.digest}
+                             for f in consumer.files]
+        return body
+    if request.body_file is not None:
+        return os.dup(request.body_file.fileno())  # The reader closes its file before the writer gets here
+    if not request.body:
+        return None
+    if len(request.body) <= settings.CAPTURE_BODY_BYTES:
+        return bytes(request.body)  # request.body does not outlive the request
+    return len(request.body), hashlib.sha256(request.body).hexdigest()
+
+def hash_file(fd):
+    """Returns (size, SHA-256) of the file behind fd, and closes fd."""
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        while True:
+            chunk = os.pread(fd, HASH_CHUNK_SIZE, size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+    finally:
+        os.close(fd)
+    return size, digest.hexdigest()
+
+def format_record(record):
+    arrived, method, path, version, headers, body, status, size, duration = record
+    entry = {
+        'time': round(arrived, 6),
+        'method': method,
+        'path': path,
+        'version': version,
+        'headers': {name: REDACTED if name in settings.CAPTURE_REDACT else value
+                    for name, value in headers.items()},
+    }
+    if isinstance(body, int):
+        body = hash_file(body)
+    if isinstance(body, bytes):
+        entry['body'] = base64.b64encode(body).decode('ascii')
+    elif isinstance(body, tuple):
+        entry['body_size'], entry['body_sha256'] = body
+    elif isinstance(body, dict):
+        entry['body_size'] = body['body_size']
+        if 'files' in body:
+            entry['form'] = {'fields': body['fields'], 'files': body['files']}
+    entry['status'] = status
+    entry['bytes'] = size
+    entry['ms'] = round(duration * 1000, 3)
+    return json.dumps(entry, separators=(',', ':'))
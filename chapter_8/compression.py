@@ -0,0 +1,85 @@
+import collections
+import os
+import zlib
+
+import settings
+
+# Types worth compressing; images, video and archives are compressed already
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json',
+                      'application/xml', 'image/svg+xml')
+
+WBITS = {'gzip': 31, 'deflate': 15}  # 31 adds a gzip header, 15 a zlib one
+
+def is_compressible(content_type):
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+def negotiate(accept_encoding):
+    """Picks gzip or deflate from an Accept-Encoding header, or None."""
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        quality = 1.0
+        name, _, value = params.partition('=')
+        if name.strip() == 'q':
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for coding in ('gzip', 'deflate'):
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+def compress(data, encoding):
+    compressor = zlib.compressobj(settings.COMPRESSION_LEVEL, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+class CompressionCache:
+    """LRU cache of compressed file contents, bounded by total size.
+
+    Entries are keyed by path, mtime, size and encoding, so a changed file
+    simply misses and its stale entries age out.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is not None:
+            self.entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+cache = None
+
+def compressed_content(filepath, f, stat_result, encoding):
+    """Returns the compressed contents of an open file, compressing it only
+    on a cache miss, or None if the file is too large to compress in memory."""
+    global cache
+    if stat_result.st_size > settings.MAX_COMPRESS_SIZE:
+        return None
+    if cache is None:
+        cache = CompressionCache(settings.COMPRESSION_CACHE_SIZE)
+    key = (filepath, stat_result.st_mtime_ns, stat_result.st_size, encoding)
+    data = cache.get(key)
+    if data is None:
+        data = compress(os.pread(f.fileno(), stat_result.st_size, 0), encoding)  # f may be shared
+        cache.put(key, data)
+    return data
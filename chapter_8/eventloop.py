@@ -0,0 +1,537 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import inspect
+import os
+import selectors
+import socket
+import time
+
+import accesslog
+import admission
+import capture
+import framing
+import metrics
+import settings
+
+SWEEP_INTERVAL = 1.0  # How often idle connections and the stop flag are checked
+MAX_GATHER = 64  # Buffers written with one sendmsg(), well under IOV_MAX
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+class FileSegment:
+    """A byte range of an open file that is written with os.sendfile."""
+
+    def __init__(self, fd, offset, count):
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+
+    def close(self):
+        os.close(self.fd)
+
+class Stream:
+    """A response body that is produced while it is sent: lists of buffers
+    are pulled from an iterator only once everything before them is out.
+
+    The iterator of a blocking handler (see router.blocking()) may block as
+    well, so the event loop pulls from it in a thread, with pull_ahead().
+    """
+
+    def __init__(self, buffers, blocking=False):
+        self.buffers = buffers
+        self.blocking = blocking
+        self.pulled = None  # What pull_ahead() got, until pull() hands it out
+
+    def pull(self):
+        """Returns the next list of buffers as memoryviews, or None at the end."""
+        if self.pulled is not None:
+            parts, self.pulled = self.pulled, None
+            return parts or None
+        parts = next(self.buffers, None)
+        return None if parts is None else [memoryview(part) for part in parts]
+
+    def pull_ahead(self):
+        """Pulls the next list of buffers, in a thread, for pull() to return."""
+        self.pulled = self.pull() or []
+
+    def close(self):
+        close = getattr(self.buffers, 'close', None)
+        if close is not None:
+            close()
+
+class ResponseWriter:
+    """Stands in for the client socket so blocking handlers can run unchanged.
+
+    Handlers call sendall(), sendmsg() and sendfile() as usual; the data is
+    queued here and flushed by the event loop whenever the socket is
+    writable. Flags are ignored: the flush works out MSG_MORE by itself.
+    response.send_stream() queues a Stream with send_stream().
+    """
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.blocking = False  # The handler writing to it runs in a thread
+
+    def sendall(self, data, flags=0):
+        if data:
+            view = memoryview(data)
+            if not view.readonly:
+                view = memoryview(bytes(view))  # Such as the receive buffer, which is reused
+            self.queue.append(view)
+
+    def sendmsg(self, buffers, ancdata=(), flags=0):
+        for data in buffers:
+            self.sendall(data)
+        return sum(map(len, buffers))
+
+    def sendfile(self, file, offset=0, count=None):
+        fd = os.dup(file.fileno())  # The handler closes its file object right away
+        size = os.fstat(fd).st_size
+        if count is None:
+            count = size - offset
+        if count > 0:
+            self.queue.append(FileSegment(fd, offset, count))
+        else:
+            os.close(fd)
+
+    def send_stream(self, buffers):
+        self.queue.append(Stream(buffers, self.blocking))
+
+    def close(self):
+        for item in self.queue:
+            if isinstance(item, (FileSegment, Stream)):
+                item.close()
+        self.queue.clear()
+
+class ThreadedConsumer:
+    """Holds the body pieces for a consumer whose feed() blocks, such as a
+    proxy.Exchange, until drain() passes them on in a thread.
+
+    The connection is taken off the selector while drain() runs, so pieces
+    are fed one receive at a time and in order, and a slow consumer pushes
+    back on the client.
+    """
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.pieces = []
+        self.complete = False  # close() was called
+        self.closed = False  # and passed on
+
+    def feed(self, data):
+        self.pieces.append(bytes(data))  # The receive buffer is reused as soon as we return
+
+    def close(self):
+        self.complete = True
+
+    def abort(self):
+        self.consumer.abort()
+
+    def pending(self):
+        return bool(self.pieces) or (self.complete and not self.closed)
+
+    def drain(self):
+        """Feeds the pieces held so far and closes the consumer if the body is complete."""
+        pieces, self.pieces = self.pieces, []
+        for piece in pieces:
+            self.consumer.feed(piece)
+        if self.complete and not self.closed:
+            self.closed = True
+            self.consumer.close()
+
+class Offload:
+    """A thread pool for the work of a connection that would block the
+    event loop: blocking handlers, feeds to a ThreadedConsumer and pulls
+    from the Streams of blocking handlers.
+
+    While its work runs the connection is off the selector, so nothing in
+    the loop touches it. A thread that is done queues the connection and
+    wakes the loop through a socket pair, which the selector watches.
+    """
+
+    def __init__(self, selector):
+        self.pool = concurrent.futures.ThreadPoolExecutor(settings.OFFLOAD_THREADS, 'offload')
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        selector.register(self.wakeup, selectors.EVENT_READ, self)
+        self.done = collections.deque()  # (connection, kind, future) of finished work
+        self.busy = set()  # Connections whose work is running
+
+    def submit(self, selector, conn, kind, work):
+        """Takes conn off the selector and runs work() in the pool."""
+        if conn.state != Connection.WORKING:
+            selector.unregister(conn.sock)
+            conn.state = Connection.WORKING
+        self.busy.add(conn)
+        future = self.pool.submit(work)
+        future.add_done_callback(lambda future: self.finished(conn, kind, future))
+
+    def finished(self, conn, kind, future):
+        self.done.append((conn, kind, future))
+        try:
+            self.waker.send(b'\0')
+        except BlockingIOError:
+            pass  # The loop has plenty of wakeups waiting already
+
+    def collect(self):
+        """Returns the finished work, once the loop has been woken up."""
+        try:
+            while self.wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        finished = []
+        while self.done:
+            conn, kind, future = self.done.popleft()
+            self.busy.discard(conn)
+            finished.append((conn, kind, future))
+        return finished
+
+    def close(self, selector):
+        self.pool.shutdown()
+        selector.unregister(self.wakeup)
+        self.wakeup.close()
+        self.waker.close()
+
+class Connection:
+    """Per-connection read/write state machine."""
+
+    READING = 'reading'
+    WRITING = 'writing'
+    WORKING = 'working'  # Off the selector while Offload runs its work
+    PULL = 'pull'  # on_writable() result: a blocking Stream is next, see Stream.pull_ahead()
+
+    def __init__(self, sock, addr, consumer_for=None):
+        self.sock = sock
+        self.addr = addr
+        self.state = Connection.READING
+        self.consumer_for = consumer_for
+        self.reader = framing.RequestReader(self.wrap_consumer if consumer_for is not None else None, addr)
+        self.writer = ResponseWriter()
+        self.served = 0
+        self.keep_alive = True
+        self.last_active = time.monotonic()
+        self.responding = None  # Request whose response is being flushed
+        self.handling = None  # Request whose handler runs in the Offload pool
+        self.started = None  # metrics.now() when the last handler was started
+
+    def wrap_consumer(self, request):
+        consumer = self.consumer_for(request)
+        if getattr(consumer, 'blocking', False):
+            return ThreadedConsumer(consumer)
+        return consumer
+
+    def pending_feeds(self):
+        """The ThreadedConsumer of the body being received, if it holds pieces."""
+        consumer = self.reader.consumer
+        if isinstance(consumer, ThreadedConsumer) and consumer.pending():
+            return consumer
+        return None
+
+    def on_readable(self):
+        """Reads what is available and returns the next complete request,
+        None while more data is needed, or raises EOFError on disconnect."""
+        try:
+            if not self.reader.recv_from(self.sock):
+                raise EOFError
+        except BlockingIOError:
+            return None
+        self.last_active = time.monotonic()
+        return self.reader.next_request()
+
+    def is_idle(self):
+        """True between requests, when closing the connection loses nothing."""
+        return self.state == Connection.READING and not self.reader.has_partial_request()
+
+    def on_writable(self):
+        """Flushes queued output; returns True once everything is sent, False
+        when the socket is full, or PULL when a blocking Stream is next.
+
+        Consecutive buffers go out together with one sendmsg(), and with
+        MSG_MORE when a file follows, so a head and the start of the file
+        share packets. A Stream is pulled from only once the socket has taken
+        everything queued before it, which is what holds back a fast producer.
+        """
+        queue = self.writer.queue
+        while queue:
+            item = queue[0]
+            try:
+                if isinstance(item, FileSegment):
+                    sent = os.sendfile(self.sock.fileno(), item.fd, item.offset, item.count)
+                    self.last_active = time.monotonic()
+                    item.offset += sent
+                    item.count -= sent
+                    if item.count <= 0 or sent == 0:
+                        item.close()
+                        queue.popleft()
+                elif isinstance(item, Stream):
+                    if item.blocking and item.pulled is None:
+                        return Connection.PULL
+                    parts = item.pull()
+                    if parts is None:
+                        queue.popleft()
+                    else:
+                        queue.extendleft(reversed(parts))
+                else:
+                    self.send_buffers(queue)
+                    self.last_active = time.monotonic()
+            except BlockingIOError:
+                return False
+        return True
+
+    def send_buffers(self, queue):
+        buffers = []
+        for item in queue:
+            if not isinstance(item, memoryview) or len(buffers) == MAX_GATHER:
+                break
+            buffers.append(item)
+        file_follows = len(buffers) < len(queue) and isinstance(queue[len(buffers)], FileSegment)
+        sent = self.sock.sendmsg(buffers, (), MSG_MORE if file_follows else 0)
+        for item in buffers:
+            if sent < len(item):
+                queue[0] = item[sent:]
+                return
+            sent -= len(item)
+            queue.popleft()
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+        self.sock.close()
+
+def accept_connections(selector, server_socket, consumer_for, offload):
+    """Accepts every pending connection without blocking."""
+    while True:
+        started = metrics.now()
+        try:
+            client_socket, addr = server_socket.accept()
+        except BlockingIOError:
+            return
+        client_socket.setblocking(False)
+        # Less the listening socket and the wakeup one, plus the connections off the selector
+        if admission.over_capacity(len(selector.get_map()) - 2 + len(offload.busy)):
+            admission.turn_away(client_socket, framing.SERVICE_UNAVAILABLE, 503)
+            continue
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        selector.register(client_socket, selectors.EVENT_READ, Connection(client_socket, addr, consumer_for))
+        metrics.connection_opened(started)
+
+def run_handler(selector, conn, dispatch, request, stopping, offload):
+    """Runs the blocking handler against the connection's ResponseWriter.
+
+    Handlers marked with router.blocking(), and those of bodies fed to a
+    ThreadedConsumer, run in the Offload pool instead, and so does the
+    coroutine that dispatch returns for a coroutine handler, with an event
+    loop of its own; then this returns False and finish_handler() is called
+    once they are done.
+    """
+    conn.served += 1
+    if conn.served >= settings.MAX_REQUESTS_PER_CONNECTION or stopping:
+        request.keep_alive = False
+    conn.started = metrics.now()
+    conn.writer.blocking = request.blocking or isinstance(request.body_consumer, ThreadedConsumer)
+    if conn.writer.blocking:
+        offload.submit(selector, conn, 'handler', functools.partial(handle_in_thread, conn.writer, dispatch, request))
+        conn.handling = request
+        return False
+    try:
+        pending = dispatch(conn.writer, request)
+    except Exception as e:
+        handler_failed(conn, e)
+    else:
+        if inspect.iscoroutine(pending):
+            conn.writer.blocking = True
+            offload.submit(selector, conn, 'handler', functools.partial(asyncio.run, pending))
+            conn.handling = request
+            return False
+        conn.keep_alive = request.keep_alive
+    finish_handler(conn, request)
+    return True
+
+def handle_in_thread(writer, dispatch, request):
+    consumer = request.body_consumer
+    if isinstance(consumer, ThreadedConsumer):
+        consumer.drain()
+        request.body_consumer = consumer.consumer  # What the handler and capture expect
+    pending = dispatch(writer, request)
+    if inspect.iscoroutine(pending):
+        asyncio.run(pending)
+
+def handler_failed(conn, error):
+    """Replaces whatever the handler queued with an error response."""
+    conn.writer.close()
+    if isinstance(error, framing.BadRequest):
+        conn.writer.sendall(error.response)
+        metrics.count_response(error.status)
+    else:
+        print(f"Error handling request from {conn.addr}: {error!r}")
+        conn.writer.sendall(framing.INTERNAL_ERROR)
+        metrics.count_response(500)
+    conn.keep_alive = False
+
+def finish_handler(conn, request):
+    request.handled_at = metrics.now()
+    metrics.observe('handle', request.handled_at - conn.started)
+    conn.responding = request
+
+def close_connection(selector, conn):
+    if conn.sock.fileno() == -1:
+        return  # Closed already, before whatever was raised
+    if conn.state != Connection.WORKING:
+        selector.unregister(conn.sock)
+    conn.close()
+    metrics.connection_closed()
+
+def sweep_connections(selector, stopping):
+    """Closes keep-alive connections that have been idle for too long, or all
+    idle ones once the server is stopping, answers requests that missed
+    their framing.RequestReader.deadline() with a 408, and closes
+    connections whose client took none of a response for WRITE_TIMEOUT."""
+    deadline = time.monotonic() - settings.KEEP_ALIVE_TIMEOUT
+    write_deadline = time.monotonic() - settings.WRITE_TIMEOUT
+    now = metrics.now()
+    for key in list(selector.get_map().values()):
+        conn = key.data
+        if not isinstance(conn, Connection):
+            continue
+        if conn.is_idle():
+            if stopping or conn.last_active < deadline:
+                close_connection(selector, conn)
+        elif conn.state == Connection.READING and conn.reader.deadline() < now:
+            metrics.count_response(408)
+            try:
+                conn.sock.send(framing.REQUEST_TIMEOUT)
+            except OSError:
+                pass
+            close_connection(selector, conn)
+        elif conn.state == Connection.WRITING and conn.last_active < write_deadline:
+            close_connection(selector, conn)
+
+def process_requests(selector, conn, dispatch, request, stopping, offload):
+    """Answers request, if any, and then every pipelined request already
+    buffered behind it, flushing responses as it goes.
+
+    Returns once the connection has to wait for the socket or for its work
+    in the Offload pool, or is closed.
+    """
+    while True:
+        if request is not None and not run_handler(selector, conn, dispatch, request, stopping, offload):
+            return
+        flushed = conn.on_writable()
+        if flushed == Connection.PULL:
+            offload.submit(selector, conn, 'pull', conn.writer.queue[0].pull_ahead)
+            return
+        if not flushed:
+            set_state(selector, conn, Connection.WRITING)
+            return
+        if conn.responding is not None:
+            metrics.request_done(conn.responding)
+            accesslog.log(conn.responding, conn.addr)
+            capture.record(conn.responding)
+            conn.responding = None
+        if not conn.keep_alive:
+            close_connection(selector, conn)
+            return
+        request = conn.reader.next_request()
+        if request is None:
+            break
+    consumer = conn.pending_feeds()
+    if consumer is not None:
+        offload.submit(selector, conn, 'feed', consumer.drain)
+        return
+    set_state(selector, conn, Connection.READING)
+
+def set_state(selector, conn, state):
+    """Has the selector watch conn for what it waits for in state."""
+    if conn.state == state:
+        return
+    if state == Connection.WRITING:
+        conn.last_active = time.monotonic()  # The client has WRITE_TIMEOUT from now to take some of it
+    events = selectors.EVENT_READ if state == Connection.READING else selectors.EVENT_WRITE
+    if conn.state == Connection.WORKING:
+        selector.register(conn.sock, events, conn)
+    else:
+        selector.modify(conn.sock, events, conn)
+    conn.state = state
+
+def handle_event(selector, conn, dispatch, stopping, offload):
+    """Reads from or writes to a connection the selector reported ready.
+    Whatever goes wrong closes that connection only; one bad client must
+    not take down the worker and every other connection with it."""
+    guarded(selector, conn, dispatch, stopping, offload,
+            lambda: conn.on_readable() if conn.state == Connection.READING else None)
+
+def resume(selector, conn, kind, future, dispatch, stopping, offload):
+    """Carries on with a connection once its work in the Offload pool is done."""
+    def finish():
+        try:
+            future.result()
+        except Exception as e:
+            if kind != 'handler':
+                raise  # A consumer or a Stream failed halfway: only closing is left
+            handler_failed(conn, e)
+        else:
+            if kind == 'handler':
+                conn.keep_alive = conn.handling.keep_alive
+        if kind == 'handler':
+            finish_handler(conn, conn.handling)
+            conn.handling = None
+        return None
+    guarded(selector, conn, dispatch, stopping, offload, finish)
+
+def guarded(selector, conn, dispatch, stopping, offload, step):
+    """Runs step(), then process_requests() on the request it returns."""
+    try:
+        try:
+            process_requests(selector, conn, dispatch, step(), stopping, offload)
+        except framing.BadRequest as e:
+            metrics.count_response(e.status)
+            conn.writer.sendall(e.response)
+            conn.keep_alive = False
+            conn.reader.close()
+            process_requests(selector, conn, dispatch, None, stopping, offload)
+    except (EOFError, ConnectionError):
+        close_connection(selector, conn)
+    except Exception as e:
+        print(f"Error on connection from {conn.addr}: {e!r}")
+        close_connection(selector, conn)
+
+def serve(server_socket, dispatch, stop=None, consumer_for=None):
+    """Serves connections from a single thread using selectors (epoll on Linux).
+
+    dispatch(writer, request) is called for every complete request;
+    consumer_for is passed on to framing.RequestReader. Work that would
+    block the loop runs in an Offload pool.
+    Once stop is set the listening socket is closed and serve() returns as
+    soon as the open connections have been drained.
+    """
+    server_socket.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(server_socket, selectors.EVENT_READ, None)
+    offload = Offload(selector)
+    listening = True
+    last_sweep = time.monotonic()
+
+    while True:
+        stopping = stop is not None and stop.is_set()
+        if listening and stopping:
+            selector.unregister(server_socket)
+            server_socket.close()
+            listening = False
+        if time.monotonic() - last_sweep >= SWEEP_INTERVAL or stopping:
+            sweep_connections(selector, stopping)
+            last_sweep = time.monotonic()
+        if not listening and len(selector.get_map()) == 1 and not offload.busy:
+            break  # Only the wakeup socket is left
+        for key, mask in selector.select(SWEEP_INTERVAL):
+            conn = key.data
+            if conn is None:
+                accept_connections(selector, server_socket, consumer_for, offload)
+            elif conn is offload:
+                for conn, kind, future in offload.collect():
+                    resume(selector, conn, kind, future, dispatch, stopping, offload)
+            else:
+                handle_event(selector, conn, dispatch, stopping, offload)
+    offload.close(selector)
@@ -0,0 +1,179 @@
+"""Per-worker cache of open static files.
+
+An entry keeps the file open together with its stat result and, for files
+of up to FILE_CACHE_MEMORY_SIZE bytes, a copy of its contents, so a hit
+costs no open(), fstat() or sendfile(): the head and the contents go out
+with one sendmsg(). Larger files are sent from the open file with
+sendfile(). Entries are evicted least recently used first once there are
+more than FILE_CACHE_ENTRIES of them or their contents add up to more than
+FILE_CACHE_BYTES.
+
+A hit that was last checked more than FILE_CACHE_REVALIDATE seconds ago
+stat()s the path first, and a file that was replaced or modified (other
+inode, size or mtime) is opened again. Files are best updated by renaming
+a new version over the old one, as deploy tools do: until then, a file
+rewritten in place is served as it was read, or, if it is sent with
+sendfile(), cut short where it was truncated.
+
+The contents are copies rather than shared mappings of the file: a
+mapping of a file that is truncated underneath it raises SIGBUS, and kills
+the worker, on the next read past the new end.
+"""
+import collections
+import os
+import stat
+import time
+
+import settings
+
+class CachedFile:
+    """An open regular file, its stat result and, if it is small enough,
+    its contents as bytes."""
+
+    def __init__(self, path, f, stat_result):
+        self.path = path
+        self.file = f
+        self.stat = stat_result
+        self.data = None
+        self.cached = False
+        self.checked_at = time.monotonic()
+        self.gzip = None  # CachedFile of the precompressed .gz sibling
+        self.gzip_checked = False
+        if 0 < stat_result.st_size <= settings.FILE_CACHE_MEMORY_SIZE:
+            try:
+                data = os.pread(f.fileno(), stat_result.st_size, 0)
+            except OSError:
+                data = b''
+            if len(data) == stat_result.st_size:  # Else it changed since the fstat(); sent with sendfile() instead
+                self.data = data
+
+    @property
+    def size(self):
+        """Bytes of contents in memory, the .gz sibling's included."""
+        size = len(self.data) if self.data is not None else 0
+        if self.gzip is not None:
+            size += self.gzip.size
+        return size
+
+    def close(self):
+        """Closes the file; queued responses keep the contents they refer to."""
+        self.file.close()
+        self.data = None
+        if self.gzip is not None:
+            self.gzip.close()
+            self.gzip = None
+
+def open_file(path):
+    """Opens a regular file for serving; returns a CachedFile or None."""
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    stat_result = os.fstat(f.fileno())
+    if not stat.S_ISREG(stat_result.st_mode):
+        f.close()
+        return None
+    return CachedFile(path, f, stat_result)
+
+def open_precompressed(entry):
+    """Opens a .gz sibling of entry's file that is at least as new as the file."""
+    gzip = open_file(entry.path + '.gz')
+    if gzip is not None and gzip.stat.st_mtime_ns < entry.stat.st_mtime_ns:
+        gzip.close()
+        return None
+    return gzip
+
+def same_file(a, b):
+    return (a.st_dev, a.st_ino, a.st_size, a.st_mtime_ns) == (b.st_dev, b.st_ino, b.st_size, b.st_mtime_ns)
+
+class FileCache:
+    """LRU cache of CachedFile entries by path, bounded by the number of
+    entries and by the bytes of contents they keep."""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, path):
+        """Returns the entry for path, opening the file on a miss, or None if
+        there is no regular file at path."""
+        entry = self.entries.get(path)
+        if entry is not None:
+            now = time.monotonic()
+            if now - entry.checked_at < settings.FILE_CACHE_REVALIDATE:
+                self.entries.move_to_end(path)
+                return entry
+            try:
+                current = os.stat(path)
+            except OSError:
+                current = None
+            if current is not None and same_file(current, entry.stat):
+                entry.checked_at = now
+                self.forget_precompressed(entry)  # The .gz sibling may have changed on its own
+                self.entries.move_to_end(path)
+                return entry
+            self.remove(entry)
+        entry = open_file(path)
+        if entry is not None:
+            self.add(entry)
+        return entry
+
+    def add(self, entry):
+        entry.cached = True
+        self.entries[entry.path] = entry
+        self.size += entry.size
+        # The entry just added is about to be served, so it is never evicted itself
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+            evicted.close()
+
+    def remove(self, entry):
+        del self.entries[entry.path]
+        self.size -= entry.size
+        entry.close()
+
+    def precompressed(self, entry):
+        """Returns the entry of the .gz sibling of a cached entry; it is
+        looked up once, and lives and dies with entry."""
+        if not entry.gzip_checked:
+            entry.gzip_checked = True
+            entry.gzip = open_precompressed(entry)
+            if entry.gzip is not None:
+                self.size += entry.gzip.size
+        return entry.gzip
+
+    def forget_precompressed(self, entry):
+        if entry.gzip is not None:
+            self.size -= entry.gzip.size
+            entry.gzip.close()
+            entry.gzip = None
+        entry.gzip_checked = False
+
+cache = None
+
+def get(path):
+    """Returns an entry for the file at path, or None. Pass it to release()
+    once the response is sent. With FILE_CACHE_ENTRIES at 0 every call opens
+    the file and release() closes it again."""
+    global cache
+    if settings.FILE_CACHE_ENTRIES <= 0:
+        return open_file(path)
+    if cache is None:
+        cache = FileCache(settings.FILE_CACHE_ENTRIES, settings.FILE_CACHE_BYTES)
+    return cache.get(path)
+
+def precompressed(entry):
+    """Returns the entry of the up-to-date .gz sibling of entry's file, or None."""
+    if entry.cached:
+        return cache.precompressed(entry)
+    if not entry.gzip_checked:
+        entry.gzip_checked = True
+        entry.gzip = open_precompressed(entry)
+    return entry.gzip
+
+def release(entry):
+    if not entry.cached:
+        entry.close()
@@ -0,0 +1,603 @@
+import os
+import re
+import socket
+import tempfile
+import urllib.parse
+
+import admission
+import metrics
+import settings
+
+RECV_SIZE = 16384
+MAX_CHUNK_LINE = 4096  # Longest chunk-size or trailer line of a chunked body
+CHUNK_SIZE_RE = re.compile(rb'[0-9A-Fa-f]{1,16}')
+DIGITS_RE = re.compile(r'[0-9]+')
+FRAMING_HEADERS = frozenset(('content-length', 'transfer-encoding'))  # See parse_head()
+
+# Sent when there is no parsed request to answer; the connection is closed after them
+BAD_REQUEST = (b"HTTP/1.1 400 Bad Request\r\nContent-Type: text/plain\r\n"
+               b"Content-Length: 12\r\nConnection: close\r\n\r\nBad request.")
+PAYLOAD_TOO_LARGE = (b"HTTP/1.1 413 Payload Too Large\r\nContent-Type: text/plain\r\n"
+                     b"Content-Length: 18\r\nConnection: close\r\n\r\nPayload too large.")
+HEADERS_TOO_LARGE = (b"HTTP/1.1 431 Request Header Fields Too Large\r\nContent-Type: text/plain\r\n"
+                     b"Content-Length: 18\r\nConnection: close\r\n\r\nHeaders too large.")
+REQUEST_TIMEOUT = (b"HTTP/1.1 408 Request Timeout\r\nContent-Type: text/plain\r\n"
+                   b"Content-Length: 16\r\nConnection: close\r\n\r\nRequest timeout.")
+TOO_MANY_REQUESTS = (b"HTTP/1.1 429 Too Many Requests\r\nContent-Type: text/plain\r\n"
+                     b"Retry-After: 1\r\nContent-Length: 18\r\nConnection: close\r\n\r\nToo many requests.")
+INTERNAL_ERROR = (b"HTTP/1.1 500 Internal Server Error\r\nContent-Type: text/plain\r\n"
+                  b"Content-Length: 22\r\nConnection: close\r\n\r\nInternal server error.")
+SERVICE_UNAVAILABLE = (b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\n"
+                       b"Retry-After: 1\r\nContent-Length: 20\r\nConnection: close\r\n\r\nServer is too busy.\n")
+
+class BadRequest(Exception):
+    """The client sent something that is not a valid HTTP request."""
+    status = 400
+    response = BAD_REQUEST
+
+class HeadersTooLarge(BadRequest):
+    status = 431
+    response = HEADERS_TOO_LARGE
+
+class BodyTooLarge(BadRequest):
+    status = 413
+    response = PAYLOAD_TOO_LARGE
+
+class RequestTimeout(BadRequest):
+    status = 408
+    response = REQUEST_TIMEOUT
+
+class TooManyRequests(BadRequest):
+    status = 429
+    response = TOO_MANY_REQUESTS
+
+class Request:
+    """A parsed HTTP request.
+
+    Handlers get at the body with read(), body_stream() or form(). A body
+    of up to BODY_SPOOL_SIZE bytes is kept in memory, in request.body; a
+    larger one is spooled to an unnamed temporary file, request.body_file,
+    as it is received, and request.body is left empty. Nothing is decoded
+    or parsed until a handler asks for it.
+    """
+
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.client = None  # Address of the peer, set by RequestReader
+        self.body = body
+        self.body_file = None
+        self.body_offset = 0  # Where the next read() starts
+        self.body_consumer = None
+        self.form_fields = None  # Cached by form()
+        self.params = {}  # Filled in by the router
+        self.route = None  # (router, handler, params) once matched, see router.Router.route()
+        self.blocking = False  # The handler may block for long; see router.blocking()
+        self.started_at = None  # metrics.now() when the first byte arrived
+        self.handled_at = None  # and when the handler returned
+        self.status = None  # Filled in by response.head_parts()
+        self.response_size = None
+        self.body_sample = None  # Set by accesslog.sample_body()
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = connection != 'close'
+        else:
+            self.keep_alive = connection == 'keep-alive'
+
+    def body_stream(self, chunk_size=65536):
+        """Yields the body in pieces of up to chunk_size bytes. The pieces of
+        an in-memory body are views of it, so nothing is copied."""
+        if self.body_file is None:
+            body = memoryview(self.body)
+            for start in range(0, len(body), chunk_size):
+                yield body[start:start + chunk_size]
+            return
+        fd = self.body_file.fileno()
+        offset = 0
+        while True:
+            chunk = os.pread(fd, chunk_size, offset)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield chunk
+
+    def read(self, n=-1):
+        """Returns up to n bytes of the body, starting where the previous
+        read() stopped, or all the rest of it if n is negative; b'' at the end."""
+        if self.body_file is None:
+            end = len(self.body) if n < 0 else self.body_offset + n
+            data = bytes(self.body[self.body_offset:end])
+        else:
+            fd = self.body_file.fileno()
+            if n < 0:
+                n = max(0, os.fstat(fd).st_size - self.body_offset)
+            data = os.pread(fd, n, self.body_offset)
+        self.body_offset += len(data)
+        return data
+
+    def form(self):
+        """Returns the fields of an application/x-www-form-urlencoded body as
+        a dict of str values, the last one winning when a name repeats, like
+        multipart.MultipartParser.fields.
+
+        The body is parsed a piece at a time, so a spooled body never has
+        to be in memory as a whole.
+        """
+        if self.form_fields is None:
+            self.form_fields = parse_form(self.body_stream())
+        return self.form_fields
+
+def parse_form(chunks):
+    """Parses urlencoded name=value pairs from an iterable of bytes-like pieces."""
+    fields = {}
+    count = 0
+    pending = b''
+    for chunk in chunks:
+        pairs = (pending + chunk).split(b'&')
+        pending = pairs.pop()  # May go on in the next piece
+        for pair in pairs:
+            count = add_form_field(fields, pair, count)
+        if len(pending) > settings.MAX_FORM_FIELD_SIZE:
+            raise BadRequest("Form field is over the size limit")
+    add_form_field(fields, pending, count)
+    return fields
+
+def add_form_field(fields, pair, count):
+    if not pair:
+        return count
+    if len(pair) > settings.MAX_FORM_FIELD_SIZE:
+        raise BadRequest("Form field is over the size limit")
+    if count >= settings.MAX_FORM_PARTS:
+        raise BadRequest("Too many form fields")
+    name, _, value = pair.decode('utf-8', 'replace').partition('=')
+    fields[urllib.parse.unquote_plus(name)] = urllib.parse.unquote_plus(value)
+    return count + 1
+
+class BodySpool:
+    """Body consumer that collects a body in memory, or in an unnamed
+    temporary file once it is larger than BODY_SPOOL_SIZE, in the manner of
+    tempfile.SpooledTemporaryFile. close() hands the body to the request.
+
+    If the length is known up front, a body that is going to be too large
+    goes to the file from its first byte.
+    """
+
+    def __init__(self, request, length=None):
+        self.request = request
+        self.data = bytearray()
+        self.file = None
+        if length is not None and length > settings.BODY_SPOOL_SIZE:
+            self.roll_over()
+
+    def roll_over(self):
+        self.file = tempfile.TemporaryFile(dir=settings.BODY_SPOOL_DIRECTORY)
+        self.file.write(self.data)
+        self.data = None
+
+    def feed(self, data):
+        if self.file is None:
+            if len(self.data) + len(data) <= settings.BODY_SPOOL_SIZE:
+                self.data += data
+                return
+            self.roll_over()
+        self.file.write(data)
+
+    def close(self):
+        if self.file is None:
+            self.request.body = self.data
+        else:
+            self.file.flush()
+            self.request.body_file = self.file
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+
+def parse_head(head):
+    """Parses the request line and header block (without the blank line).
+
+    Of a repeated header the last value counts, except for the ones that
+    frame the body: Content-Length may only repeat with the same value, and
+    Transfer-Encoding not at all, or a proxy in front of us that went by
+    another of the values would see another request boundary than we do.
+    """
+    lines = bytes(head).split(b'\r\n')
+    request_line = lines[0].split(b' ')
+    if len(request_line) != 3:
+        raise BadRequest(f"Malformed request line: {lines[0]!r}")
+    if len(lines) - 1 > settings.MAX_HEADER_COUNT:
+        raise HeadersTooLarge(f"{len(lines) - 1} headers are over the limit")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(b':')
+        if not sep or not name or name[-1:].isspace():
+            raise BadRequest(f"Malformed header line: {line!r}")
+        name = name.lower().decode('latin1')
+        value = value.strip().decode('latin1')
+        if name in FRAMING_HEADERS and name in headers and (name == 'transfer-encoding' or headers[name] != value):
+            raise BadRequest(f"Conflicting {name} headers")
+        headers[name] = value
+    method, path, version = (part.decode('latin1') for part in request_line)
+    return Request(method, path, version, headers, b'')
+
+def is_chunked(request):
+    """True if the body of request is sent with Transfer-Encoding: chunked.
+
+    No other transfer coding is supported, and a request with a
+    Content-Length as well is refused: a proxy in front of us might frame
+    it by the other header, which is how requests get smuggled past it.
+    """
+    value = request.headers.get('transfer-encoding')
+    if value is None:
+        return False
+    if value.strip().lower() != 'chunked':
+        raise BadRequest(f"Unsupported Transfer-Encoding: {value!r}")
+    if 'content-length' in request.headers:
+        raise BadRequest("Both Transfer-Encoding and Content-Length are set")
+    return True
+
+class ChunkedDecoder:
+    """Incremental decoder of a Transfer-Encoding: chunked body.
+
+    decode() is given whatever part of the encoded body has arrived, feeds
+    the chunk data in it to the consumer and returns how many bytes it
+    used. What it cannot use yet, like half a chunk-size line, is left for
+    the next call. Once the last chunk and the trailers are in, done is
+    True, and any bytes after them belong to the next request. Chunk
+    extensions and trailers are read and ignored.
+    """
+
+    SIZE = 'size'
+    DATA = 'data'
+    DATA_END = 'data_end'
+    TRAILERS = 'trailers'
+    DONE = 'done'
+
+    def __init__(self, consumer, limit):
+        self.consumer = consumer
+        self.limit = limit
+        self.state = ChunkedDecoder.SIZE
+        self.remaining = 0  # Data bytes left in the current chunk
+        self.total = 0
+        self.trailer_size = 0
+
+    @property
+    def done(self):
+        return self.state == ChunkedDecoder.DONE
+
+    def decode(self, buffer, start, end):
+        """Decodes buffer[start:end]; returns the number of bytes used."""
+        view = memoryview(buffer)
+        position = start
+        while position < end and self.state != ChunkedDecoder.DONE:
+            if self.state == ChunkedDecoder.DATA:
+                count = min(self.remaining, end - position)
+                self.consumer.feed(view[position:position + count])
+                position += count
+                self.remaining -= count
+                if not self.remaining:
+                    self.state = ChunkedDecoder.DATA_END
+                continue
+            if self.state == ChunkedDecoder.DATA_END:
+                if end - position < 2:
+                    break
+                if buffer[position:position + 2] != b"\r\n":
+                    raise BadRequest("Chunk data is not followed by CRLF")
+                position += 2
+                self.state = ChunkedDecoder.SIZE
+                continue
+            line_end = buffer.find(b"\r\n", position, end)
+            if line_end == -1:
+                if end - position > MAX_CHUNK_LINE:
+                    raise BadRequest("Chunk line is too long")
+                break
+            line = bytes(buffer[position:line_end])
+            position = line_end + 2
+            if self.state == ChunkedDecoder.SIZE:
+                self.start_chunk(line)
+            elif not line:
+                self.state = ChunkedDecoder.DONE
+            else:
+                self.trailer_size += len(line) + 2
+                if self.trailer_size > settings.MAX_HEADER_SIZE:
+                    raise HeadersTooLarge("Chunked trailers are over the limit")
+        return position - start
+
+    def start_chunk(self, line):
+        size = line.partition(b';')[0].strip()
+        if not CHUNK_SIZE_RE.fullmatch(size):
+            raise BadRequest(f"Malformed chunk size: {line!r}")
+        self.remaining = int(size, 16)
+        self.total += self.remaining
+        if self.total > self.limit:
+            raise BodyTooLarge(f"Chunked body is over the limit of {self.limit} bytes")
+        self.state = ChunkedDecoder.DATA if self.remaining else ChunkedDecoder.TRAILERS
+
+def parse_digits(value):
+    """Returns the number a header value of ASCII digits stands for, or
+    None. Not str.isdigit(): it also takes digits such as '\u00b2' that int()
+    does not."""
+    if value is None or not DIGITS_RE.fullmatch(value):
+        return None
+    return int(value)
+
+def header_number(request, name):
+    """Returns the value of a header that has to be a non-negative integer,
+    or None if the request does not have it; raises BadRequest for anything
+    but ASCII digits."""
+    value = request.headers.get(name)
+    if value is None:
+        return None
+    number = parse_digits(value)
+    if number is None:
+        raise BadRequest(f"Invalid {name}: {value!r}")
+    return number
+
+def content_length(request, limit):
+    """Returns the declared body length of request, checking it against limit."""
+    length = header_number(request, 'content-length')
+    if length is None:
+        return 0
+    if length > limit:
+        raise BodyTooLarge(f"Body of {length} bytes is over the limit")
+    return length
+
+class RequestReader:
+    """Incremental request framing for one connection.
+
+    Data is received with recv_into() into a fixed buffer that is reused for
+    the life of the connection. The search for the end of the headers resumes
+    where the previous one stopped, and the request line and headers are
+    parsed once. A body that is already in the buffer is handed out as a
+    memoryview of it; a larger one is received straight into its own
+    bytearray, and one over BODY_SPOOL_SIZE into a BodySpool file. Either
+    way request.body is only valid until the next call to recv_from(), and
+    request.body_file until the next call to next_request(), which is fine
+    because handlers run before more is read.
+
+    If consumer_for(request) returns an object for a request, its body is
+    not buffered at all: each piece is passed to consumer.feed() as it is
+    received, consumer.close() is called at the end, and the handler finds
+    the consumer in request.body_consumer.
+
+    A chunked body is received into the buffer like a head and run through
+    a ChunkedDecoder, which feeds the data to the request's consumer, or to
+    a BodySpool if there is none.
+
+    Bytes that arrive after the end of a request stay buffered, so pipelined
+    requests are handed out one after another without another recv().
+    """
+
+    def __init__(self, consumer_for=None, client=None):
+        self.consumer_for = consumer_for
+        self.client = client  # Address of the peer, for the rate limit
+        self.buffer = bytearray(settings.MAX_HEADER_SIZE + RECV_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First byte not handed out yet
+        self.end = 0  # End of the received data
+        self.scan_from = 0
+        self.pending = None  # Request whose body is still being received
+        self.body_view = None
+        self.body_received = 0
+        self.consumer = None
+        self.body_file = None  # Spooled body of the request handed out last
+        self.decoder = None  # ChunkedDecoder of the pending request's body
+        self.remaining = 0  # Body bytes the consumer has yet to be fed
+        self.started = None  # When the first byte of the next request arrived
+        self.last_received = None
+        self.head_done = None  # When the head of the pending request was parsed
+        self.parse_time = 0.0
+
+    def recv_from(self, sock):
+        """Receives once from sock; returns the byte count, 0 on end of stream."""
+        n = sock.recv_into(self.recv_buffer())
+        if n:
+            self.received(n)
+        return n
+
+    def recv_buffer(self):
+        """Returns the memoryview the next receive should fill.
+
+        recv_buffer() and received() let callers that do not own a blocking
+        socket, like asyncio.BufferedProtocol, drive the reader.
+        """
+        if self.consumer is not None and self.remaining:
+            # The buffer is empty while a body is streamed; never read past its end
+            return self.view[:min(self.remaining, len(self.buffer))]
+        if self.pending is not None and self.consumer is None:
+            return self.body_view[self.body_received:]
+        if self.end == len(self.buffer):
+            self.compact()
+        return self.view[self.end:]
+
+    def received(self, n):
+        """Accounts for n bytes received into the view from recv_buffer()."""
+        self.last_received = metrics.now()
+        if self.started is None:
+            self.started = self.last_received
+        if self.consumer is not None and self.remaining:
+            self.remaining -= n
+            self.consumer.feed(self.view[:n])
+        elif self.pending is not None and self.consumer is None:
+            self.body_received += n
+        else:
+            self.end += n
+
+    def compact(self):
+        """Moves unconsumed bytes to the front of the buffer to make room."""
+        if self.start == 0:
+            raise HeadersTooLarge("Request headers do not fit in the buffer")
+        length = self.end - self.start
+        self.buffer[:length] = self.buffer[self.start:self.end]
+        self.scan_from -= self.start
+        self.start = 0
+        self.end = length
+
+    def consume(self, count):
+        self.start += count
+        if self.start == self.end:
+            self.start = self.end = 0
+        self.scan_from = self.start
+
+    def next_request(self):
+        """Returns the next complete request, or None if more data is needed."""
+        if self.pending is not None:
+            return self.finish_body()
+        if self.body_file is not None:
+            self.body_file.close()  # The previous request has been answered
+            self.body_file = None
+        header_end = self.buffer.find(b"\r\n\r\n", self.scan_from, self.end)
+        if header_end == -1:
+            if self.end - self.start > settings.MAX_HEADER_SIZE:
+                raise HeadersTooLarge("Request headers are over the limit")
+            self.scan_from = max(self.start, self.end - 3)
+            return None
+        if header_end - self.start > settings.MAX_HEADER_SIZE:
+            raise HeadersTooLarge("Request headers are over the limit")
+        parse_started = metrics.now()
+        request = parse_head(self.view[self.start:header_end])
+        request.client = self.client
+        self.parse_time = metrics.now() - parse_started
+        metrics.observe('parse', self.parse_time)
+        if not admission.allow_request(self.client):
+            raise TooManyRequests(f"{self.client} is over the rate limit")
+        self.consume(header_end + 4 - self.start)
+        consumer = self.consumer_for(request) if self.consumer_for else None
+        if is_chunked(request):
+            if consumer is None:
+                return self.start_chunked(request, BodySpool(request), settings.MAX_BODY_SIZE)
+            request.body_consumer = consumer
+            return self.start_chunked(request, consumer, settings.MAX_UPLOAD_SIZE)
+        if consumer is not None:
+            request.body_consumer = consumer
+            return self.start_streaming(request, consumer, content_length(request, settings.MAX_UPLOAD_SIZE))
+        length = content_length(request, settings.MAX_BODY_SIZE)
+        buffered = self.end - self.start
+        if buffered >= length:
+            request.body = self.view[self.start:self.start + length]
+            self.consume(length)
+            return self.hand_out(request)
+        if length > settings.BODY_SPOOL_SIZE:
+            return self.start_streaming(request, BodySpool(request, length), length)
+        # The body does not fit: receive the rest of it straight into its own buffer
+        body = bytearray(length)
+        self.body_view = memoryview(body)
+        self.body_view[:buffered] = self.view[self.start:self.end]
+        self.body_received = buffered
+        self.consume(buffered)
+        request.body = body
+        self.pending = request
+        self.head_done = metrics.now()
+        return None
+
+    def start_streaming(self, request, consumer, length):
+        """Feeds consumer the part of the body that is already buffered."""
+        self.pending = request
+        self.head_done = metrics.now()
+        self.consumer = consumer
+        self.remaining = length
+        buffered = min(self.end - self.start, self.remaining)
+        if buffered:
+            self.remaining -= buffered
+            consumer.feed(self.view[self.start:self.start + buffered])
+            self.consume(buffered)
+        return self.finish_body()
+
+    def start_chunked(self, request, consumer, limit):
+        """Starts decoding a chunked body into consumer. remaining stays 0,
+        so the encoded body is received into the buffer like a head."""
+        self.pending = request
+        self.head_done = metrics.now()
+        self.consumer = consumer
+        self.decoder = ChunkedDecoder(consumer, limit)
+        return self.finish_body()
+
+    def finish_body(self):
+        """Returns the pending request if its whole body has arrived."""
+        if self.decoder is not None:
+            self.consume(self.decoder.decode(self.buffer, self.start, self.end))
+            if not self.decoder.done:
+                return None
+            self.decoder = None
+        elif self.consumer is not None:
+            if self.remaining:
+                return None
+        elif self.body_received < len(self.body_view):
+            return None
+        if self.consumer is not None:
+            self.consumer.close()
+            self.consumer = None
+        request = self.pending
+        self.pending = self.body_view = None
+        return self.hand_out(request)
+
+    def hand_out(self, request):
+        """Records how long request took to arrive and returns it."""
+        finished = metrics.now()
+        request.started_at = self.started
+        self.body_file = request.body_file
+        metrics.observe('read', finished - self.started - self.parse_time)
+        metrics.count_request(request.method)
+        # Pipelined bytes behind this request start the clock for the next one
+        self.started = finished if self.end > self.start else None
+        return request
+
+    def has_partial_request(self):
+        return self.pending is not None or self.end > self.start
+
+    def deadline(self):
+        """Returns the metrics.now() time by which the request being received
+        has to make progress, or None between requests.
+
+        Every receive must come within READ_TIMEOUT of the one before, the
+        head within HEADER_TIMEOUT of the first byte and the body within
+        BODY_TIMEOUT of the head, so a client that trickles bytes in cannot
+        hold a connection forever.
+        """
+        if self.pending is not None:
+            return min(self.last_received + settings.READ_TIMEOUT, self.head_done + settings.BODY_TIMEOUT)
+        if self.end > self.start:
+            return min(self.last_received + settings.READ_TIMEOUT, self.started + settings.HEADER_TIMEOUT)
+        return None
+
+    def close(self):
+        """Lets a consumer clean up after a body that will never be finished,
+        and closes the spooled body of the last request."""
+        if self.consumer is not None:
+            self.consumer.abort()
+            self.consumer = None
+            self.decoder = None
+        if self.body_file is not None:
+            self.body_file.close()
+            self.body_file = None
+
+def read_request(client_socket, reader):
+    """Blocks until the next request on client_socket is complete.
+
+    Returns None when the client closes the connection between requests;
+    raises socket.timeout when it stays idle for KEEP_ALIVE_TIMEOUT.
+    """
+    while True:
+        request = reader.next_request()
+        if request is not None:
+            return request
+        deadline = reader.deadline()
+        if deadline is None:
+            client_socket.settimeout(settings.KEEP_ALIVE_TIMEOUT)
+        else:
+            timeout = deadline - metrics.now()
+            if timeout <= 0:
+                raise RequestTimeout("Request was not received in time")
+            client_socket.settimeout(timeout)
+        try:
+            received = reader.recv_from(client_socket)
+        except socket.timeout:
+            if deadline is not None:
+                raise RequestTimeout("Request was not received in time") from None
+            raise
+        if not received:
+            if reader.has_partial_request():
+                raise BadRequest("Connection closed in the middle of a request")
+            return None
@@ -0,0 +1,359 @@
+import argparse
+import asyncio
+import functools
+import inspect
+import math
+import os
+import socket
+import threading
+import urllib.parse
+
+import accesslog
+import aioserver
+import capture
+import eventloop
+import framing
+import metrics
+import multipart
+import prefork
+import profiler
+import proxy
+import resumable
+import router
+import settings
+import static
+from response import send_response
+
+routes = None  # The router.Router, compiled in every worker by start_serving()
+
+ADMIN_PORTS = 256  # Ports tried from ADMIN_PORT on for a worker's admin listener
+
+def handle_static_file(client_socket, request):
+    """Serves a file of STATIC_DIRECTORY."""
+    filepath = static.resolve_path(request.params['path'])
+    if filepath is None:
+        send_response(client_socket, request, 404, "File not found.")
+    else:
+        static.serve_file(client_socket, request, filepath)
+
+def handle_metrics(client_socket, request):
+    send_response(client_socket, request, 200, metrics.render(), 'text/plain; version=0.0.4; charset=utf-8')
+
+def handle_profile(client_socket, request):
+    """Profiles this worker and answers with the result: collapsed stacks
+    sampled every ?interval= seconds for ?seconds=, or with ?mode=trace a
+    cProfile report of the handlers that ran meanwhile."""
+    query = urllib.parse.parse_qs(request.path.partition('?')[2])
+    try:
+        seconds = float(query.get('seconds', ['10'])[0])
+        interval = float(query.get('interval', [settings.PROFILE_INTERVAL])[0])
+    except ValueError:
+        seconds = interval = math.nan
+    # float() also takes 'nan' and 'inf'
+    if not (math.isfinite(seconds) and math.isfinite(interval) and seconds > 0 and interval > 0):
+        send_response(client_socket, request, 400, "seconds and interval must be positive numbers.")
+        return
+    seconds = min(seconds, settings.PROFILE_MAX_SECONDS)
+    interval = max(interval, 0.001)
+    if query.get('mode', ['sample'])[0] == 'trace':
+        send_response(client_socket, request, 200, profiler.trace(routes, seconds))
+    else:
+        send_response(client_socket, request, 200, profiler.format_collapsed(profiler.sample(seconds, interval)))
+
+def body_consumer(request):
+    """Picks a streaming consumer for request bodies that should not be
+    buffered. It is called for every request once its head is in, so this is
+    also where the request is routed, and where the servers learn whether its
+    handler blocks (see router.blocking())."""
+    handler, params = routes.route(request)
+    request.blocking = getattr(handler, 'blocking', False)
+    if isinstance(handler, proxy.Backend):
+        return proxy.Exchange(handler, request)  # Forwarded upstream as it arrives
+    if handler is resumable.handle_patch:
+        return resumable.ChunkWriter(params['id'], request)  # Written at its offset as it arrives
+    if request.method == 'POST':
+        boundary = multipart.parse_boundary(request.headers.get('content-type', ''))
+        if boundary:
+            body_size = None if framing.is_chunked(request) else framing.content_length(request, settings.MAX_UPLOAD_SIZE)
+            return multipart.MultipartParser(boundary, settings.UPLOADS_DIRECTORY, body_size)
+    return None
+
+def handle_post_request(client_socket, request):
+    """Handles POST requests, differentiating between form data and file uploads."""
+    form = request.body_consumer
+    if form is not None:
+        # The multipart body was already parsed and saved while it was received
+        accesslog.sample_body(request, {'fields': form.fields,
+                                        'files': {f.filename: f.size for f in form.files}})
+        send_response(client_socket, request, 200, f"POST request processed. {len(form.files)} file(s) uploaded.")
+    elif request.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+        fields = request.form()
+        accesslog.sample_body(request, fields)
+        send_response(client_socket, request, 200, f"POST data received. {len(fields)} field(s).")
+    else:
+        accesslog.sample_body(request)
+        send_response(client_socket, request, 200, "POST data received.")
+
+def build_routes():
+    """Registers the handlers; static files are served for any GET path that
+    nothing else claims, and forms are accepted with a POST to any path.
+    Paths under a PROXY_ROUTES prefix are forwarded, whatever the method.
+    Resumable uploads live under RESUMABLE_PATH."""
+    routes = router.Router()
+    if settings.METRICS_PATH:
+        routes.add('GET', settings.METRICS_PATH, handle_metrics)
+    index = settings.STATIC_DIRECTORY if settings.STATIC_INDEX else None
+    routes.mount('/', handle_static_file, methods=('GET',), directory=index)
+    routes.mount('/', handle_post_request, methods=('POST',))
+    if settings.RESUMABLE_PATH:
+        path = settings.RESUMABLE_PATH.rstrip('/')
+        routes.add('POST', path, resumable.handle_create)
+        routes.add('HEAD', path + '/{id}', resumable.handle_head)
+        routes.add('PATCH', path + '/{id}', resumable.handle_patch)
+        routes.add('DELETE', path + '/{id}', resumable.handle_delete)
+        routes.add('POST', path + '/{id}/finalize', resumable.handle_finalize)
+    for prefix in settings.PROXY_ROUTES:
+        routes.mount(prefix, proxy.backend_for(prefix), methods=proxy.METHODS)
+    routes.compile()
+    return routes
+
+def build_admin_routes():
+    """Routes of the admin listener, which only loopback clients can reach."""
+    admin_routes = router.Router()
+    admin_routes.add('GET', '/debug/profile', handle_profile)
+    admin_routes.compile()
+    return admin_routes
+
+def dispatch_request(client_socket, request):
+    """Routes a parsed request to its handler; returns the coroutine of a
+    coroutine handler, see router.Router.dispatch()."""
+    return routes.dispatch(client_socket, request)
+
+def handle_connection(client_socket, addr, stop=None, dispatch=dispatch_request, consumer_for=body_consumer,
+                      recorded=True):
+    """Serves requests from one client until it closes or stops keeping alive.
+    Unless recorded is False, their durations are recorded, and they go to
+    the access log and the capture."""
+    started = metrics.now()
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = framing.RequestReader(consumer_for, addr)
+    timed_socket = metrics.TimedSocket(client_socket)
+    served = 0
+    request = None
+    metrics.connection_opened(started)
+    try:
+        try:
+            while True:
+                request = framing.read_request(client_socket, reader)
+                if request is None:
+                    return
+                served += 1
+                if served >= settings.MAX_REQUESTS_PER_CONNECTION or (stop is not None and stop.is_set()):
+                    request.keep_alive = False
+                started = metrics.now()
+                timed_socket.send_time = 0.0
+                pending = dispatch(timed_socket, request)
+                if inspect.iscoroutine(pending):
+                    asyncio.run(pending)
+                finished = metrics.now()
+                metrics.observe('handle', finished - started - timed_socket.send_time)
+                metrics.observe('send', timed_socket.send_time)
+                if recorded:
+                    metrics.duration.record(finished - request.started_at)
+                    accesslog.log(request, addr)
+                    capture.record(request)
+                if not request.keep_alive:
+                    return
+        except framing.BadRequest as e:
+            metrics.count_response(e.status)
+            client_socket.sendall(e.response)
+    except (socket.timeout, ConnectionError):
+        pass
+    except Exception as e:
+        # Only this connection is lost; the server goes on with the next one
+        print(f"Error on connection from {addr}: {e!r}")
+        if request is not None and request.status is None:
+            try:
+                client_socket.sendall(framing.INTERNAL_ERROR)  # Nothing of a response went out yet
+                metrics.count_response(500)
+            except OSError:
+                pass
+    finally:
+        reader.close()
+        metrics.connection_closed()
+
+def create_server_socket(port, reuse_port=False, host=''):
+    """Creates the listening socket shared by every serving mode."""
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        server_socket.bind((host, port))
+    except OSError:
+        server_socket.close()
+        raise
+    server_socket.listen(socket.SOMAXCONN)
+    return server_socket
+
+def serve_admin(stop=None):
+    """Serves the admin routes from a thread of the worker, on the first
+    free loopback port from ADMIN_PORT on, so every worker can be reached
+    on a port of its own. A profile taken there blocks only this thread.
+
+    Admin requests are kept out of everything that reports on the main
+    routes: their bodies are plainly buffered rather than handed to the
+    consumers body_consumer() picks, and they are not logged, captured or
+    counted in the metrics."""
+    for port in range(settings.ADMIN_PORT, settings.ADMIN_PORT + ADMIN_PORTS):
+        try:
+            admin_socket = create_server_socket(port, host='127.0.0.1')
+            break
+        except OSError:
+            continue
+    else:
+        print(f"Worker {os.getpid()} found no free admin port from {settings.ADMIN_PORT}")
+        return
+    print(f"Worker {os.getpid()} admin endpoint on 127.0.0.1:{port}")
+    metrics.exclude_thread()
+    serve_blocking(admin_socket, stop, build_admin_routes().dispatch, consumer_for=None, recorded=False)
+
+def serve_blocking(server_socket, stop=None, dispatch=dispatch_request, consumer_for=body_consumer, recorded=True):
+    """Serves one connection at a time, like the earlier chapters."""
+    if stop is not None:
+        server_socket.settimeout(1.0)  # Wake up now and then to check for stop
+    while stop is None or not stop.is_set():
+        try:
+            client_socket, addr = server_socket.accept()
+        except socket.timeout:
+            continue
+        handle_connection(client_socket, addr, stop, dispatch, consumer_for, recorded)
+        client_socket.close()
+
+def start_serving(serve, server_socket, stop=None):
+    """Sets up the per-process state and runs serve(). Called in every
+    worker: threads such as the log writers and the proxy's health checks
+    do not survive fork(), and compiling the routes here means a rolling
+    restart (SIGHUP) picks up files added to STATIC_DIRECTORY."""
+    global routes
+    routes = build_routes()
+    accesslog.start()
+    capture.start()
+    proxy.start()
+    if settings.ADMIN_PORT:
+        threading.Thread(target=serve_admin, args=(stop,), daemon=True).start()
+    try:
+        serve(server_socket, stop)
+    finally:
+        proxy.stop()
+        capture.stop()
+        accesslog.stop()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--mode', choices=['blocking', 'eventloop', 'asyncio'], default='eventloop')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: CPU count)')
+    parser.add_argument('--no-reuse-port', dest='reuse_port', action='store_false',
+                        help='share one inherited listening socket instead of SO_REUSEPORT')
+    parser.add_argument('--keep-alive-timeout', type=float, default=settings.KEEP_ALIVE_TIMEOUT)
+    parser.add_argument('--max-requests', type=int, default=settings.MAX_REQUESTS_PER_CONNECTION,
+                        help='requests served on one connection before it is closed')
+    parser.add_argument('--max-header-size', type=int, default=settings.MAX_HEADER_SIZE)
+    parser.add_argument('--max-header-count', type=int, default=settings.MAX_HEADER_COUNT)
+    parser.add_argument('--max-body-size', type=int, default=settings.MAX_BODY_SIZE)
+    parser.add_argument('--body-spool-size', type=int, default=settings.BODY_SPOOL_SIZE,
+                        help='bodies larger than this are received into a temporary file')
+    parser.add_argument('--read-timeout', type=float, default=settings.READ_TIMEOUT,
+                        help='seconds a partly received request may go without new data')
+    parser.add_argument('--header-timeout', type=float, default=settings.HEADER_TIMEOUT)
+    parser.add_argument('--body-timeout', type=float, default=settings.BODY_TIMEOUT)
+    parser.add_argument('--write-timeout', type=float, default=settings.WRITE_TIMEOUT,
+                        help='seconds a response may wait for the client to take more of it')
+    parser.add_argument('--max-connections', type=int, default=settings.MAX_CONNECTIONS,
+                        help='open connections per worker before new ones are answered with 503')
+    parser.add_argument('--rate-limit', type=float, default=settings.RATE_LIMIT,
+                        help='requests per second allowed per client IP (0: no limit)')
+    parser.add_argument('--rate-limit-burst', type=int, default=settings.RATE_LIMIT_BURST)
+    parser.add_argument('--upload-fsync', choices=['none', 'file', 'full'], default=settings.UPLOAD_FSYNC,
+                        help='how uploads are synced to disk before they are acknowledged')
+    parser.add_argument('--resumable-path', default=settings.RESUMABLE_PATH,
+                        help='prefix of the resumable upload endpoints, such as /files (default: off)')
+    parser.add_argument('--resumable-expiry', type=float, default=settings.RESUMABLE_EXPIRY,
+                        help='seconds an unfinished resumable upload is kept after it was last written to')
+    parser.add_argument('--cache-control', default=settings.CACHE_CONTROL,
+                        help='Cache-Control header for static files')
+    parser.add_argument('--file-cache-entries', type=int, default=settings.FILE_CACHE_ENTRIES,
+                        help='static files kept open per worker (0: no cache)')
+    parser.add_argument('--file-cache-revalidate', type=float, default=settings.FILE_CACHE_REVALIDATE,
+                        help='seconds before a cached file is checked for changes')
+    parser.add_argument('--no-static-index', dest='static_index', action='store_false',
+                        help='look every GET up on disk instead of in an index of the static directory')
+    parser.add_argument('--access-log', default=settings.ACCESS_LOG,
+                        help="file to append the access log to, '-' for stdout, empty to turn it off")
+    parser.add_argument('--log-body-sample-rate', type=float, default=settings.LOG_BODY_SAMPLE_RATE,
+                        help='fraction of requests whose body is written to the access log')
+    parser.add_argument('--proxy', action='append', default=[], metavar='PREFIX=HOST:PORT[,HOST:PORT...]',
+                        help='forward requests under PREFIX to these upstreams (repeatable)')
+    parser.add_argument('--proxy-health-path', default=settings.PROXY_HEALTH_PATH,
+                        help='path the upstreams are health-checked with; empty to only check connecting')
+    parser.add_argument('--capture', default=settings.CAPTURE_FILE, metavar='FILE',
+                        help='append a sample of the requests to FILE as JSON lines, for replay.py')
+    parser.add_argument('--capture-sample-rate', type=float, default=settings.CAPTURE_SAMPLE_RATE,
+                        help='fraction of requests captured')
+    parser.add_argument('--admin-port', type=int, default=settings.ADMIN_PORT,
+                        help='first 127.0.0.1 port for the per-worker admin endpoint (0: off)')
+    parser.add_argument('--metrics-path', default=settings.METRICS_PATH,
+                        help='path of the Prometheus metrics endpoint; empty to turn it off')
+    args = parser.parse_args()
+    try:
+        settings.PROXY_ROUTES = proxy.parse_routes(args.proxy)
+    except ValueError as e:
+        parser.error(str(e))
+    settings.PROXY_HEALTH_PATH = args.proxy_health_path
+    settings.KEEP_ALIVE_TIMEOUT = args.keep_alive_timeout
+    settings.MAX_REQUESTS_PER_CONNECTION = args.max_requests
+    settings.MAX_HEADER_SIZE = args.max_header_size
+    settings.MAX_HEADER_COUNT = args.max_header_count
+    settings.MAX_BODY_SIZE = args.max_body_size
+    settings.BODY_SPOOL_SIZE = args.body_spool_size
+    settings.READ_TIMEOUT = args.read_timeout
+    settings.HEADER_TIMEOUT = args.header_timeout
+    settings.BODY_TIMEOUT = args.body_timeout
+    settings.WRITE_TIMEOUT = args.write_timeout
+    settings.MAX_CONNECTIONS = args.max_connections
+    settings.RATE_LIMIT = args.rate_limit
+    settings.RATE_LIMIT_BURST = args.rate_limit_burst
+    settings.UPLOAD_FSYNC = args.upload_fsync
+    settings.RESUMABLE_PATH = args.resumable_path
+    settings.RESUMABLE_EXPIRY = args.resumable_expiry
+    settings.CACHE_CONTROL = args.cache_control
+    settings.STATIC_INDEX = args.static_index
+    settings.FILE_CACHE_ENTRIES = args.file_cache_entries
+    settings.FILE_CACHE_REVALIDATE = args.file_cache_revalidate
+    settings.METRICS_PATH = args.metrics_path
+    settings.ADMIN_PORT = args.admin_port
+    settings.ACCESS_LOG = args.access_log
+    settings.LOG_BODY_SAMPLE_RATE = args.log_body_sample_rate
+    settings.CAPTURE_FILE = args.capture
+    settings.CAPTURE_SAMPLE_RATE = args.capture_sample_rate
+
+    if args.mode == 'eventloop':
+        serve = lambda server_socket, stop=None: eventloop.serve(server_socket, dispatch_request, stop, body_consumer)
+    elif args.mode == 'asyncio':
+        serve = lambda server_socket, stop=None: aioserver.serve(server_socket, dispatch_request, stop, body_consumer)
+    else:
+        serve = serve_blocking
+    serve = functools.partial(start_serving, serve)
+
+    print(f"Serving HTTP on port {args.port} ({args.mode}, {args.workers} workers)...")
+    if args.workers > 1:
+        reuse_port = args.reuse_port and hasattr(socket, 'SO_REUSEPORT')
+        prefork.supervise(lambda: create_server_socket(args.port, reuse_port), serve,
+                          args.workers, reuse_port)
+    else:
+        serve(create_server_socket(args.port))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""Request counters and per-phase latency histograms, served on /metrics in
+the Prometheus text format.
+
+A request goes through these phases:
+
+    accept  accepting the connection and setting it up
+    read    from the first byte of the request until all of it has arrived
+            (streamed bodies are fed to their consumer during this phase)
+    parse   parsing the request line and headers
+    handle  running the handler, not counting time spent sending
+    send    writing the response to the socket, sendfile() included
+
+Every worker process keeps its own metrics and labels them with its pid,
+so with several workers each scrape reports the worker that answered it.
+"""
+import os
+import threading
+import time
+
+now = time.perf_counter
+
+PHASES = ('accept', 'read', 'parse', 'handle', 'send')
+METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')
+
+SUB_BUCKET_BITS = 3  # 8 buckets per power of two: at most 12.5% between bucket bounds
+LINEAR_LIMIT = 2 << SUB_BUCKET_BITS  # Microsecond values below this get a bucket each
+MAX_MICROS = (1 << 37) - 1  # About 38 hours; longer durations land in the last bucket
+
+def bucket_index(micros):
+    if micros < LINEAR_LIMIT:
+        return max(micros, 0)
+    shift = micros.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift << SUB_BUCKET_BITS) + (micros >> shift)
+
+def bucket_bound(index):
+    """Upper bound, in microseconds, of the values counted in bucket index."""
+    if index < LINEAR_LIMIT:
+        return index + 1
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    mantissa = index & ((1 << SUB_BUCKET_BITS) - 1)
+    return (mantissa + (1 << SUB_BUCKET_BITS) + 1) << shift
+
+class Histogram:
+    """Latency histogram with log-linear buckets, in the style of HdrHistogram.
+
+    Durations are counted in whole microseconds. Below LINEAR_LIMIT every
+    value has its own bucket; above it each power of two is split into
+    2**SUB_BUCKET_BITS equal buckets, so the relative precision is the same
+    from microseconds to minutes and recording is a few integer operations.
+    """
+
+    SIZE = bucket_index(MAX_MICROS) + 1
+
+    def __init__(self):
+        self.counts = [0] * Histogram.SIZE
+        self.count = 0
+        self.sum = 0.0
+        self.highest = -1  # Highest bucket used so far
+
+    def record(self, seconds):
+        index = bucket_index(int(seconds * 1e6))
+        if index >= Histogram.SIZE:
+            index = Histogram.SIZE - 1
+        self.counts[index] += 1
+        if index > self.highest:
+            self.highest = index
+        self.count += 1
+        self.sum += seconds
+
+phases = {phase: Histogram() for phase in PHASES}
+duration = Histogram()  # From the first byte of a request until its response is sent
+requests = dict.fromkeys(METHODS + ('other',), 0)
+responses = {}
+connections_accepted = 0
+connections_open = 0
+excluded = threading.local()  # excluded.on in threads whose traffic is left out, see exclude_thread()
+
+def exclude_thread():
+    """Leaves what the calling thread serves out of the metrics, as the
+    admin listener does with its own requests."""
+    excluded.on = True
+
+def counted():
+    return not getattr(excluded, 'on', False)
+
+def observe(phase, seconds):
+    if counted():
+        phases[phase].record(seconds)
+
+def count_request(method):
+    if not counted():
+        return
+    if method not in requests:
+        method = 'other'
+    requests[method] += 1
+
+def count_response(status):
+    if counted():
+        responses[status] = responses.get(status, 0) + 1
+
+def connection_opened(started):
+    global connections_accepted, connections_open
+    if not counted():
+        return
+    connections_accepted += 1
+    connections_open += 1
+    observe('accept', now() - started)
+
+def connection_closed():
+    global connections_open
+    if counted():
+        connections_open -= 1
+
+def request_done(request):
+    """Records the send phase and the total duration of request, whose
+    response has just been written."""
+    finished = now()
+    observe('send', finished - request.handled_at)
+    duration.record(finished - request.started_at)
+
+class TimedSocket:
+    """Wraps a blocking client socket and adds up the time spent in sendall(),
+    sendmsg() and sendfile(), so handlers that send as they go can be split
+    into their handle and send phases."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_time = 0.0
+
+    def sendall(self, data, flags=0):
+        started = now()
+        try:
+            self.sock.sendall(data, flags)
+        finally:
+            self.send_time += now() - started
+
+    def sendmsg(self, buffers, ancdata=(), flags=0):
+        started = now()
+        try:
+            return self.sock.sendmsg(buffers, ancdata, flags)
+        finally:
+            self.send_time += now() - started
+
+    def sendfile(self, file, offset=0, count=None):
+        started = now()
+        try:
+            return self.sock.sendfile(file, offset, count)
+        finally:
+            self.send_time += now() - started
+
+def format_seconds(micros):
+    return format(micros / 1e6, '.6g')
+
+def render_histogram(lines, name, labels, histogram):
+    cumulative = 0
+    for index in range(histogram.highest + 1):
+        cumulative += histogram.counts[index]
+        lines.append(f'{name}_bucket{{{labels},le="{format_seconds(bucket_bound(index))}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram.sum:.6f}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+def render():
+    """Returns every metric in the Prometheus text exposition format.
+
+    Histograms list each bucket up to the highest one used so far; once a
+    bucket has been listed it is listed in every later scrape.
+    """
+    worker = f'worker="{os.getpid()}"'
+    lines = [
+        '# HELP http_connections_accepted_total Connections accepted.',
+        '# TYPE http_connections_accepted_total counter',
+        f'http_connections_accepted_total{{{worker}}} {connections_accepted}',
+        '# HELP http_connections_open Connections currently open.',
+        '# TYPE http_connections_open gauge',
+        f'http_connections_open{{{worker}}} {connections_open}',
+        '# HELP http_requests_total Requests received, by method.',
+        '# TYPE http_requests_total counter',
+    ]
+    for method, count in requests.items():
+        lines.append(f'http_requests_total{{{worker},method="{method}"}} {count}')
+    lines += [
+        '# HELP http_responses_total Responses sent, by status code.',
+        '# TYPE http_responses_total counter',
+    ]
+    for status, count in sorted(responses.items()):
+        lines.append(f'http_responses_total{{{worker},status="{status}"}} {count}')
+    lines += [
+        '# HELP http_request_phase_seconds Time spent in each phase of a request.',
+        '# TYPE http_request_phase_seconds histogram',
+    ]
+    for phase, histogram in phases.items():
+        render_histogram(lines, 'http_request_phase_seconds', f'{worker},phase="{phase}"', histogram)
+    lines += [
+        '# HELP http_request_duration_seconds Time from the first byte of a request until its response is sent.',
+        '# TYPE http_request_duration_seconds histogram',
+    ]
+    render_histogram(lines, 'http_request_duration_seconds', worker, duration)
+    return '\n'.join(lines) + '\n'
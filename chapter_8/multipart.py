@@ -0,0 +1,208 @@
+import os
+import re
+from urllib.parse import unquote_plus
+
+import framing
+import settings
+import uploadstore
+
+NAME_RE = re.compile(rb'\bname="([^"]*)"')
+FILENAME_RE = re.compile(rb'\bfilename="([^"]*)"')
+BOUNDARY_RE = re.compile(r'boundary=("?)([^";]+)\1')
+
+MAX_PART_HEADER_SIZE = 8192
+
+class MultipartError(framing.BadRequest):
+    """The multipart/form-data body is malformed."""
+
+def parse_boundary(content_type):
+    """Returns the boundary of a multipart/form-data Content-Type, or None."""
+    if not content_type.startswith('multipart/form-data'):
+        return None
+    match = BOUNDARY_RE.search(content_type)
+    return match.group(2).encode('latin1') if match else None
+
+def safe_filename(filename):
+    """The last component of a client's filename, or None if nothing usable
+    is left; no path traversal via the filename."""
+    filename = os.path.basename(filename.replace('\\', '/'))
+    if filename in ('', '.', '..') or '\0' in filename:
+        return None
+    return filename
+
+class UploadedFile:
+    """A file part, hashed and stored in the content-addressed upload store
+    as it arrives (see uploadstore)."""
+
+    def __init__(self, name, filename, store, size_hint=None):
+        self.name = name
+        self.filename = filename
+        self.stored = store.open(filename, size_hint)
+
+    @property
+    def size(self):
+        return self.stored.size
+
+    @property
+    def digest(self):
+        return self.stored.digest
+
+    def write(self, data):
+        self.stored.write(data)
+
+    def finish(self):
+        self.stored.finish()
+
+    def abort(self):
+        self.stored.abort()
+
+class FormField:
+    """A non-file part, kept in memory up to a small size limit."""
+
+    def __init__(self, name):
+        self.name = name
+        self.value = bytearray()
+
+    def write(self, data):
+        if len(self.value) + len(data) > settings.MAX_FORM_FIELD_SIZE:
+            raise MultipartError(f"Form field {self.name!r} is over the size limit")
+        self.value += data
+
+    def finish(self):
+        pass
+
+    def abort(self):
+        pass
+
+class MultipartParser:
+    """Push parser for multipart/form-data bodies.
+
+    feed() may be called with pieces of the body of any size. Each file part
+    is streamed to disk as it arrives, so memory use is bounded by the size
+    of the pieces fed in plus the boundary, however large the upload is.
+    After close(), fields maps field names to their (str) values and files
+    lists the UploadedFile objects. body_size, the Content-Length, lets
+    file parts preallocate what is left of the body.
+    """
+
+    blocking = True  # feed() writes, and close() may fsync(), files; see eventloop.ThreadedConsumer
+
+    PREAMBLE = 'preamble'
+    HEADERS = 'headers'
+    BODY = 'body'
+    DELIMITER = 'delimiter'
+    EPILOGUE = 'epilogue'
+
+    def __init__(self, boundary, upload_directory, body_size=None):
+        self.delimiter = b'\r\n--' + boundary
+        self.store = uploadstore.store_for(upload_directory)
+        self.body_size = body_size
+        self.fed = 0
+        # The first boundary has no CRLF in front of it; pretend it does
+        self.buffer = bytearray(b'\r\n')
+        self.state = MultipartParser.PREAMBLE
+        self.part = None
+        self.fields = {}
+        self.files = []
+
+    def feed(self, data):
+        if self.state == MultipartParser.EPILOGUE:
+            return  # Anything after the closing boundary is ignored
+        self.buffer += data
+        self.fed += len(data)
+        while self.step():
+            pass
+
+    def step(self):
+        """Makes as much progress as the buffer allows; returns False when
+        more data is needed."""
+        buffer = self.buffer
+        if self.state == MultipartParser.PREAMBLE:
+            index = buffer.find(self.delimiter)
+            if index == -1:
+                del buffer[:max(0, len(buffer) - len(self.delimiter) + 1)]
+                return False
+            del buffer[:index + len(self.delimiter)]
+            self.state = MultipartParser.DELIMITER
+            return True
+
+        if self.state == MultipartParser.DELIMITER:
+            if len(buffer) < 2:
+                return False
+            if buffer[:2] == b'--':
+                self.state = MultipartParser.EPILOGUE
+                buffer.clear()
+                return False
+            if buffer[:2] != b'\r\n':
+                raise MultipartError("Malformed multipart boundary")
+            del buffer[:2]
+            self.state = MultipartParser.HEADERS
+            return True
+
+        if self.state == MultipartParser.HEADERS:
+            index = buffer.find(b'\r\n\r\n')
+            if index == -1:
+                if len(buffer) > MAX_PART_HEADER_SIZE:
+                    raise MultipartError("Multipart part headers are too large")
+                return False
+            self.start_part(bytes(buffer[:index]))
+            del buffer[:index + 4]
+            self.state = MultipartParser.BODY
+            return True
+
+        if self.state == MultipartParser.BODY:
+            index = buffer.find(self.delimiter)
+            if index == -1:
+                # Everything except a possible partial delimiter at the end is content
+                safe = len(buffer) - len(self.delimiter) + 1
+                if safe > 0:
+                    with memoryview(buffer) as view:
+                        self.part.write(view[:safe])
+                    del buffer[:safe]
+                return False
+            with memoryview(buffer) as view:
+                self.part.write(view[:index])
+            del buffer[:index + len(self.delimiter)]
+            self.finish_part()
+            self.state = MultipartParser.DELIMITER
+            return True
+
+        return False
+
+    def start_part(self, headers):
+        if len(self.files) + len(self.fields) >= settings.MAX_FORM_PARTS:
+            raise MultipartError("Too many parts in multipart body")
+        name_match = NAME_RE.search(headers)
+        filename_match = FILENAME_RE.search(headers)
+        name = name_match.group(1).decode('utf-8', 'replace') if name_match else ''
+        if filename_match:
+            filename = safe_filename(unquote_plus(filename_match.group(1).decode('utf-8', 'replace')))
+            if filename is None:
+                raise MultipartError("Upload without a usable filename")
+            size_hint = None
+            if self.body_size is not None:
+                # Nothing before this part's body can belong to it
+                size_hint = max(0, self.body_size - (self.fed - len(self.buffer)))
+            self.part = UploadedFile(name, filename, self.store, size_hint)
+        else:
+            self.part = FormField(name)
+
+    def finish_part(self):
+        part, self.part = self.part, None
+        part.finish()
+        if isinstance(part, UploadedFile):
+            self.files.append(part)
+        else:
+            self.fields[part.name] = part.value.decode('utf-8', 'replace')
+
+    def close(self):
+        """Checks that the whole body was seen."""
+        if self.state != MultipartParser.EPILOGUE:
+            self.abort()
+            raise MultipartError("Multipart body ended before the closing boundary")
+
+    def abort(self):
+        """Discards the part being written, e.g. when the client disconnects."""
+        if self.part is not None:
+            self.part.abort()
+            self.part = None
@@ -0,0 +1,130 @@
+import os
+import select
+import signal
+import sys
+import threading
+import time
+
+SUPERVISOR_SIGNALS = {signal.SIGCHLD, signal.SIGHUP, signal.SIGTERM, signal.SIGINT}
+READY_TIMEOUT = 5.0
+STOP_TIMEOUT = 30.0
+CRASH_BACKOFF = 1.0
+
+def run_worker(create_socket, server_socket, serve, ready_fd):
+    """Body of a forked worker process; never returns."""
+    status = 0
+    try:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, SUPERVISOR_SIGNALS)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # The supervisor decides when we stop
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        if server_socket is None:
+            server_socket = create_socket()  # Own SO_REUSEPORT socket
+        os.write(ready_fd, b'1')
+        os.close(ready_fd)
+        serve(server_socket, stop)
+    except BaseException as e:
+        print(f"Worker {os.getpid()} crashed: {e!r}")
+        status = 1
+    for stream in (sys.stdout, sys.stderr):  # os._exit() does not flush them
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+    os._exit(status)
+
+def spawn_worker(create_socket, server_socket, serve):
+    """Forks a worker and waits until it is accepting connections."""
+    ready_r, ready_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(ready_r)
+        run_worker(create_socket, server_socket, serve, ready_w)
+    os.close(ready_w)
+    readable, _, _ = select.select([ready_r], [], [], READY_TIMEOUT)
+    if not readable or not os.read(ready_r, 1):
+        print(f"Worker {pid} did not become ready")
+    os.close(ready_r)
+    return pid
+
+def stop_workers(pids, timeout=STOP_TIMEOUT):
+    """Asks workers to finish their connections and exit, all at once, and
+    kills the ones still running after timeout."""
+    running = set()
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+            running.add(pid)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + timeout
+    while running and time.monotonic() < deadline:
+        for pid in list(running):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done:
+                running.discard(pid)
+        if running:
+            time.sleep(0.05)
+    for pid in running:
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+def supervise(create_socket, serve, workers, reuse_port=True):
+    """Runs `workers` copies of serve(server_socket, stop) and keeps them alive.
+
+    With reuse_port every worker binds its own SO_REUSEPORT socket and the
+    kernel spreads connections between them; otherwise they all accept on
+    one socket created here and inherited across fork().
+
+    SIGHUP replaces the workers one at a time (a rolling restart), SIGTERM or
+    SIGINT stops them all gracefully.
+    """
+    server_socket = None if reuse_port else create_socket()
+    signal.pthread_sigmask(signal.SIG_BLOCK, SUPERVISOR_SIGNALS)
+    # SIGCHLD is ignored by default, which would keep it from being queued
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    started = {}
+    for _ in range(workers):
+        pid = spawn_worker(create_socket, server_socket, serve)
+        started[pid] = time.monotonic()
+    print(f"Supervisor {os.getpid()} started {workers} workers: {sorted(started)}")
+
+    while True:
+        info = signal.sigwaitinfo(SUPERVISOR_SIGNALS)
+        if info.si_signo in (signal.SIGTERM, signal.SIGINT):
+            print("Shutting down workers...")
+            stop_workers(list(started))
+            return
+        if info.si_signo == signal.SIGHUP:
+            print("Rolling restart of workers...")
+            for pid in list(started):
+                new_pid = spawn_worker(create_socket, server_socket, serve)
+                started[new_pid] = time.monotonic()
+                del started[pid]
+                stop_workers([pid])
+            continue
+        # SIGCHLD: reap every exited worker and replace the ones we still want
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid not in started:
+                continue
+            lifetime = time.monotonic() - started.pop(pid)
+            print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+            if lifetime < CRASH_BACKOFF:
+                time.sleep(CRASH_BACKOFF)  # Don't spin if workers die on startup
+            new_pid = spawn_worker(create_socket, server_socket, serve)
+            started[new_pid] = time.monotonic()
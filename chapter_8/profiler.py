@@ -0,0 +1,84 @@
+"""On-demand profiling of a live worker, for the admin endpoint.
+
+sample() looks at the stack of every other thread of the process at a
+fixed interval with sys._current_frames() and counts identical stacks;
+the result is in the collapsed format that flamegraph.pl and speedscope
+read, one 'thread;outermost;...;innermost count' line per stack. Threads
+that are waiting, like an event loop in select(), show up waiting.
+
+trace() runs every request handler under cProfile instead, which sees
+every call but slows the handlers down, and returns the pstats report.
+
+Nothing is installed while no profile is being taken, so the cost of
+having a profiler is nil until it is asked for.
+"""
+import collections
+import cProfile
+import functools
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+TRACE_LINES = 60  # Functions listed in a trace() report
+
+@functools.lru_cache(maxsize=65536)
+def frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def collapse(thread_name, frame):
+    """Returns the stack of frame as 'thread;outermost;...;innermost'."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    names.append(thread_name)
+    return ';'.join(reversed(names))
+
+def sample(seconds, interval):
+    """Samples the stacks of the other threads for seconds; returns a
+    Counter of collapsed stacks."""
+    me = threading.get_ident()
+    stacks = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident != me:
+                stacks[collapse(names.get(ident, str(ident)), frame)] += 1
+        time.sleep(interval)
+    return stacks
+
+def format_collapsed(stacks):
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+def trace(router, seconds):
+    """Profiles every request that router dispatches for seconds with
+    cProfile; returns the report, sorted by cumulative time.
+
+    The router's dispatch() is replaced for the duration. Handlers that
+    the asyncio server runs in its executor are traced one at a time.
+    """
+    profile = cProfile.Profile()
+    lock = threading.Lock()
+    dispatch = router.dispatch
+
+    def traced(client_socket, request):
+        with lock:
+            profile.runcall(dispatch, client_socket, request)
+
+    router.dispatch = traced
+    try:
+        time.sleep(seconds)
+    finally:
+        del router.dispatch
+    with lock:
+        pass  # Lets a handler that is still being traced finish
+    report = io.StringIO()
+    profile.create_stats()
+    if not profile.stats:
+        return "No requests were handled.\n"
+    pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(TRACE_LINES)
+    return report.getvalue()
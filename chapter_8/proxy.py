@@ -0,0 +1,455 @@
+"""Reverse proxy: forwards requests under configured path prefixes to
+upstream servers, streaming both ways.
+
+A proxied request gets an Exchange as its body consumer (see
+main.body_consumer()), so the upstream is picked and sent the request head
+when the first piece of the body arrives, and the body is passed on piece
+by piece from there. The handler then reads the upstream's response head
+and streams the body back with response.send_stream(), pulling from the
+upstream only as fast as the client takes it. Neither body is ever held in
+memory as a whole.
+
+Each Backend (one per prefix) balances over its Upstreams by least
+connections: the healthy upstream with the fewest requests in flight from
+this worker wins. Each Upstream keeps up to PROXY_POOL_SIZE idle
+keep-alive connections, reused most recently used first and dropped after
+PROXY_IDLE_TIMEOUT, which should be shorter than the upstream's own
+keep-alive timeout. A thread per worker checks every upstream every
+PROXY_HEALTH_INTERVAL seconds; an upstream that fails a check, or refuses a
+connection, gets no requests until a check passes again.
+
+Upstream I/O is blocking, with PROXY_TIMEOUT. The blocking server runs it
+like any other handler. Backend and Exchange are marked blocking, so the
+asyncio server runs the handler, the feeds and the pulls from the response
+body in its executor, and the eventloop server in its thread pool (see
+eventloop.Offload); a slow upstream holds up its own connection there, not
+the worker.
+"""
+import collections
+import socket
+import threading
+import time
+
+import framing
+import settings
+from response import head_parts, send_buffers, send_response, send_stream
+
+RECV_SIZE = 65536
+MAX_RESPONSE_HEAD = 65536
+METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')
+
+# Headers that only concern one connection, not the message (RFC 9110, 7.6.1)
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate', 'proxy-authorization',
+              'te', 'trailer', 'transfer-encoding', 'upgrade', 'content-length', 'expect'}
+MSG_PEEK_NOWAIT = socket.MSG_PEEK | getattr(socket, 'MSG_DONTWAIT', 0)
+
+class UpstreamError(Exception):
+    """The upstream could not be reached or sent something unusable."""
+
+class NoUpstream(UpstreamError):
+    """Every upstream of the prefix is down."""
+
+class Upstream:
+    """One upstream server and this worker's idle connections to it."""
+
+    def __init__(self, address):
+        host, _, port = address.rpartition(':')
+        self.address = (host, int(port))
+        self.name = address
+        self.idle = collections.deque()  # (socket, time it was released), most recent on the right
+        self.active = 0  # Requests in flight
+        self.healthy = True
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """Returns a pooled connection that is still open, or a new one, and
+        whether it was pooled."""
+        expired = time.monotonic() - settings.PROXY_IDLE_TIMEOUT
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                sock, released = self.idle.pop()
+            if released >= expired and is_open(sock):
+                return sock, True
+            sock.close()
+        sock = socket.create_connection(self.address, settings.PROXY_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, False
+
+    def release(self, sock, reusable):
+        """Takes back a connection, or None if none was opened, once its
+        exchange is over."""
+        with self.lock:
+            self.active -= 1
+            if reusable and len(self.idle) < settings.PROXY_POOL_SIZE:
+                self.idle.append((sock, time.monotonic()))
+                return
+        if sock is not None:
+            sock.close()
+
+    def close_idle(self):
+        with self.lock:
+            idle, self.idle = self.idle, collections.deque()
+        for sock, _ in idle:
+            sock.close()
+
+def is_open(sock):
+    """False if the peer closed an idle connection, or sent something on it."""
+    sock.setblocking(False)  # With a timeout, recv() would wait for data first
+    try:
+        sock.recv(1, MSG_PEEK_NOWAIT)
+        return False
+    except BlockingIOError:
+        return True  # Nothing to read: still open
+    except OSError:
+        return False
+    finally:
+        sock.settimeout(settings.PROXY_TIMEOUT)
+
+class Backend:
+    """The upstreams of one proxied prefix. It is mounted on the router as
+    the prefix's handler, and main.body_consumer() looks for it there."""
+
+    blocking = True  # See router.blocking()
+
+    def __init__(self, addresses):
+        self.upstreams = [Upstream(address) for address in addresses]
+        self.turn = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, client_socket, request):
+        handle(client_socket, request)
+
+    def choose(self, tried):
+        """Picks the healthy upstream with the fewest requests in flight and
+        counts the request against it; ties are taken in turn."""
+        with self.lock:
+            candidates = [u for u in self.upstreams if u.healthy and u not in tried]
+            if not candidates:
+                return None
+            self.turn += 1
+            count = len(candidates)
+            upstream = min((candidates[(self.turn + i) % count] for i in range(count)), key=lambda u: u.active)
+            upstream.active += 1
+            return upstream
+
+class Exchange:
+    """One request being forwarded.
+
+    As the body consumer, it opens the upstream connection with the first
+    piece of the body, or when the handler runs if there is none, sends the
+    head and passes on the body as it arrives. If the upstream fails on the
+    way, error is set and the rest of the body is dropped, so the handler
+    can still answer the client with a 502.
+    """
+
+    blocking = True  # feed() and close() wait on the upstream; see eventloop.ThreadedConsumer
+
+    def __init__(self, backend, request):
+        self.backend = backend
+        self.request = request
+        self.chunked = framing.is_chunked(request)
+        self.opened = False
+        self.upstream = None
+        self.sock = None
+        self.error = None
+        self.fed = 0
+        self.buffer = bytearray(RECV_SIZE)
+        self.start = self.end = 0  # Received from the upstream but not used yet
+
+    def open(self):
+        """Sends the head to the least busy healthy upstream that takes it."""
+        self.opened = True
+        head = request_head(self.request, self.chunked)
+        tried = set()
+        while True:
+            upstream = self.backend.choose(tried)
+            if upstream is None:
+                self.error = NoUpstream("No healthy upstream")
+                return
+            tried.add(upstream)
+            try:
+                sock, pooled = upstream.connect()
+            except OSError as e:
+                upstream.release(None, False)
+                mark_down(upstream, e)
+                continue
+            try:
+                sock.sendall(head)
+            except OSError:
+                upstream.release(sock, False)
+                if pooled:
+                    tried.discard(upstream)  # It went away while idle; the next connection may be new
+                continue
+            self.upstream, self.sock = upstream, sock
+            return
+
+    def feed(self, data):
+        if not self.opened:
+            self.open()
+        if self.sock is None:
+            return
+        self.fed += len(data)
+        try:
+            if self.chunked:
+                send_buffers(self.sock, [b"%x\r\n" % len(data), data, b"\r\n"])
+            else:
+                self.sock.sendall(data)
+        except OSError as e:
+            self.fail(e)
+
+    def close(self):
+        if not self.opened:
+            self.open()
+        if self.chunked and self.sock is not None:
+            try:
+                self.sock.sendall(b"0\r\n\r\n")
+            except OSError as e:
+                self.fail(e)
+
+    def abort(self):
+        self.release(False)
+
+    def fail(self, error):
+        self.error = error
+        self.release(False)
+
+    def release(self, reusable):
+        if self.sock is not None:
+            self.upstream.release(self.sock, reusable)
+            self.sock = None
+
+    def recv(self):
+        """Receives more of the response into the buffer; raises at the end
+        of the stream."""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            self.buffer[:self.end - self.start] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, self.end - self.start
+        n = self.sock.recv_into(memoryview(self.buffer)[self.end:])
+        if not n:
+            raise UpstreamError("Upstream closed the connection")
+        self.end += n
+
+    def read_head(self):
+        """Returns the status, the header list and whether the upstream
+        keeps the connection open, of the first final response."""
+        while True:
+            head_end = self.buffer.find(b"\r\n\r\n", self.start, self.end)
+            while head_end == -1:
+                if self.end - self.start >= MAX_RESPONSE_HEAD:
+                    raise UpstreamError("Response head is too large")
+                self.recv()
+                head_end = self.buffer.find(b"\r\n\r\n", self.start, self.end)
+            lines = bytes(self.buffer[self.start:head_end]).decode('latin1').split('\r\n')
+            self.start = head_end + 4
+            version, _, rest = lines[0].partition(' ')
+            status = framing.parse_digits(rest[:3])
+            if status is None:
+                raise UpstreamError(f"Malformed status line: {lines[0]!r}")
+            if 100 <= status < 200:
+                continue  # Interim responses are not passed on
+            headers = []
+            for line in lines[1:]:
+                name, sep, value = line.partition(':')
+                if sep:
+                    headers.append((name.strip(), value.strip()))
+            connection = ','.join(v for n, v in headers if n.lower() == 'connection').lower()
+            keep_alive = 'close' not in connection if version == 'HTTP/1.1' else 'keep-alive' in connection
+            return status, headers, keep_alive
+
+    def body(self, length, chunked, keep_alive):
+        """Yields the response body as it is received; a None length means
+        it runs until the upstream closes. The connection goes back to the
+        pool if the whole body was read and the upstream keeps it open."""
+        try:
+            if chunked:
+                pieces = Pieces()
+                decoder = framing.ChunkedDecoder(pieces, float('inf'))
+                while True:
+                    self.start += decoder.decode(self.buffer, self.start, self.end)
+                    yield from pieces.take()
+                    if decoder.done:
+                        break
+                    self.recv()
+            elif length is not None:
+                while length:
+                    if self.start == self.end:
+                        self.recv()
+                    count = min(length, self.end - self.start)
+                    yield bytes(self.buffer[self.start:self.start + count])
+                    self.start += count
+                    length -= count
+            else:
+                keep_alive = False
+                while True:
+                    if self.start < self.end:
+                        yield bytes(self.buffer[self.start:self.end])
+                        self.start = self.end
+                    try:
+                        self.recv()
+                    except UpstreamError:
+                        break
+            self.release(keep_alive and self.start == self.end)
+        finally:
+            self.release(False)  # Only still held if the body was cut short
+
+class Pieces:
+    """Consumer that collects what a ChunkedDecoder feeds it."""
+
+    def __init__(self):
+        self.pieces = []
+
+    def feed(self, data):
+        self.pieces.append(bytes(data))  # data is a view of the receive buffer
+
+    def take(self):
+        pieces, self.pieces = self.pieces, []
+        return pieces
+
+def request_head(request, chunked):
+    """Encodes the head sent upstream: the client's, minus its hop-by-hop
+    headers, plus the X-Forwarded-* ones."""
+    lines = [f"{request.method} {request.path} HTTP/1.1"]
+    for name, value in request.headers.items():
+        if name not in HOP_BY_HOP and not name.startswith('x-forwarded-'):
+            lines.append(f"{name}: {value}")
+    if request.client is not None:
+        forwarded_for = request.headers.get('x-forwarded-for')
+        client = request.client[0]
+        lines.append(f"x-forwarded-for: {forwarded_for}, {client}" if forwarded_for else f"x-forwarded-for: {client}")
+    lines.append("x-forwarded-proto: http")
+    if 'host' in request.headers:
+        lines.append(f"x-forwarded-host: {request.headers['host']}")
+    if chunked:
+        lines.append("transfer-encoding: chunked")
+    elif 'content-length' in request.headers:
+        lines.append(f"content-length: {request.headers['content-length']}")
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin1')
+
+def mark_down(upstream, error):
+    """Takes an upstream out of rotation until a health check passes; with
+    the checks off there is nothing to bring it back, so it stays in."""
+    if settings.PROXY_HEALTH_INTERVAL > 0 and upstream.healthy:
+        upstream.healthy = False
+        print(f"Upstream {upstream.name} is down: {error!r}")
+    upstream.close_idle()
+
+def handle(client_socket, request):
+    """Answers a proxied request with the upstream's response."""
+    exchange = request.body_consumer
+    if not exchange.opened:
+        exchange.open()
+    if isinstance(exchange.error, NoUpstream):
+        send_response(client_socket, request, 503, "No upstream available.")
+        return
+    if exchange.error is not None:
+        print(f"Upstream {exchange.upstream.name} failed: {exchange.error!r}")
+        send_response(client_socket, request, 502, "Bad gateway.")
+        return
+    try:
+        status, headers, keep_alive = exchange.read_head()
+    except socket.timeout:
+        exchange.release(False)
+        send_response(client_socket, request, 504, "Gateway timeout.")
+        return
+    except (OSError, UpstreamError) as e:
+        print(f"Upstream {exchange.upstream.name} failed: {e!r}")
+        exchange.release(False)
+        send_response(client_socket, request, 502, "Bad gateway.")
+        return
+    names = {name.lower() for name, _ in headers}
+    passed = [(name, value) for name, value in headers if name.lower() not in HOP_BY_HOP]
+    if request.method == 'HEAD' or status in (204, 304):
+        # No body, but the Content-Length of the resource it describes, if any, still applies
+        passed += [(name, value) for name, value in headers if name.lower() == 'content-length']
+        send_buffers(client_socket, head_parts(request, status, headers=passed))
+        request.response_size = 0
+        exchange.release(keep_alive)
+        return
+    chunked = 'transfer-encoding' in names
+    length = None
+    if not chunked and 'content-length' in names:
+        value = next(value for name, value in headers if name.lower() == 'content-length')
+        length = framing.parse_digits(value)
+        if length is None:
+            exchange.release(False)
+            send_response(client_socket, request, 502, "Bad gateway.")
+            return
+    send_stream(client_socket, request, status, exchange.body(length, chunked, keep_alive),
+                content_type=None, headers=passed, content_length=length)
+
+backends = {}  # Prefix -> Backend
+checker = None
+stopping = threading.Event()
+
+def backend_for(prefix):
+    backend = backends.get(prefix)
+    if backend is None:
+        backend = backends[prefix] = Backend(settings.PROXY_ROUTES[prefix])
+    return backend
+
+def check(upstream):
+    """Raises if the upstream does not accept a connection, or does not
+    answer a GET of PROXY_HEALTH_PATH with a status below 500."""
+    with socket.create_connection(upstream.address, settings.PROXY_TIMEOUT) as sock:
+        if not settings.PROXY_HEALTH_PATH:
+            return
+        sock.sendall(f"GET {settings.PROXY_HEALTH_PATH} HTTP/1.1\r\nHost: {upstream.name}\r\n"
+                     f"Connection: close\r\n\r\n".encode('latin1'))
+        status_line = sock.recv(RECV_SIZE).partition(b'\r\n')[0]
+        parts = status_line.split(b' ')
+        status = framing.parse_digits(parts[1].decode('latin1')) if len(parts) >= 2 else None
+        if status is None:
+            raise UpstreamError(f"Malformed status line: {status_line!r}")
+        if status >= 500:
+            raise UpstreamError(f"Health check answered {status}")
+
+def run_checks():
+    while not stopping.wait(settings.PROXY_HEALTH_INTERVAL):
+        for prefix in settings.PROXY_ROUTES:
+            for upstream in backend_for(prefix).upstreams:
+                try:
+                    check(upstream)
+                except (OSError, UpstreamError) as e:
+                    mark_down(upstream, e)
+                else:
+                    if not upstream.healthy:
+                        upstream.healthy = True
+                        print(f"Upstream {upstream.name} is up")
+
+def start():
+    """Starts the health checks; called in each process that serves requests."""
+    global checker
+    if not settings.PROXY_ROUTES or settings.PROXY_HEALTH_INTERVAL <= 0:
+        return
+    stopping.clear()
+    checker = threading.Thread(target=run_checks, name='proxy-health', daemon=True)
+    checker.start()
+
+def stop():
+    global checker
+    if checker is not None:
+        stopping.set()
+        checker.join()
+        checker = None
+    for backend in backends.values():
+        for upstream in backend.upstreams:
+            upstream.close_idle()
+
+def parse_routes(values):
+    """Parses --proxy PREFIX=HOST:PORT[,HOST:PORT...] arguments into PROXY_ROUTES."""
+    routes = {}
+    for value in values:
+        prefix, sep, addresses = value.partition('=')
+        if not sep or not prefix.startswith('/') or not addresses:
+            raise ValueError(f"Expected PREFIX=HOST:PORT[,HOST:PORT...], not {value!r}")
+        upstreams = routes.setdefault(prefix.rstrip('/') or '/', [])
+        for address in addresses.split(','):
+            host, _, port = address.rpartition(':')
+            if not host or framing.parse_digits(port) is None:
+                raise ValueError(f"Expected HOST:PORT, not {address!r}")
+            upstreams.append(address)
+    return routes
@@ -0,0 +1,238 @@
+"""Replays traffic captured with main.py --capture against a local server.
+
+Requests go out at the pace at which they originally arrived, or --speed
+times faster, over --concurrency keep-alive connections, and the latency
+distribution is reported at the end. With pacing, latency is measured from
+when a request was due rather than from when a connection got around to
+sending it, so a server that falls behind shows it in the tail instead of
+quietly slowing the replay down. With --speed 0 requests are sent as fast
+as the connections allow and latency is measured from the send.
+
+    python main.py --capture captured.jsonl
+    python replay.py captured.jsonl --port 8000 --speed 2 --concurrency 16
+
+Bodies that were captured by size and digest only are made up: random
+bytes of the same length, or for a multipart upload a form with the same
+fields and random files of the same names and sizes. They are generated
+and sent BODY_CHUNK_SIZE bytes at a time, after a Content-Length worked out
+up front, so replaying a large upload does not hold it in memory. Redacted
+headers are left out, and every request is sent as HTTP/1.1 with keep-alive.
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import json
+import os
+import sys
+import time
+
+import bench
+import capture
+import multipart
+
+# Headers that describe the original connection or framing; replay sets its own
+HOP_BY_HOP = {'connection', 'keep-alive', 'proxy-connection', 'content-length', 'transfer-encoding',
+              'te', 'trailer', 'upgrade', 'expect'}
+BODY_METHODS = {'POST', 'PUT', 'PATCH'}
+BODY_CHUNK_SIZE = 65536  # Made-up bodies are generated this much at a time
+
+class Entry:
+    """One captured request: when it is due, relative to the first one, and
+    everything needed to send it again."""
+
+    def __init__(self, record, offset):
+        self.offset = offset
+        self.record = record
+        self.method = record['method']
+        self.path = record['path']
+        self.status = record.get('status')
+        headers = record.get('headers', {})
+        self.headers = {name: value for name, value in headers.items()
+                        if name not in HOP_BY_HOP and value != capture.REDACTED}
+
+    def body(self):
+        """Returns the length of the body to send and an iterator of its
+        pieces, made up anew on every call when it was not captured whole."""
+        record = self.record
+        if 'body' in record:
+            body = base64.b64decode(record['body'])
+            return len(body), iter([body])
+        if 'form' in record:
+            return build_form(self.headers.get('content-type', ''), record['form'])
+        size = record.get('body_size') or 0
+        return size, random_bytes(size)
+
+    def encode(self):
+        """Returns the head, the body length and the body pieces."""
+        length, pieces = self.body()
+        lines = [f"{self.method} {self.path} HTTP/1.1"]
+        lines += [f"{name}: {value}" for name, value in self.headers.items()]
+        if length or self.method in BODY_METHODS:
+            lines.append(f"content-length: {length}")
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin1')
+        return head, length, pieces
+
+def random_bytes(size):
+    """Yields size random bytes, BODY_CHUNK_SIZE at a time."""
+    while size > 0:
+        chunk = os.urandom(min(size, BODY_CHUNK_SIZE))
+        size -= len(chunk)
+        yield chunk
+
+def build_form(content_type, form):
+    """A multipart/form-data body with the captured fields and random
+    files of the captured sizes, delimited by the captured boundary; returns
+    its length and an iterator of its pieces."""
+    boundary = multipart.parse_boundary(content_type) or b'replay-boundary'
+    parts = []  # Bytes, or the size of a random file
+    for name, value in form.get('fields', {}).items():
+        parts.append(b'--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                     % (boundary, name.encode(), value.encode()))
+    for f in form.get('files', []):
+        parts.append(b'--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                     b'Content-Type: application/octet-stream\r\n\r\n'
+                     % (boundary, f['name'].encode(), f['filename'].encode()))
+        parts.append(f['size'] or 0)
+        parts.append(b'\r\n')
+    parts.append(b'--%s--\r\n' % boundary)
+    return sum(part if isinstance(part, int) else len(part) for part in parts), form_pieces(parts)
+
+def form_pieces(parts):
+    for part in parts:
+        if isinstance(part, int):
+            yield from random_bytes(part)
+        else:
+            yield part
+
+def load(path):
+    """Reads a capture file; returns its entries in order of arrival. Lines
+    that are not requests, such as the writer's drop counts, are skipped."""
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if 'method' in record and 'path' in record:
+                records.append(record)
+    records.sort(key=lambda record: record['time'])
+    if not records:
+        return []
+    first = records[0]['time']
+    return [Entry(record, record['time'] - first) for record in records]
+
+async def connection(host, port, queue, timeout, stats):
+    """Sends the requests it takes off the queue over one connection,
+    reconnecting after errors and responses that close it."""
+    reader = writer = None
+    while True:
+        item = await queue.get()
+        if item is None:
+            break
+        due, entry = item
+        head, length, pieces = entry.encode()
+        start = time.perf_counter()
+        if due is not None:
+            stats['send_lag'].append(max(0.0, start - due))
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(head)
+            for piece in pieces:
+                writer.write(piece)
+                await writer.drain()
+            await writer.drain()
+            status, received, reusable = await asyncio.wait_for(bench.read_response(reader), timeout)
+            stats['latencies'].append(time.perf_counter() - (start if due is None else due))
+            stats['bytes'] += received + len(head) + length
+            stats['statuses'][status] += 1
+            if entry.status is not None and status != entry.status:
+                stats['mismatches'] += 1
+        except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ValueError, IndexError):
+            stats['errors'] += 1
+            reusable = False
+        if not reusable and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+async def replay(entries, host, port, speed, concurrency, timeout):
+    """Hands the entries to the connections as they fall due."""
+    stats = {'latencies': [], 'send_lag': [], 'bytes': 0, 'errors': 0, 'mismatches': 0,
+             'statuses': collections.Counter()}
+    queue = asyncio.Queue()
+    connections = [asyncio.create_task(connection(host, port, queue, timeout, stats))
+                   for _ in range(concurrency)]
+    started = time.perf_counter()
+    for entry in entries:
+        due = None
+        if speed > 0:
+            due = started + entry.offset / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        queue.put_nowait((due, entry))
+    for _ in connections:
+        queue.put_nowait(None)
+    await asyncio.gather(*connections)
+    return stats, time.perf_counter() - started
+
+def milliseconds(values):
+    values = sorted(values)
+    return {name: None if value is None else round(value * 1000, 3)
+            for name, value in (('p50', bench.percentile(values, 0.50)),
+                                ('p95', bench.percentile(values, 0.95)),
+                                ('p99', bench.percentile(values, 0.99)),
+                                ('p999', bench.percentile(values, 0.999)),
+                                ('max', values[-1] if values else None))}
+
+def summarize(path, entries, stats, elapsed, speed):
+    return {
+        'capture': path,
+        'speed': speed,
+        'requests': len(entries),
+        'responses': len(stats['latencies']),
+        'errors': stats['errors'],
+        'status_mismatches': stats['mismatches'],
+        'statuses': {str(status): count for status, count in sorted(stats['statuses'].items())},
+        'captured_span_s': round(entries[-1].offset, 3) if entries else 0.0,
+        'duration_s': round(elapsed, 3),
+        'requests_per_sec': round(len(stats['latencies']) / elapsed, 1) if elapsed else None,
+        'bytes_per_sec': round(stats['bytes'] / elapsed) if elapsed else None,
+        'latency_ms': milliseconds(stats['latencies']),
+        'send_lag_ms': milliseconds(stats['send_lag']),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('capture', help='file written by main.py --capture')
+    parser.add_argument('--host', default=bench.HOST)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='multiple of the captured pace; 0 sends as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=16, help='connections to replay over')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='seconds before a request counts as failed')
+    parser.add_argument('--output', help='also write the report to this JSON file')
+    args = parser.parse_args()
+
+    entries = load(args.capture)
+    if not entries:
+        sys.exit(f"No requests in {args.capture}")
+    print(f"Replaying {len(entries)} requests from {args.capture} to {args.host}:{args.port}"
+          f" ({'as fast as possible' if args.speed <= 0 else f'{args.speed:g}x'})...")
+    stats, elapsed = asyncio.run(replay(entries, args.host, args.port, args.speed,
+                                        args.concurrency, args.timeout))
+    report = summarize(args.capture, entries, stats, elapsed, args.speed)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+import functools
+import http
+import socket
+
+import metrics
+
+STATUS_REASONS = {
+    200: 'OK',
+    201: 'Created',
+    204: 'No Content',
+    206: 'Partial Content',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    409: 'Conflict',
+    413: 'Payload Too Large',
+    415: 'Unsupported Media Type',
+    416: 'Range Not Satisfiable',
+    460: 'Checksum Mismatch',
+    500: 'Internal Server Error',
+    502: 'Bad Gateway',
+    503: 'Service Unavailable',
+    504: 'Gateway Timeout',
+}
+
+# Encoded once: the status lines, and the end of the head in its two variants
+STATUS_LINES = {status: f"HTTP/1.1 {status} {reason}\r\n".encode('latin1')
+                for status, reason in STATUS_REASONS.items()}
+END_OF_HEAD = {True: b"Connection: keep-alive\r\n\r\n", False: b"Connection: close\r\n\r\n"}
+
+# Lets the head of a response share packets with the file sent after it
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+def status_line(status):
+    """The encoded status line; statuses outside STATUS_REASONS, which
+    only proxied responses have, are encoded once on first use."""
+    line = STATUS_LINES.get(status)
+    if line is None:
+        try:
+            reason = http.HTTPStatus(status).phrase
+        except ValueError:
+            reason = 'Unknown'
+        line = STATUS_LINES[status] = f"HTTP/1.1 {status} {reason}\r\n".encode('latin1')
+    return line
+
+@functools.lru_cache(maxsize=4096)
+def header_line(name, value):
+    """Encodes a header line; the common ones (content types, Cache-Control,
+    the validators of popular files) are encoded once and reused."""
+    return f"{name}: {value}\r\n".encode('latin1')
+
+def head_parts(request, status, content_type=None, content_length=None, headers=()):
+    """Returns the status line and headers of a response as a list of
+    buffers, to be sent with send_buffers().
+
+    headers is a sequence of extra (name, value) pairs. content_length may
+    only be left out for responses that never have a body, such as 304.
+    """
+    metrics.count_response(status)
+    request.status = status
+    request.response_size = content_length
+    parts = [status_line(status)]
+    if content_type is not None:
+        parts.append(header_line('Content-Type', content_type))
+    if content_length is not None:
+        parts.append(b"Content-Length: %d\r\n" % content_length)
+    for name, value in headers:
+        parts.append(header_line(name, value))
+    parts.append(END_OF_HEAD[request.keep_alive])
+    return parts
+
+def send_buffers(client_socket, buffers, flags=0):
+    """Writes buffers with a single sendmsg() (writev) call, falling back to
+    sendall() for whatever the socket did not take."""
+    sent = client_socket.sendmsg(buffers, (), flags)
+    if sent < sum(map(len, buffers)):
+        client_socket.sendall(memoryview(b''.join(buffers))[sent:], flags)
+
+def send_response(client_socket, request, status, body, content_type='text/plain', headers=()):
+    """Sends a complete response with a small in-memory body."""
+    body = body.encode() if isinstance(body, str) else body
+    send_buffers(client_socket, head_parts(request, status, content_type, len(body), headers) + [body])
+
+def send_file(client_socket, request, status, content_type, f, offset, count, headers=()):
+    """Sends a response whose body is count bytes of f from offset.
+
+    The head goes out with MSG_MORE, so the kernel holds it back and sends
+    it in the same packets as the start of the file instead of on its own.
+    """
+    parts = head_parts(request, status, content_type, count, headers)
+    if not count:
+        send_buffers(client_socket, parts)
+        return
+    send_buffers(client_socket, parts, MSG_MORE)
+    client_socket.sendfile(f, offset, count)
+
+def send_stream(client_socket, request, status, chunks, content_type='text/plain', headers=(), content_length=None):
+    """Sends a response whose body is produced by an iterable of bytes-like
+    chunks, with Transfer-Encoding: chunked, so it never has to be in
+    memory as a whole and its first bytes go out as soon as they exist.
+
+    Chunks are only pulled as the client takes them: a blocking socket
+    waits in sendmsg(), and the event loops ask the iterable for more once
+    the socket has drained what came before. HTTP/1.0 clients get the
+    chunks as they are, and the end of the body is the end of the connection.
+    If content_length is known up front, the chunks go out as they are
+    after a Content-Length instead.
+    """
+    chunked = content_length is None and request.version != 'HTTP/1.0'
+    if chunked:
+        headers = [('Transfer-Encoding', 'chunked'), *headers]
+    elif content_length is None:
+        request.keep_alive = False
+    head = head_parts(request, status, content_type, content_length, headers=headers)
+    buffers = stream_buffers(request, head, chunks, chunked)
+    if hasattr(client_socket, 'send_stream'):
+        client_socket.send_stream(buffers)
+    else:
+        for parts in buffers:
+            send_buffers(client_socket, parts)
+
+def stream_buffers(request, head, chunks, chunked):
+    """Yields lists of buffers to send: the head with the first chunk, each
+    chunk after that, and the last-chunk that ends a chunked body."""
+    parts = head
+    request.response_size = 0
+    chunks = iter(chunks)
+    while True:
+        try:
+            chunk = next(chunks, None)
+        except Exception as e:
+            # The head is out already, so the only way to fail is to hang up
+            print(f"Error streaming response: {e!r}")
+            raise ConnectionAbortedError("Response stream failed") from e
+        if chunk is None:
+            break
+        if not chunk:
+            continue  # An empty chunk would end the body
+        request.response_size += len(chunk)
+        if chunked:
+            parts += [b"%x\r\n" % len(chunk), chunk, b"\r\n"]
+        else:
+            parts.append(chunk)
+        yield parts
+        parts = []
+    if chunked:
+        parts.append(b"0\r\n\r\n")
+    if parts:
+        yield parts
+
+class PrebuiltResponse:
+    """A small response encoded once up front, in a keep-alive and a close
+    variant, for answers that do not depend on the request."""
+
+    def __init__(self, status, body, content_type='text/plain', headers=()):
+        self.status = status
+        body = body.encode()
+        self.size = len(body)
+        head = status_line(status) + header_line('Content-Type', content_type)
+        head += b"Content-Length: %d\r\n" % len(body)
+        head += b''.join(header_line(name, value) for name, value in headers)
+        self.variants = {keep_alive: head + END_OF_HEAD[keep_alive] + body for keep_alive in (True, False)}
+
+def send_prebuilt(client_socket, request, response):
+    metrics.count_response(response.status)
+    request.status = response.status
+    request.response_size = response.size
+    client_socket.sendall(response.variants[request.keep_alive])
@@ -0,0 +1,484 @@
+"""Resumable uploads: a large file sent in pieces, over as many requests
+and connections as it takes, in the manner of the tus protocol. They are
+off unless RESUMABLE_PATH (--resumable-path) names a prefix; with /files:
+
+    POST   /files                Upload-Length: <size>
+                                 Upload-Metadata: filename <base64>    (optional)
+                                 -> 201 Created, Location: /files/<id>
+    HEAD   /files/<id>           -> Upload-Offset, Upload-Length, Upload-Ranges
+    PATCH  /files/<id>           Upload-Offset: <offset>
+                                 Content-Type: application/offset+octet-stream
+                                 -> 204 No Content, Upload-Offset
+    POST   /files/<id>/finalize  Upload-Checksum: sha256 <hex or base64 digest>
+                                 -> 200, the file is stored under its filename
+    DELETE /files/<id>           -> 204 No Content
+
+Upload-Offset in a response is how much of the file, from its start, has
+arrived. A PATCH may start at any offset inside the file rather than only
+there, so a client can send several pieces at once over parallel
+connections; Upload-Ranges lists every byte range received so far, in the
+inclusive start-end form of a Range header, so that resuming such an
+upload means sending only the gaps. A connection that drops in the middle
+of a PATCH keeps what arrived before it did.
+
+The state lives in partial/ under the uploads directory, so it outlives the
+process: <id>.part is the file, written in place with pwrite() as pieces
+arrive, and <id>.json its length, filename and received ranges. The JSON is
+replaced atomically after every PATCH, under an flock() of <id>.lock, so
+the workers agree on it. Uploads that nobody wrote to for
+RESUMABLE_EXPIRY seconds are gone: they answer 404, and the sweep that
+creating or finalizing an upload runs now and then removes their files.
+Nothing is preallocated: a create costs no disk space, so anyone who can
+reach the endpoint cannot reserve Upload-Length bytes for a day at a time.
+
+Finalizing checks that every byte arrived and that the SHA-256 matches,
+then moves the file into the content-addressed store (see uploadstore),
+where it is linked under its filename like a multipart upload. A PATCH
+holds a shared flock() of the .part file while it writes, and finalizing
+takes it exclusively, so it answers 409 rather than move a file that is
+still being written to, and a PATCH that comes later gets a 409 or 404.
+A worker hashes the pieces it receives in order, as they arrive, so
+finalizing only reads back what it did not see arrive, such as pieces sent
+in parallel or before a restart; it is marked router.blocking() so the
+event loop servers do that in a thread. The JSON counts the PATCHes
+recorded, and a worker's running hash is only trusted while every one of
+them was its own: a piece another worker wrote may have replaced bytes it
+already hashed.
+"""
+import base64
+import collections
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import framing
+import multipart
+import router
+import settings
+import uploadstore
+from response import head_parts, send_buffers, send_response
+
+ID_RE = re.compile(r'[0-9a-f]{32}')
+OFFSET_CONTENT_TYPE = 'application/offset+octet-stream'
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_ENTRIES = 256  # Uploads per worker whose running SHA-256 is kept
+
+# Upload id -> [offset, SHA-256 of the file up to offset, Upload.writes it is valid for],
+# of the pieces this worker received
+hashes = collections.OrderedDict()
+hashes_lock = threading.Lock()
+last_sweep = 0.0
+
+class UploadError(Exception):
+    """A request about an upload that cannot be carried out; it is answered
+    with status and the message."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def partial_directory():
+    return os.path.join(settings.UPLOADS_DIRECTORY, 'partial')
+
+class Upload:
+    """The state of one upload, as last read from or written to its JSON."""
+
+    def __init__(self, upload_id, length=0, filename=None):
+        directory = partial_directory()
+        self.id = upload_id
+        self.data_path = os.path.join(directory, upload_id + '.part')
+        self.meta_path = os.path.join(directory, upload_id + '.json')
+        self.lock_path = os.path.join(directory, upload_id + '.lock')
+        self.length = length
+        self.filename = filename
+        self.ranges = []  # Sorted, disjoint [start, end) pairs
+        self.writes = 0  # PATCHes recorded, by any worker
+
+    @property
+    def offset(self):
+        """Bytes received from the start of the file without a gap."""
+        if self.ranges and self.ranges[0][0] == 0:
+            return self.ranges[0][1]
+        return 0
+
+    def headers(self):
+        received = ','.join(f"{start}-{end - 1}" for start, end in self.ranges)
+        return [('Upload-Offset', str(self.offset)), ('Upload-Length', str(self.length)),
+                ('Upload-Ranges', received), ('Cache-Control', 'no-store')]
+
+    def load(self):
+        try:
+            with open(self.meta_path) as f:
+                updated = os.fstat(f.fileno()).st_mtime
+                state = json.load(f)
+        except (OSError, ValueError):
+            raise UploadError(404, "No such upload.") from None
+        if time.time() - updated > settings.RESUMABLE_EXPIRY:
+            raise UploadError(404, "Upload expired.")
+        self.length = state['length']
+        self.filename = state['filename']
+        self.ranges = state['ranges']
+        self.writes = state.get('writes', 0)
+        return self
+
+    def save(self):
+        """Replaces the JSON, atomically and synced per UPLOAD_FSYNC."""
+        temp_path = f"{self.meta_path}.{os.urandom(4).hex()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'length': self.length, 'filename': self.filename, 'ranges': self.ranges,
+                       'writes': self.writes}, f)
+            if settings.UPLOAD_FSYNC != 'none':
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, self.meta_path)
+        if settings.UPLOAD_FSYNC == 'full':
+            uploadstore.fsync_directory(os.path.dirname(self.meta_path))
+
+def find(upload_id):
+    """Returns the Upload with this id; raises UploadError for unknown ones."""
+    if not ID_RE.fullmatch(upload_id):
+        raise UploadError(404, "No such upload.")
+    return Upload(upload_id).load()
+
+def add_range(ranges, start, end):
+    """Merges [start, end) into sorted, disjoint ranges."""
+    merged = []
+    for first, last in ranges:
+        if last < start or first > end:
+            merged.append([first, last])
+        else:
+            start, end = min(start, first), max(end, last)
+    merged.append([start, end])
+    merged.sort()
+    return merged
+
+def record(upload_id, start, end):
+    """Adds [start, end) to the ranges of the upload; returns the updated
+    Upload. The lock is a file of its own: the writers' shared lock of the
+    .part file cannot be upgraded while other writers hold it."""
+    fd = os.open(Upload(upload_id).lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        upload = find(upload_id)
+        upload.ranges = add_range(upload.ranges, start, end)
+        upload.writes += 1
+        upload.save()
+        with hashes_lock:
+            entry = hashes.get(upload_id)
+            if entry is not None:
+                if entry[2] == upload.writes - 1:
+                    entry[2] = upload.writes
+                else:
+                    del hashes[upload_id]  # Another worker wrote to the file since
+        return upload
+    finally:
+        os.close(fd)
+
+def lock_for_writing(fd, upload_id):
+    """Takes the shared lock a PATCH holds on the .part file until it is
+    done, which keeps handle_finalize() from moving the file meanwhile."""
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        raise UploadError(409, "Upload is being finalized.") from None
+    find(upload_id)  # It may have been finalized between the open() and the flock()
+
+def hash_piece(upload_id, writes, position, data):
+    """Adds a piece just written at position to the upload's running hash,
+    if it continues it; the first piece of a file starts one, valid for the
+    writes the PATCH found recorded."""
+    with hashes_lock:
+        entry = hashes.get(upload_id)
+        if entry is None:
+            if position != 0:
+                return
+            entry = hashes[upload_id] = [0, hashlib.sha256(), writes]
+            if len(hashes) > HASH_ENTRIES:
+                hashes.popitem(last=False)
+        if entry[0] == position:
+            entry[1].update(data)
+            entry[0] += len(data)
+        elif position < entry[0]:
+            del hashes[upload_id]  # Hashed bytes are being written again; they may differ
+
+def catch_up(upload, fd):
+    """Returns the SHA-256 of the upload's file: the running hash, advanced
+    to its length by reading back the pieces that arrived out of order, or
+    a new hash of all of it if other workers wrote to the file as well."""
+    with hashes_lock:
+        entry = hashes.pop(upload.id, None)
+    if entry is None or entry[2] != upload.writes:
+        entry = (0, hashlib.sha256(), upload.writes)
+    position, digest, _ = entry
+    length = upload.length
+    while position < length:
+        data = os.pread(fd, min(HASH_CHUNK_SIZE, length - position), position)
+        if not data:
+            break
+        digest.update(data)
+        position += len(data)
+    return digest
+
+def forget(upload_id):
+    with hashes_lock:
+        hashes.pop(upload_id, None)
+
+class ChunkWriter:
+    """The body consumer of a PATCH: writes the piece into the upload's
+    file at Upload-Offset as it arrives, and records the range it covered
+    once the body ends or the connection drops.
+
+    Problems with the request are kept in error, and the rest of the body
+    is dropped, for handle_patch() to answer with.
+    """
+
+    blocking = True  # feed() writes, and finish() fsync()s and flock()s; see eventloop.ThreadedConsumer
+
+    def __init__(self, upload_id, request):
+        self.upload_id = upload_id
+        self.fd = None
+        self.error = None
+        self.fed = 0
+        self.offset = 0
+        self.lock = threading.Lock()  # abort() may come from the event loop while feed() runs in the executor
+        try:
+            upload = find(upload_id)
+            self.offset = upload.offset
+            self.length = upload.length
+            self.writes = upload.writes
+            content_type = request.headers.get('content-type', '').partition(';')[0].strip()
+            if content_type != OFFSET_CONTENT_TYPE:
+                raise UploadError(415, f"PATCH bodies must be {OFFSET_CONTENT_TYPE}.")
+            self.start = self.position = required_number(request, 'upload-offset')
+            declared = required_number(request, 'content-length') if 'content-length' in request.headers else 0
+            if self.start + declared > self.length:
+                raise UploadError(400, f"The piece runs past Upload-Length ({self.length}).")
+            fd = os.open(upload.data_path, os.O_RDWR)
+            try:
+                lock_for_writing(fd, upload_id)
+            except UploadError:
+                os.close(fd)
+                raise
+            self.fd = fd
+        except UploadError as e:
+            self.error = e
+        except OSError:
+            self.error = UploadError(404, "No such upload.")
+
+    def feed(self, data):
+        self.fed += len(data)
+        with self.lock:
+            if self.fd is None or self.error is not None:
+                return
+            if self.position + len(data) > self.length:
+                self.error = UploadError(400, f"The piece runs past Upload-Length ({self.length}).")
+                return
+            view = memoryview(data)
+            try:
+                while view:
+                    written = os.pwrite(self.fd, view, self.position)
+                    hash_piece(self.upload_id, self.writes, self.position, view[:written])
+                    self.position += written
+                    view = view[written:]
+            except OSError as e:
+                self.error = UploadError(500, f"Could not write the piece: {e.strerror}.")
+
+    def close(self):
+        self.finish()
+
+    def abort(self):
+        self.finish()  # What arrived is kept for the client to resume after
+
+    def finish(self):
+        with self.lock:
+            fd, self.fd = self.fd, None
+        if fd is None:
+            return
+        try:
+            if self.position > self.start:
+                if settings.UPLOAD_FSYNC != 'none':
+                    os.fsync(fd)  # Ranges are only recorded once their bytes are on disk
+                self.offset = record(self.upload_id, self.start, self.position).offset
+        except UploadError as e:
+            self.error = self.error or e
+        except OSError as e:
+            self.error = self.error or UploadError(500, f"Could not record the piece: {e.strerror}.")
+        finally:
+            os.close(fd)
+
+def required_number(request, name):
+    """The value of a numeric header the request must have; a missing or
+    invalid one is answered with a 400."""
+    try:
+        number = framing.header_number(request, name)
+    except framing.BadRequest:
+        number = None
+    if number is None:
+        raise UploadError(400, f"Missing or invalid {name.title()}.")
+    return number
+
+def parse_metadata(value):
+    """Decodes Upload-Metadata: comma-separated keys, each followed by its
+    value in base64."""
+    metadata = {}
+    for pair in value.split(','):
+        key, _, encoded = pair.strip().partition(' ')
+        if not key:
+            continue
+        try:
+            metadata[key] = base64.b64decode(encoded.strip(), validate=True).decode('utf-8')
+        except ValueError:
+            raise UploadError(400, f"Invalid Upload-Metadata value for {key}.") from None
+    return metadata
+
+def parse_checksum(value):
+    """Returns the hex SHA-256 of an Upload-Checksum: 'sha256 <digest>',
+    with the digest in hex or, as tus sends it, base64."""
+    algorithm, _, encoded = value.strip().partition(' ')
+    encoded = encoded.strip()
+    digest = b''
+    if algorithm.lower() == 'sha256':
+        try:
+            digest = bytes.fromhex(encoded) if len(encoded) == 64 else base64.b64decode(encoded, validate=True)
+        except ValueError:
+            pass
+    if len(digest) != hashlib.sha256().digest_size:
+        raise UploadError(400, "Upload-Checksum must be 'sha256 <digest>', in hex or base64.")
+    return digest.hex()
+
+def send_head(client_socket, request, status, headers=()):
+    """Sends a response that has no body: a 204, or the answer to a HEAD."""
+    send_buffers(client_socket, head_parts(request, status, headers=headers))
+
+def send_error(client_socket, request, error):
+    if request.method == 'HEAD':
+        send_head(client_socket, request, error.status)
+    else:
+        send_response(client_socket, request, error.status, str(error))
+
+def sweep():
+    """Removes the files of expired uploads, at most every
+    RESUMABLE_SWEEP_INTERVAL seconds per worker."""
+    global last_sweep
+    now = time.time()
+    if now - last_sweep < settings.RESUMABLE_SWEEP_INTERVAL:
+        return
+    last_sweep = now
+    cutoff = now - settings.RESUMABLE_EXPIRY
+    try:
+        entries = os.scandir(partial_directory())
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            upload = Upload(entry.name.partition('.')[0])
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                if os.stat(upload.meta_path).st_mtime >= cutoff:
+                    continue  # Such as the .lock of an upload that is still being written to
+            except FileNotFoundError:
+                pass  # No JSON: what is left of an upload finalized or swept meanwhile
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+            forget(upload.id)
+
+def remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+def handle_create(client_socket, request):
+    sweep()
+    try:
+        length = required_number(request, 'upload-length')
+        if length > settings.MAX_UPLOAD_SIZE:
+            raise UploadError(413, f"Uploads are limited to {settings.MAX_UPLOAD_SIZE} bytes.")
+        metadata = parse_metadata(request.headers.get('upload-metadata', ''))
+    except UploadError as e:
+        send_error(client_socket, request, e)
+        return
+    upload_id = os.urandom(16).hex()
+    filename = multipart.safe_filename(metadata.get('filename', '')) or upload_id
+    upload = Upload(upload_id, length, filename)
+    os.makedirs(partial_directory(), exist_ok=True)
+    os.close(os.open(upload.data_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+    upload.save()
+    location = f"{settings.RESUMABLE_PATH.rstrip('/')}/{upload_id}"
+    send_response(client_socket, request, 201, f"Upload {upload_id} created.",
+                  headers=[('Location', location), ('Upload-Offset', '0')])
+
+def handle_head(client_socket, request):
+    try:
+        upload = find(request.params['id'])
+    except UploadError as e:
+        send_error(client_socket, request, e)
+        return
+    send_head(client_socket, request, 200, upload.headers())
+
+def handle_patch(client_socket, request):
+    writer = request.body_consumer
+    if writer.error is not None:
+        send_error(client_socket, request, writer.error)
+        return
+    send_head(client_socket, request, 204, [('Upload-Offset', str(writer.offset))])
+
+@router.blocking
+def handle_finalize(client_socket, request):
+    """Checks the upload is complete and matches Upload-Checksum, and moves
+    it into the upload store. A mismatch leaves the upload as it is, and so
+    does a PATCH that is still running."""
+    sweep()
+    try:
+        expected = parse_checksum(request.headers.get('upload-checksum', ''))
+        upload = find(request.params['id'])
+        fd = os.open(upload.data_path, os.O_RDWR)
+    except UploadError as e:
+        send_error(client_socket, request, e)
+        return
+    except OSError:
+        send_response(client_socket, request, 404, "No such upload.")
+        return
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)  # Nobody writes to the file, or finalizes it, meanwhile
+        except BlockingIOError:
+            raise UploadError(409, "Upload is still being written to.") from None
+        upload.load()
+        if upload.offset < upload.length:
+            raise UploadError(409, f"Upload is incomplete: {upload.offset} of {upload.length} bytes received.")
+        digest = catch_up(upload, fd).hexdigest()
+        if digest != expected:
+            raise UploadError(460, f"Checksum mismatch: the upload's SHA-256 is {digest}.")
+        if settings.UPLOAD_FSYNC != 'none':
+            os.fsync(fd)
+        store = uploadstore.store_for(settings.UPLOADS_DIRECTORY)
+        store.add_object(upload.data_path, digest)
+        store.link(upload.filename, digest)
+        os.unlink(upload.meta_path)
+        remove(upload.lock_path)
+    except UploadError as e:
+        send_error(client_socket, request, e)
+        return
+    finally:
+        os.close(fd)
+    forget(upload.id)
+    send_response(client_socket, request, 200, f"Stored {upload.filename} ({upload.length} bytes, sha256 {digest}).")
+
+def handle_delete(client_socket, request):
+    try:
+        upload = find(request.params['id'])
+    except UploadError as e:
+        send_error(client_socket, request, e)
+        return
+    for path in (upload.meta_path, upload.data_path, upload.lock_path):
+        remove(path)
+    forget(upload.id)
+    send_head(client_socket, request, 204)
@@ -0,0 +1,200 @@
+import inspect
+import os
+import urllib.parse
+
+from response import PrebuiltResponse, send_prebuilt, send_stream
+
+NOT_FOUND = PrebuiltResponse(404, "File not found.")
+
+class Node:
+    """One path segment of the routing trie."""
+
+    def __init__(self):
+        self.children = {}  # Static segment -> Node
+        self.param = None  # Node for a {name} segment
+        self.param_name = None
+        self.handlers = {}  # Method -> handler for routes ending here
+        self.mounts = {}  # Method -> (handler, indexed) for mounts at this prefix
+        self.exists = False  # A file of an indexed mount directory is at this path
+        # Filled in by Router.compile()
+        self.inherited = {}  # Method -> (handler, depth, indexed) of the deepest mount above
+        self.not_allowed = None  # 405 response when the whole path matched, or None
+        self.not_allowed_below = None  # and when the path went on past this node
+
+    def child(self, segment):
+        if segment.startswith('{') and segment.endswith('}'):
+            name = segment[1:-1]
+            if self.param is None:
+                self.param = Node()
+                self.param_name = name
+            elif self.param_name != name:
+                raise ValueError(f"Conflicting parameter names {{{self.param_name}}} and {segment}")
+            return self.param
+        return self.static_child(segment)
+
+    def static_child(self, segment):
+        node = self.children.get(segment)
+        if node is None:
+            node = self.children[segment] = Node()
+        return node
+
+def split_path(path):
+    """Splits a URL path, without its query string, into segments. '/' is
+    [''], and a trailing slash leaves an empty last segment."""
+    return path.partition('?')[0][1:].split('/')
+
+class Router:
+    """Maps a method and path onto a handler through a trie of path segments.
+
+    Routes are registered with add() and mount() and compiled once with
+    compile(); matching then walks one trie node per path segment, however
+    many routes there are. Static segments win over {name} parameters, and
+    there is no backtracking. Everything that does not match is answered
+    with a 404 or 405 response that was encoded in compile(), without
+    calling a handler or touching the disk.
+
+    A handler is called as handler(client_socket, request), with the
+    matched parameters in request.params. Mount handlers find the rest of
+    the path, from its '/', in request.params['path']. A handler either
+    sends its response itself or returns an iterable of bytes chunks, which
+    is streamed as a 200 text/plain response (see response.send_stream()).
+
+    A handler may also be a coroutine function. dispatch() then returns a
+    coroutine for the server to run: the asyncio server awaits it in its
+    loop, and the others run it with asyncio.run() in a thread.
+    """
+
+    def __init__(self):
+        self.root = Node()
+        self.indexes = []
+
+    def add(self, method, pattern, handler):
+        """Registers handler for pattern, e.g. '/users/{id}/files'."""
+        node = self.root
+        for segment in split_path(pattern):
+            node = node.child(segment)
+        node.handlers[method] = handler
+
+    def mount(self, prefix, handler, methods=('GET',), directory=None):
+        """Sends every path under prefix to handler.
+
+        If directory is given, the files in it are indexed by compile(), and
+        paths under prefix that are not in the index get a 404 without the
+        handler being called. Files added later are only found once the
+        router is compiled again.
+        """
+        node = self.root
+        for segment in split_path(prefix.rstrip('/') + '/')[:-1]:
+            node = node.child(segment)
+        for method in methods:
+            node.mounts[method] = (handler, directory is not None)
+        if directory is not None:
+            self.indexes.append((node, directory))
+
+    def compile(self):
+        """Indexes mounted directories and precomputes the inherited mounts
+        and 405 responses of every node."""
+        for node, directory in self.indexes:
+            index_directory(node, directory)
+        self.compile_node(self.root, {}, 0)
+
+    def compile_node(self, node, inherited, depth):
+        if node.mounts:
+            inherited = dict(inherited)
+            for method, (handler, indexed) in node.mounts.items():
+                inherited[method] = (handler, depth, indexed)
+        node.inherited = inherited
+        below = set(inherited)
+        here = below | set(node.handlers)
+        node.not_allowed = not_allowed(here)
+        node.not_allowed_below = not_allowed(below)
+        for child in node.children.values():
+            self.compile_node(child, inherited, depth + 1)
+        if node.param is not None:
+            self.compile_node(node.param, inherited, depth + 1)
+
+    def match(self, method, path):
+        """Returns (handler, params), or (None, prebuilt error response)."""
+        segments = split_path(path)
+        node = self.root
+        params = {}
+        matched = 0
+        for segment in segments:
+            if '%' in segment:
+                segment = urllib.parse.unquote(segment)
+            child = node.children.get(segment)
+            if child is None:
+                if node.param is None or not segment:
+                    break
+                params[node.param_name] = segment
+                child = node.param
+            node = child
+            matched += 1
+        whole = matched == len(segments)
+        if whole and method in node.handlers:
+            return node.handlers[method], params
+        mount = node.inherited.get(method)
+        if mount is not None:
+            handler, depth, indexed = mount
+            if not indexed or (whole and node.exists):
+                params['path'] = '/' + '/'.join(segments[depth:])
+                return handler, params
+            return None, NOT_FOUND
+        response = node.not_allowed if whole else node.not_allowed_below
+        return None, response or NOT_FOUND
+
+    def route(self, request):
+        """Returns match() for request, matching it only once: the servers
+        route a request when its head arrives, to pick its body consumer,
+        and dispatch() then reuses that."""
+        if request.route is None or request.route[0] is not self:
+            request.route = (self, *self.match(request.method, request.path))
+        return request.route[1:]
+
+    def dispatch(self, client_socket, request):
+        """Calls the request's handler; returns a coroutine that finishes
+        the response if the handler is a coroutine function, else None."""
+        handler, result = self.route(request)
+        if handler is None:
+            send_prebuilt(client_socket, request, result)
+            return None
+        request.params = result
+        chunks = handler(client_socket, request)
+        if inspect.iscoroutine(chunks):
+            return self.finish(client_socket, request, chunks)
+        send_chunks(client_socket, request, chunks)
+        return None
+
+    async def finish(self, client_socket, request, coroutine):
+        send_chunks(client_socket, request, await coroutine)
+
+def send_chunks(client_socket, request, chunks):
+    if chunks is not None:
+        send_stream(client_socket, request, 200, chunks)
+
+def blocking(handler):
+    """Marks handler as one that may block for long, on an upstream or on
+    reading back a large file. The event loop servers run it in a thread
+    rather than in the loop, where it would hold up every connection."""
+    handler.blocking = True
+    return handler
+
+def not_allowed(methods):
+    if not methods:
+        return None
+    allow = ', '.join(sorted(methods))
+    return PrebuiltResponse(405, f"Method not allowed. Allowed: {allow}.", headers=[('Allow', allow)])
+
+def index_directory(mount_node, directory):
+    """Adds a node for every file under directory below mount_node. A
+    directory with an index.html also exists with a trailing slash."""
+    for dirpath, _, filenames in os.walk(directory):
+        relative = os.path.relpath(dirpath, directory)
+        node = mount_node
+        if relative != '.':
+            for segment in relative.split(os.sep):
+                node = node.static_child(segment)
+        for filename in filenames:
+            node.static_child(filename).exists = True
+            if filename == 'index.html':
+                node.static_child('').exists = True
@@ -0,0 +1,81 @@
+"""Server settings shared by every module; main() overrides them from the command line."""
+
+# Keep-alive
+KEEP_ALIVE_TIMEOUT = 5.0  # Seconds an idle keep-alive connection is kept open
+MAX_REQUESTS_PER_CONNECTION = 100
+
+# Request limits
+MAX_HEADER_SIZE = 16384  # Bytes in the request line plus headers
+MAX_HEADER_COUNT = 100
+MAX_BODY_SIZE = 100 * 1024 * 1024
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024 * 1024  # Streamed multipart bodies are not held in memory
+BODY_SPOOL_SIZE = 1024 * 1024  # Larger bodies are received into a temporary file
+BODY_SPOOL_DIRECTORY = None  # Where those files go; None for the system's temporary directory
+
+# Admission control
+READ_TIMEOUT = 10.0  # Seconds a partly received request may go without new data
+HEADER_TIMEOUT = 10.0  # Seconds from the first byte of a request until its headers are in
+BODY_TIMEOUT = 600.0  # Seconds to receive a body once the headers are in
+WRITE_TIMEOUT = 60.0  # Seconds a response may wait for the client to take more of it
+MAX_CONNECTIONS = 10000  # Open connections per worker before new ones get a 503
+RATE_LIMIT = 0.0  # Requests per second per client IP; 0 turns the limit off
+RATE_LIMIT_BURST = 100  # Requests a client may make at once before RATE_LIMIT applies
+
+# Uploads
+UPLOADS_DIRECTORY = 'uploads'
+UPLOAD_CHUNK_SIZE = 65536  # Size of the writes to upload files
+UPLOAD_PREALLOCATE = True  # posix_fallocate() uploads up to the size of the rest of the body
+UPLOAD_FSYNC = 'file'  # 'none', 'file' (fsync before the rename) or 'full' (directories too)
+MAX_FORM_FIELD_SIZE = 65536  # Non-file parts are kept in memory
+MAX_FORM_PARTS = 1000
+
+# Resumable uploads
+RESUMABLE_PATH = ''  # Prefix of the resumable upload endpoints, such as '/files'; empty turns them off
+RESUMABLE_EXPIRY = 24 * 3600.0  # Seconds an unfinished upload is kept after it was last written to
+RESUMABLE_SWEEP_INTERVAL = 600.0  # Seconds between a worker's sweeps for the files of expired uploads
+
+# Static files
+STATIC_DIRECTORY = 'www'
+CACHE_CONTROL = 'public, max-age=3600'  # Sent with every static file; empty to leave it out
+STATIC_INDEX = True  # Index STATIC_DIRECTORY at startup so unknown paths never touch the disk
+FILE_CACHE_ENTRIES = 1024  # Static files kept open per worker; 0 turns the cache off
+FILE_CACHE_BYTES = 64 * 1024 * 1024  # Bytes of their contents kept in memory per worker
+FILE_CACHE_MEMORY_SIZE = 256 * 1024  # Files up to this size are read into memory and sent from there
+FILE_CACHE_REVALIDATE = 1.0  # Seconds before a cached file is checked for changes on disk
+
+# Reverse proxy
+PROXY_ROUTES = {}  # Path prefix -> list of 'host:port' upstreams; filled in from --proxy
+PROXY_POOL_SIZE = 32  # Idle keep-alive connections kept per upstream and worker
+PROXY_IDLE_TIMEOUT = 4.0  # Seconds an idle upstream connection is kept; keep it below the upstream's own
+PROXY_TIMEOUT = 30.0  # Seconds to connect to, write to or wait for an upstream
+PROXY_HEALTH_PATH = '/'  # GET by the health checks; empty to only check that a connection opens
+PROXY_HEALTH_INTERVAL = 2.0  # Seconds between health checks; 0 turns them off
+
+# Compression
+COMPRESSION_LEVEL = 6
+COMPRESSION_CACHE_SIZE = 32 * 1024 * 1024  # Bytes of compressed variants kept per worker
+MAX_COMPRESS_SIZE = 4 * 1024 * 1024  # Larger files are sent uncompressed unless a .gz exists
+
+# Metrics
+METRICS_PATH = '/metrics'  # Empty to turn the endpoint off
+
+# Admin endpoint
+ADMIN_PORT = 0  # Each worker serves /debug/profile on the first free 127.0.0.1 port from here; 0 turns it off
+PROFILE_MAX_SECONDS = 60.0
+PROFILE_INTERVAL = 0.005  # Default seconds between stack samples
+
+# Access log
+ACCESS_LOG = '-'  # File to append to, '-' for stdout, empty to turn it off
+ACCESS_LOG_BUFFER = 65536  # Records waiting for the writer before new ones are dropped
+LOG_BODY_SAMPLE_RATE = 0.0  # Fraction of requests whose body is logged, for debugging
+LOG_BODY_BYTES = 1024
+
+# Traffic capture
+CAPTURE_FILE = ''  # JSON lines file to append sampled requests to; empty turns capture off
+CAPTURE_SAMPLE_RATE = 1.0  # Fraction of requests captured
+CAPTURE_BODY_BYTES = 4096  # Larger bodies are captured as their size and SHA-256
+CAPTURE_BUFFER = 4096  # Records waiting for the writer before new ones are dropped
+CAPTURE_REDACT = ('authorization', 'proxy-authorization', 'cookie')  # Header values left out
+
+# eventloop backend
+OFFLOAD_THREADS = 32  # Threads per worker for blocking handlers, such as proxied requests
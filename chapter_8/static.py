@@ -0,0 +1,225 @@
+import email.utils
+import functools
+import mimetypes
+import os
+import secrets
+import urllib.parse
+
+import compression
+import filecache
+import framing
+import settings
+from response import MSG_MORE, head_parts, send_buffers, send_file, send_response
+
+# Text types are sent with an explicit charset
+CHARSET_TYPES = ('application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+
+# More ranges than this in one request are answered with the whole file
+MAX_RANGES = 16
+
+@functools.lru_cache(maxsize=4096)
+def resolve_path(url_path):
+    """Maps a URL path onto a file under STATIC_DIRECTORY, or None if the
+    path tries to escape it. Popular paths are resolved once."""
+    path = urllib.parse.unquote(url_path.partition('?')[0])
+    if path.endswith('/'):
+        path += 'index.html'  # Default file to serve
+    parts = [part for part in path.split('/') if part and part != '.']
+    if '..' in parts or any('\0' in part or '\\' in part for part in parts):
+        return None
+    return os.path.join(settings.STATIC_DIRECTORY, *parts)
+
+@functools.lru_cache(maxsize=4096)
+def content_type_for(filepath):
+    """Guesses the MIME type of a file from its extension."""
+    mime, _ = mimetypes.guess_type(filepath)
+    if mime is None:
+        return 'application/octet-stream'
+    if mime.startswith('text/') or mime in CHARSET_TYPES:
+        return f"{mime}; charset=utf-8"
+    return mime
+
+def make_etag(stat_result, encoding=None):
+    """Builds a strong validator from the file's inode, size and mtime.
+
+    Each content encoding is a different representation with its own ETag.
+    """
+    suffix = f"-{encoding}" if encoding else ''
+    return f'"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}{suffix}"'
+
+def validator_headers(stat_result, encoding=None, compressible=False):
+    """Headers that let clients and caches revalidate instead of re-downloading."""
+    headers = [
+        ('Accept-Ranges', 'bytes'),
+        ('ETag', make_etag(stat_result, encoding)),
+        ('Last-Modified', email.utils.formatdate(stat_result.st_mtime, usegmt=True)),
+    ]
+    if compressible:
+        headers.append(('Vary', 'Accept-Encoding'))
+    if encoding:
+        headers.append(('Content-Encoding', encoding))
+    if settings.CACHE_CONTROL:
+        headers.append(('Cache-Control', settings.CACHE_CONTROL))
+    return headers
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match list against etag."""
+    if if_none_match.strip() == '*':
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(','))
+    return any(tag.removeprefix('W/') == etag for tag in candidates)
+
+def is_not_modified(request, stat_result, encoding=None):
+    """True if the client's cached copy of the file is still current.
+
+    If-None-Match wins over If-Modified-Since when both are sent.
+    """
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        return etag_matches(if_none_match, make_etag(stat_result, encoding))
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(stat_result.st_mtime) <= since
+    return False
+
+def parse_range(range_header, size):
+    """Parses a Range header into a list of (start, end) byte offsets, end
+    exclusive.
+
+    Returns None if the header should be ignored (not bytes, malformed or
+    too many ranges), or an empty list if none of the ranges is satisfiable.
+    """
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    specs = spec.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, dash, last = spec.strip().partition('-')
+        start = framing.parse_digits(first) if first else None
+        last_byte = framing.parse_digits(last) if last else None
+        if not dash or (first and start is None) or (last and last_byte is None) or not (first or last):
+            return None
+        if start is None:
+            # Suffix range: the last N bytes
+            if last_byte:
+                ranges.append((max(0, size - last_byte), size))
+            continue
+        if last_byte is not None and last_byte < start:
+            return None
+        end = size if last_byte is None else min(last_byte + 1, size)
+        if start < size:
+            ranges.append((start, end))
+    return ranges
+
+def if_range_matches(request, stat_result):
+    """True if a Range request may be answered partially. If-Range needs a
+    strong match of the ETag or an exact match of the Last-Modified date."""
+    if_range = request.headers.get('if-range')
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):
+        return if_range == make_etag(stat_result)
+    return if_range == email.utils.formatdate(stat_result.st_mtime, usegmt=True)
+
+def send_ranges(client_socket, request, f, stat_result, content_type, headers, ranges):
+    """Sends a 206 for one range, or a multipart/byteranges body for several.
+
+    Every range goes out with sendfile() using its offset and count, and the
+    bytes in between (the CRLF ending one part and the head of the next)
+    with one sendmsg() each.
+    """
+    size = stat_result.st_size
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers.append(('Content-Range', f"bytes {start}-{end - 1}/{size}"))
+        send_file(client_socket, request, 206, content_type, f, start, end - start, headers)
+        return
+    boundary = secrets.token_hex(16)
+    part_heads = [(f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+                   f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n").encode('latin1')
+                  for start, end in ranges]
+    closing = f"--{boundary}--\r\n".encode('latin1')
+    content_length = (sum(len(head) + end - start + 2 for head, (start, end) in zip(part_heads, ranges))
+                      + len(closing))
+    buffers = head_parts(request, 206, f"multipart/byteranges; boundary={boundary}", content_length, headers)
+    for head, (start, end) in zip(part_heads, ranges):
+        buffers.append(head)
+        send_buffers(client_socket, buffers, MSG_MORE)
+        client_socket.sendfile(f, start, end - start)
+        buffers = [b"\r\n"]
+    send_buffers(client_socket, buffers + [closing])
+
+def choose_encoding(request, entry, content_type):
+    """Picks the content encoding for a response.
+
+    Returns (encoding, precompressed) where precompressed is the cache
+    entry of a .gz sibling to send instead of the file, or None to compress
+    from the compression cache. Range requests are always answered from the
+    uncompressed file.
+    """
+    if not compression.is_compressible(content_type) or 'range' in request.headers:
+        return None, None
+    encoding = compression.negotiate(request.headers.get('accept-encoding', ''))
+    if encoding == 'gzip':
+        precompressed = filecache.precompressed(entry)
+        if precompressed is not None:
+            return encoding, precompressed
+    if encoding is None or entry.stat.st_size > settings.MAX_COMPRESS_SIZE:
+        return None, None
+    return encoding, None
+
+def serve_file(client_socket, request, filepath):
+    """Sends a static file, the requested byte ranges of it, or 304 if the
+    client already has it. Compressible files are sent gzip- or
+    deflate-encoded when the client accepts it. The file comes from the
+    filecache, so a popular one is neither opened nor stat()ed again."""
+    entry = filecache.get(filepath)
+    if entry is None:
+        send_response(client_socket, request, 404, "File not found.")
+        return
+    try:
+        stat_result = entry.stat
+        content_type = content_type_for(filepath)
+        encoding, precompressed = choose_encoding(request, entry, content_type)
+        headers = validator_headers(stat_result, encoding, compression.is_compressible(content_type))
+        if is_not_modified(request, stat_result, encoding):
+            send_buffers(client_socket, head_parts(request, 304, headers=headers))
+        elif precompressed is not None:
+            send_whole(client_socket, request, precompressed, content_type, headers)
+        elif encoding is not None:
+            body = compression.compressed_content(filepath, entry.file, stat_result, encoding)
+            send_buffers(client_socket, head_parts(request, 200, content_type, len(body), headers) + [body])
+        else:
+            send_identity(client_socket, request, entry, content_type, headers)
+    finally:
+        filecache.release(entry)
+
+def send_whole(client_socket, request, entry, content_type, headers):
+    """Sends a whole file with a 200: one in memory together with the head in
+    one sendmsg(), any other one with sendfile()."""
+    if entry.data is not None:
+        send_buffers(client_socket, head_parts(request, 200, content_type, len(entry.data), headers) + [entry.data])
+    else:
+        send_file(client_socket, request, 200, content_type, entry.file, 0, entry.stat.st_size, headers)
+
+def send_identity(client_socket, request, entry, content_type, headers):
+    """Sends the file as it is on disk, or the byte ranges asked for."""
+    stat_result = entry.stat
+    range_header = request.headers.get('range')
+    if range_header and if_range_matches(request, stat_result):
+        ranges = parse_range(range_header, stat_result.st_size)
+        if ranges == []:
+            headers.append(('Content-Range', f"bytes */{stat_result.st_size}"))
+            send_response(client_socket, request, 416, "Range not satisfiable.", headers=headers)
+            return
+        if ranges:
+            send_ranges(client_socket, request, entry.file, stat_result, content_type, headers, ranges)
+            return
+    send_whole(client_socket, request, entry, content_type, headers)
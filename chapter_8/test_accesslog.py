@@ -0,0 +1,98 @@
+import json
+import os
+
+import pytest
+
+import accesslog
+import framing
+import main
+import settings
+from test_main import serve_one
+
+@pytest.fixture
+def log_file(tmp_path):
+    path = tmp_path / 'access.log'
+    fd = accesslog.open_output(str(path))
+    yield path, fd
+
+def lines(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+def test_records_are_written_in_batches(log_file, monkeypatch):
+    monkeypatch.setattr(accesslog, 'BATCH_SIZE', 3)
+    path, fd = log_file
+    log = accesslog.AccessLog(fd, 100, lambda record: json.dumps({'n': record}))
+    writes = []
+    write = log.write
+    monkeypatch.setattr(log, 'write', lambda batch: (writes.append(len(batch)), write(batch)))
+    for n in range(7):
+        assert log.append(n)
+    log.flush()
+    os.close(fd)
+    assert writes == [3, 3, 1]
+    assert [record['n'] for record in lines(path)] == list(range(7))
+
+def test_full_queue_drops_and_reports_it(log_file):
+    path, fd = log_file
+    log = accesslog.AccessLog(fd, 2, lambda record: json.dumps({'n': record}))
+    assert [log.append(n) for n in range(5)] == [True, True, False, False, False]
+    log.flush()
+    log.flush()  # Drops are reported once
+    os.close(fd)
+    records = lines(path)
+    assert records[:2] == [{'n': 0}, {'n': 1}]
+    assert len(records) == 3 and records[2]['dropped'] == 3
+
+def test_failed_write_counts_the_records_as_dropped(log_file, capsys):
+    path, fd = log_file
+    log = accesslog.AccessLog(fd, 10, str)
+    os.close(fd)
+    log.append(1)
+    log.flush()
+    assert log.dropped == log.reported_drops == 1
+    assert 'write failed' in capsys.readouterr().err
+
+@pytest.mark.parametrize('body, logged', [
+    (None, None),
+    (b'a=\xff', 'a=�'),
+    ({'fields': {'a': '1'}}, '{"fields": {"a": "1"}}'),
+])
+def test_format_record(body, logged):
+    entry = json.loads(accesslog.format_record((0.0, ('10.0.0.1', 1234), 'GET', '/a', 200, 5, 0.0012345, body)))
+    assert entry['time'] == '1970-01-01T00:00:00.000+00:00' and entry['client'] == '10.0.0.1'
+    assert (entry['status'], entry['bytes'], entry['ms']) == (200, 5, 1.234)
+    assert entry.get('body') == logged
+
+def test_format_record_without_a_client_or_with_a_large_body(monkeypatch):
+    monkeypatch.setattr(settings, 'LOG_BODY_BYTES', 10)
+    entry = json.loads(accesslog.format_record((0.0, None, 'POST', '/', 200, 0, 0.0, {'a': 'x' * 100})))
+    assert entry['client'] is None and entry['body'] == '{"a": "xxx'
+
+def test_sample_body(monkeypatch):
+    request = framing.Request('POST', '/', 'HTTP/1.1', {}, b'x' * 5000)
+    monkeypatch.setattr(settings, 'LOG_BODY_SAMPLE_RATE', 0.0)
+    accesslog.sample_body(request)
+    assert request.body_sample is None
+    monkeypatch.setattr(settings, 'LOG_BODY_SAMPLE_RATE', 1.0)
+    accesslog.sample_body(request)
+    assert request.body_sample == b'x' * settings.LOG_BODY_BYTES
+    accesslog.sample_body(request, memoryview(b'y' * 5000))
+    assert request.body_sample == b'y' * settings.LOG_BODY_BYTES
+
+def test_served_requests_are_logged(tmp_path, monkeypatch):
+    path = tmp_path / 'access.log'
+    monkeypatch.setattr(settings, 'ACCESS_LOG', str(path))
+    monkeypatch.setattr(settings, 'LOG_BODY_SAMPLE_RATE', 1.0)
+    monkeypatch.setattr(settings, 'STATIC_INDEX', False)
+    monkeypatch.setattr(main, 'routes', main.build_routes())
+    accesslog.start()
+    try:
+        serve_one(b"GET /missing HTTP/1.1\r\n\r\n"
+                  b"POST /form HTTP/1.1\r\nContent-Type: application/x-www-form-urlencoded\r\n"
+                  b"Content-Length: 3\r\nConnection: close\r\n\r\na=1", main.dispatch_request)
+    finally:
+        accesslog.stop()
+    records = lines(path)
+    assert [(r['method'], r['path'], r['status']) for r in records] == [('GET', '/missing', 404), ('POST', '/form', 200)]
+    assert records[0]['client'] == '127.0.0.1' and records[1]['body'] == '{"a": "1"}'
+    assert accesslog.access_log is None
@@ -0,0 +1,170 @@
+import socket
+import time
+
+import pytest
+
+import admission
+import aioserver
+import eventloop
+import settings
+import static
+import test_aioserver
+import test_eventloop
+from test_eventloop import exchange
+from response import send_response
+from test_main import hello, serve_one
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, 'monotonic', clock)
+    return clock
+
+def test_burst_then_rate(clock):
+    limiter = admission.RateLimiter(rate=2.0, burst=3)
+    assert [limiter.allow('a') for _ in range(4)] == [True, True, True, False]
+    assert limiter.allow('b')  # Every client has a bucket of its own
+    clock.now += 0.25
+    assert not limiter.allow('a')
+    clock.now += 0.25
+    assert limiter.allow('a') and not limiter.allow('a')
+    clock.now += 60
+    assert [limiter.allow('a') for _ in range(4)] == [True, True, True, False]  # No more than burst saved up
+
+def test_quiet_clients_are_forgotten(clock):
+    limiter = admission.RateLimiter(rate=1.0, burst=5)
+    limiter.allow('a')
+    clock.now += admission.PRUNE_INTERVAL - 2
+    limiter.allow('b')
+    clock.now += 2  # a's bucket has been full for a while, b's is still filling up
+    limiter.allow('c')
+    assert set(limiter.buckets) == {'b', 'c'}
+
+def test_rate_limit_is_off_by_default(monkeypatch):
+    monkeypatch.setattr(admission, 'limiter', None)
+    monkeypatch.setattr(settings, 'RATE_LIMIT', 0.0)
+    assert all(admission.allow_request(('10.0.0.1', 1)) for _ in range(1000))
+    monkeypatch.setattr(settings, 'RATE_LIMIT', 1.0)
+    monkeypatch.setattr(settings, 'RATE_LIMIT_BURST', 1)
+    assert admission.allow_request(None)  # Unix sockets and the like have no address to limit
+    assert admission.allow_request(('10.0.0.1', 1)) and not admission.allow_request(('10.0.0.1', 2))
+
+def test_over_the_rate_limit_gets_429(monkeypatch):
+    monkeypatch.setattr(admission, 'limiter', None)
+    monkeypatch.setattr(settings, 'RATE_LIMIT', 0.01)
+    monkeypatch.setattr(settings, 'RATE_LIMIT_BURST', 2)
+    with test_eventloop.running() as port:
+        received = exchange(port, b"GET /a HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\n\r\nGET /c HTTP/1.1\r\n\r\n")
+    assert received.count(b"HTTP/1.1 200 OK") == 2
+    assert b"HTTP/1.1 429 Too Many Requests" in received and b"Hello /c" not in received
+
+@pytest.mark.parametrize('running', [test_eventloop.running, lambda: test_aioserver.running(test_aioserver.hello)])
+def test_connections_over_the_cap_get_503(running, monkeypatch):
+    monkeypatch.setattr(settings, 'MAX_CONNECTIONS', 1)
+    with running() as port:
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as first:
+            first.sendall(b"GET /first HTTP/1.1\r\n\r\n")
+            assert b"Hello /first" in first.recv(65536)  # Open, and counted
+            # Turned away before anything is read; a request sent meanwhile would make the close a reset
+            assert exchange(port, b"").startswith(b"HTTP/1.1 503")
+        time.sleep(0.2)  # Until the server sees the first one close
+        assert b"Hello /third" in exchange(port, b"GET /third HTTP/1.1\r\nConnection: close\r\n\r\n")
+
+def trickle(port, data, interval):
+    """Sends data a byte at a time; returns what comes back."""
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        try:
+            for byte in data:
+                sock.sendall(bytes([byte]))
+                time.sleep(interval)
+        except OSError:
+            pass  # Hung up on
+        received = b''
+        while chunk := sock.recv(65536):
+            received += chunk
+        return received
+
+def test_trickled_head_times_out_with_408(monkeypatch):
+    monkeypatch.setattr(settings, 'READ_TIMEOUT', 1.0)
+    monkeypatch.setattr(settings, 'HEADER_TIMEOUT', 0.3)
+    monkeypatch.setattr(eventloop, 'SWEEP_INTERVAL', 0.05)
+    with test_eventloop.running() as port:
+        started = time.monotonic()
+        received = trickle(port, b"GET / HTTP/1.1\r\nX-Slow: " + b"a" * 1000 + b"\r\n\r\n", 0.02)
+    assert received.startswith(b"HTTP/1.1 408") and time.monotonic() - started < 5
+
+def test_stalled_body_times_out_with_408(monkeypatch):
+    monkeypatch.setattr(settings, 'READ_TIMEOUT', 0.3)
+    monkeypatch.setattr(eventloop, 'SWEEP_INTERVAL', 0.05)
+    with test_eventloop.running() as port:
+        received = exchange(port, b"POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\nabc")
+    assert received.startswith(b"HTTP/1.1 408")
+
+def test_blocking_server_times_out_a_partial_request(monkeypatch):
+    monkeypatch.setattr(settings, 'HEADER_TIMEOUT', 0.3)
+    assert serve_one(b"GET / HTTP/1.1\r\nHost:", hello).startswith(b"HTTP/1.1 408")
+
+def test_idle_keep_alive_connection_is_closed_without_a_response(monkeypatch):
+    monkeypatch.setattr(settings, 'KEEP_ALIVE_TIMEOUT', 0.3)
+    monkeypatch.setattr(eventloop, 'SWEEP_INTERVAL', 0.05)
+    with test_eventloop.running() as port:
+        assert exchange(port, b"") == b""
+
+BIG = 8 * 1024 * 1024  # Far more than the socket buffers hold
+
+def big_response(path):
+    def dispatch(client_socket, request):
+        if request.path == '/file':
+            static.serve_file(client_socket, request, str(path))
+        else:
+            send_response(client_socket, request, 200, b'm' * BIG)
+    return dispatch
+
+def serving(server, dispatch):
+    if server == 'eventloop':
+        return test_eventloop.running(dispatch=dispatch)
+    return test_aioserver.running(dispatch)
+
+@pytest.fixture
+def write_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'WRITE_TIMEOUT', 0.5)
+    monkeypatch.setattr(eventloop, 'SWEEP_INTERVAL', 0.05)
+    monkeypatch.setattr(aioserver, 'SWEEP_INTERVAL', 0.05)
+    path = tmp_path / 'big.bin'
+    path.write_bytes(b'f' * BIG)
+    return big_response(path)
+
+@pytest.mark.parametrize('server', ['eventloop', 'aioserver'])
+@pytest.mark.parametrize('target', [b'/memory', b'/file'])
+def test_client_that_stops_reading_is_dropped(write_timeout, server, target):
+    with serving(server, write_timeout) as port:
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+            sock.sendall(b"GET " + target + b" HTTP/1.1\r\n\r\n")
+            time.sleep(1.5)  # Takes nothing for longer than WRITE_TIMEOUT
+            received = 0
+            try:
+                while chunk := sock.recv(65536):
+                    received += len(chunk)
+            except ConnectionResetError:
+                pass
+    assert received < BIG
+
+@pytest.mark.parametrize('server', ['eventloop', 'aioserver'])
+@pytest.mark.parametrize('target', [b'/memory', b'/file'])
+def test_client_that_reads_slowly_gets_everything(write_timeout, server, target):
+    with serving(server, write_timeout) as port:
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+            sock.sendall(b"GET " + target + b" HTTP/1.1\r\nConnection: close\r\n\r\n")
+            started = time.monotonic()
+            received = 0
+            while chunk := sock.recv(65536):
+                received += len(chunk)
+                time.sleep(0.01)  # Keeps taking some, never all at once
+    assert received > BIG and time.monotonic() - started > settings.WRITE_TIMEOUT
@@ -0,0 +1,208 @@
+import asyncio
+import contextlib
+import socket
+import threading
+import time
+
+import pytest
+
+import aioserver
+import framing
+import main
+import router
+import settings
+import static
+import test_eventloop
+import test_main
+from response import send_response
+from test_eventloop import exchange
+
+@contextlib.contextmanager
+def running(dispatch, consumer_for=None):
+    """The asyncio server serving dispatch on a loopback port, in a thread."""
+    server_socket = socket.create_server(('127.0.0.1', 0))
+    stop = threading.Event()
+    thread = threading.Thread(target=aioserver.serve, args=(server_socket, dispatch, stop, consumer_for),
+                              name='aioserver')
+    thread.start()
+    try:
+        yield server_socket.getsockname()[1]
+    finally:
+        stop.set()
+        thread.join(5)
+        assert not thread.is_alive()
+
+def hello(client_socket, request):
+    send_response(client_socket, request, 200, f"Hello {request.path}")
+
+async def sleepy(client_socket, request):
+    await asyncio.sleep(0.5)
+    send_response(client_socket, request, 200, f"Slept in {threading.current_thread().name}")
+
+async def counting(client_socket, request):
+    await asyncio.sleep(0)
+    return (str(n).encode() for n in range(3))
+
+async def failing(client_socket, request):
+    await asyncio.sleep(0)
+    raise ValueError("coroutine handler failed")
+
+@pytest.fixture
+def routes():
+    routes = router.Router()
+    routes.add('GET', '/hello', hello)
+    routes.add('GET', '/sleepy', sleepy)
+    routes.add('GET', '/counting', counting)
+    routes.add('GET', '/failing', failing)
+    routes.compile()
+    return routes
+
+def get(port, path):
+    return exchange(port, f"GET {path} HTTP/1.1\r\nConnection: close\r\n\r\n".encode())
+
+def test_coroutine_route_handlers_are_awaited_in_the_loop(routes):
+    with running(routes.dispatch) as port:
+        assert b"Hello /hello" in get(port, '/hello')
+        received = get(port, '/sleepy')
+        assert received.startswith(b"HTTP/1.1 200") and b"Slept in aioserver" in received  # Not an executor's
+        assert received_body(get(port, '/counting')) == b"012"
+        assert get(port, '/failing').startswith(b"HTTP/1.1 500")
+
+def test_only_blocking_handlers_run_in_the_executor():
+    def where(client_socket, request):
+        send_response(client_socket, request, 200, threading.current_thread().name)
+    def route(request):  # As main.body_consumer() does once the head is in
+        request.blocking = request.path == '/blocking'
+        return None
+    with running(where, route) as port:
+        large = exchange(port, b"GET /plain HTTP/1.1\r\nContent-Length: 200000\r\nConnection: close\r\n\r\n"
+                               + b"b" * 200_000)
+        assert large.endswith(b"\r\n\r\naioserver")  # A large body alone is no reason to leave the loop
+        assert not get(port, '/blocking').endswith(b"\r\n\r\naioserver")
+
+def test_coroutine_route_handlers_wait_concurrently(routes):
+    with running(routes.dispatch) as port:
+        started = time.monotonic()
+        threads = [threading.Thread(target=get, args=(port, '/sleepy')) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert time.monotonic() - started < 2.0
+
+def test_coroutine_route_handlers_under_the_eventloop_server(routes):
+    with test_eventloop.running(dispatch=routes.dispatch) as port:
+        assert b"Slept in offload" in get(port, '/sleepy')
+        assert received_body(get(port, '/counting')) == b"012"
+        assert get(port, '/failing').startswith(b"HTTP/1.1 500")
+        assert b"Hello /hello" in get(port, '/hello')
+
+def test_coroutine_route_handlers_under_the_blocking_server(routes, monkeypatch):
+    monkeypatch.setattr(main, 'routes', routes)  # main.body_consumer() routes with it
+    received = test_main.serve_one(b"GET /counting HTTP/1.1\r\nConnection: close\r\n\r\n", routes.dispatch)
+    assert received_body(received) == b"012"
+
+def test_dispatch_returns_the_coroutine(routes):
+    class Sink:
+        def __init__(self):
+            self.data = b''
+
+        def sendall(self, data, flags=0):
+            self.data += bytes(data)
+
+        def sendmsg(self, buffers, ancdata=(), flags=0):
+            for data in buffers:
+                self.sendall(data)
+            return sum(map(len, buffers))
+
+    request = framing.Request('GET', '/counting', 'HTTP/1.1', {}, b'')
+    sink = Sink()
+    pending = routes.dispatch(sink, request)
+    assert asyncio.iscoroutine(pending) and sink.data == b''
+    asyncio.run(pending)
+    assert received_body(sink.data) == b"012"
+    assert routes.dispatch(sink, framing.Request('GET', '/hello', 'HTTP/1.1', {}, b'')) is None
+
+def received_body(received):
+    """The body of a chunked response."""
+    body, rest = b'', received.partition(b"\r\n\r\n")[2]
+    while True:
+        size, _, rest = rest.partition(b"\r\n")
+        size = int(size, 16)
+        if not size:
+            return body
+        body, rest = body + rest[:size], rest[size + 2:]
+
+def test_pipelined_requests_are_answered_in_order():
+    with running(hello) as port:
+        received = exchange(port, b"GET /a HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\n\r\nGET /c HTTP/1.1\r\nConnection: close\r\n\r\n")
+    assert received.count(b"HTTP/1.1 200 OK") == 3
+    assert received.index(b"Hello /a") < received.index(b"Hello /b") < received.index(b"Hello /c")
+
+@pytest.mark.parametrize('data, status', [
+    (b"BROKEN\r\n\r\n", b"400"),
+    (b"POST / HTTP/1.1\r\nContent-Length: abc\r\n\r\n", b"400"),
+    (b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n", b"400"),
+])
+def test_malformed_requests_get_an_error_and_close(data, status):
+    with running(hello) as port:
+        assert exchange(port, data).startswith(b"HTTP/1.1 " + status)
+
+class Recorder:
+    """A body consumer that takes its time over every piece."""
+
+    def __init__(self, fail_at=None):
+        self.pieces = []
+        self.threads = set()
+        self.closed = False
+        self.fail_at = fail_at
+
+    def feed(self, data):
+        self.threads.add(threading.current_thread().name)
+        time.sleep(0.001)
+        self.pieces.append(bytes(data))
+        if self.fail_at is not None and sum(map(len, self.pieces)) >= self.fail_at:
+            raise ValueError("disk full")
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        pass
+
+def test_body_consumer_is_fed_in_order_off_the_loop():
+    recorder = Recorder()
+    def dispatch(client_socket, request):
+        assert request.body_consumer is recorder and recorder.closed
+        send_response(client_socket, request, 200, str(sum(map(len, recorder.pieces))))
+    body = b''.join(b"%x\r\n%s\r\n" % (n, bytes([n % 256]) * n) for n in range(1, 200)) + b"0\r\n\r\n"
+    with running(dispatch, lambda request: recorder) as port:
+        received = exchange(port, b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n" + body)
+    assert received.startswith(b"HTTP/1.1 200") and received.endswith(str(199 * 200 // 2).encode())
+    assert b''.join(recorder.pieces) == b''.join(bytes([n % 256]) * n for n in range(1, 200))
+    assert 'aioserver' not in recorder.threads
+
+def test_failing_body_consumer_gets_500():
+    with running(hello, lambda request: Recorder(fail_at=1)) as port:
+        received = exchange(port, b"POST / HTTP/1.1\r\nContent-Length: 100000\r\n\r\n" + b"x" * 100_000)
+    assert received.startswith(b"HTTP/1.1 500")
+
+def test_cached_file_rewritten_in_place(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'FILE_CACHE_REVALIDATE', 60.0)
+    path = tmp_path / 'small.txt'
+    path.write_bytes(b'a' * 1000)
+    def dispatch(client_socket, request):
+        static.serve_file(client_socket, request, str(path))
+    with running(dispatch) as port:
+        assert exchange(port, b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n").endswith(b'a' * 1000)
+        path.write_bytes(b'b')  # Truncated in place, not renamed over
+        assert exchange(port, b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n").endswith(b'a' * 1000)
+
+def test_static_files_go_out_with_sendfile(tmp_path):
+    path = tmp_path / 'large.bin'
+    path.write_bytes(bytes(range(256)) * 4096)
+    def dispatch(client_socket, request):
+        static.serve_file(client_socket, request, str(path))
+    with running(dispatch) as port:
+        received = exchange(port, b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n")
+    assert received.partition(b"\r\n\r\n")[2] == path.read_bytes()
@@ -0,0 +1,81 @@
+import asyncio
+import os
+
+import pytest
+
+import bench
+from test_eventloop import running
+
+def read(data):
+    """Runs bench.read_response() over data followed by the end of the stream."""
+    async def read_from_stream():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await bench.read_response(reader), await reader.read()
+    return asyncio.run(read_from_stream())
+
+@pytest.mark.parametrize('data, status, reusable', [
+    (b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello", 200, True),
+    (b"HTTP/1.1 200 OK\r\nconnection: Close\r\ncontent-length: 0\r\n\r\n", 200, False),
+    (b"HTTP/1.0 200 OK\r\nContent-Length: 0\r\n\r\n", 200, False),
+    (b"HTTP/1.0 200 OK\r\nConnection: keep-alive\r\nContent-Length: 0\r\n\r\n", 200, True),
+    (b"HTTP/1.1 404 Not Found\r\nTransfer-Encoding: chunked\r\n\r\n3;x=y\r\nabc\r\n0\r\nX-Sum: 1\r\n\r\n", 404, True),
+    (b"HTTP/1.0 200 OK\n\nuntil close", 200, False),
+])
+def test_read_response(data, status, reusable):
+    assert read(data) == ((status, len(data), reusable), b'')
+
+def test_read_response_leaves_the_next_response_alone():
+    first = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+    assert read(first + b"HTTP/1.1 204 No Content\r\n\r\n") == ((200, len(first), True), b"HTTP/1.1 204 No Content\r\n\r\n")
+
+@pytest.mark.parametrize('data, error', [
+    (b"", ConnectionError),
+    (b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nshort", asyncio.IncompleteReadError),
+    (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nab", asyncio.IncompleteReadError),
+    (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n", ConnectionError),
+    (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n", ValueError),
+    (b"HTTP/1.1 200 OK\r\nContent-Length: many\r\n\r\n", ValueError),
+    (b"garbage\r\n\r\n", IndexError),
+])
+def test_truncated_or_malformed_responses(data, error):
+    with pytest.raises(error):
+        read(data)
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert bench.percentile([], 0.5) is None
+    assert bench.percentile([7], 0.999) == 7
+    assert bench.percentile(values, 0.50) == 51
+    assert bench.percentile(values, 0.99) == 100
+    assert bench.percentile(values, 1.0) == 100
+
+def result(requests_per_sec, p99, target='t', scenario='s'):
+    return {'target': target, 'scenario': scenario, 'requests_per_sec': requests_per_sec,
+            'latency_ms': {'p99': p99}}
+
+def test_find_regressions():
+    baseline = {'results': [result(1000, 10.0), result(1000, 10.0, scenario='other')]}
+    assert bench.find_regressions(baseline, [result(950, 10.9), result(5, None, target='new')], 0.1) == []
+    assert bench.find_regressions(baseline, [result(899, 11.1)], 0.1) == [
+        "t/s: 1000 -> 899 req/s", "t/s: p99 10.0 -> 11.1 ms"]
+
+def test_requests_are_framed_consistently():
+    for name, request in bench.build_requests(True).items():
+        head, _, body = request.partition(b"\r\n\r\n")
+        assert b"Connection: keep-alive" in head
+        if b"Content-Length" in head:
+            assert int(head.rpartition(b"Content-Length: ")[2]) == len(body)
+        else:
+            assert body == b''
+    assert b"Connection: close" in bench.build_requests(False)['tiny_get']
+
+def test_drive_a_server():
+    with running() as port:
+        stats, elapsed = asyncio.run(bench.drive(port, os.getpid(), bench.build_requests(True)['tiny_get'],
+                                                 4, 0.3, True, 5.0))
+    summary = bench.summarize('t', 'tiny_get', stats, elapsed)
+    assert summary['requests'] > 0 and summary['errors'] == 0
+    assert summary['latency_ms']['p50'] <= summary['latency_ms']['p999']
+    assert summary['peak_rss_kb'] > 0
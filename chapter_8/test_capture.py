@@ -0,0 +1,95 @@
+import base64
+import hashlib
+import json
+import os
+
+import pytest
+
+import capture
+import framing
+import main
+import replay
+import settings
+from test_main import serve_one
+
+@pytest.fixture
+def capture_file(tmp_path, monkeypatch):
+    path = tmp_path / 'captured.jsonl'
+    monkeypatch.setattr(settings, 'CAPTURE_FILE', str(path))
+    monkeypatch.setattr(settings, 'CAPTURE_BODY_BYTES', 100)
+    monkeypatch.setattr(settings, 'BODY_SPOOL_SIZE', 1000)
+    monkeypatch.setattr(settings, 'UPLOADS_DIRECTORY', str(tmp_path / 'uploads'))
+    monkeypatch.setattr(settings, 'UPLOAD_FSYNC', 'none')
+    monkeypatch.setattr(settings, 'STATIC_INDEX', False)
+    monkeypatch.setattr(main, 'routes', main.build_routes())
+    return path
+
+def captured(path, data):
+    """Serves data with capture on; returns the captured records."""
+    capture.start()
+    try:
+        serve_one(data, main.dispatch_request)
+    finally:
+        capture.stop()
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+def post(body, headers=b"Content-Type: application/x-www-form-urlencoded\r\n"):
+    return b"POST /form HTTP/1.1\r\n" + headers + b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body
+
+def test_small_body_is_kept_whole_and_secrets_are_redacted(capture_file):
+    [record] = captured(capture_file, post(b"a=1", b"Cookie: session=secret\r\nX-Trace: 7\r\n"))
+    assert (record['method'], record['path'], record['version'], record['status']) == ('POST', '/form', 'HTTP/1.1', 200)
+    assert base64.b64decode(record['body']) == b"a=1"
+    assert record['headers']['cookie'] == capture.REDACTED and record['headers']['x-trace'] == '7'
+    assert record['bytes'] > 0 and record['ms'] >= 0
+
+@pytest.mark.parametrize('size', [101, 5000])  # Held in memory, and spooled to a file
+def test_large_body_is_kept_as_its_size_and_digest(capture_file, size):
+    body = os.urandom(size)
+    [record] = captured(capture_file, post(body, b""))
+    assert 'body' not in record
+    assert (record['body_size'], record['body_sha256']) == (size, hashlib.sha256(body).hexdigest())
+
+def test_multipart_upload_is_kept_as_its_form(capture_file):
+    data = os.urandom(3000)
+    body = (b'--B\r\nContent-Disposition: form-data; name="title"\r\n\r\nHello\r\n'
+            b'--B\r\nContent-Disposition: form-data; name="file"; filename="f.bin"\r\n\r\n' + data + b'\r\n--B--\r\n')
+    [record] = captured(capture_file, post(body, b"Content-Type: multipart/form-data; boundary=B\r\n"))
+    assert record['body_size'] == len(body)
+    assert record['form'] == {'fields': {'title': 'Hello'}, 'files': [
+        {'name': 'file', 'filename': 'f.bin', 'size': 3000, 'sha256': hashlib.sha256(data).hexdigest()}]}
+
+def test_capture_replays(capture_file):
+    records = captured(capture_file, b"GET /missing HTTP/1.1\r\n\r\n" + post(b"x" * 500, b""))
+    first, second = replay.load(capture_file)
+    assert (first.method, first.status, second.method, second.status) == ('GET', 404, 'POST', 200)
+    head, length, pieces = second.encode()
+    assert length == 500 and sum(map(len, pieces)) == 500 and records[1]['time'] >= records[0]['time']
+
+def test_sampling(capture_file, monkeypatch):
+    monkeypatch.setattr(settings, 'CAPTURE_SAMPLE_RATE', 0.0)
+    assert captured(capture_file, b"GET /a HTTP/1.1\r\nConnection: close\r\n\r\n") == []
+
+def test_off_without_a_file(monkeypatch):
+    monkeypatch.setattr(settings, 'CAPTURE_FILE', '')
+    capture.start()
+    assert capture.capture_log is None
+    capture.record(framing.Request('GET', '/', 'HTTP/1.1', {}, b''))  # Does nothing
+
+def test_dropped_record_closes_the_spool_descriptor(tmp_path, monkeypatch):
+    monkeypatch.setattr(capture, 'capture_log', capture.accesslog.AccessLog(-1, 0, capture.format_record))
+    request = framing.Request('POST', '/', 'HTTP/1.1', {}, b'')
+    request.started_at = capture.metrics.now()
+    with open(tmp_path / 'spool', 'w+b') as request.body_file:
+        before = len(os.listdir('/proc/self/fd'))
+        capture.record(request)
+        assert len(os.listdir('/proc/self/fd')) == before
+    assert capture.capture_log.dropped == 1
+
+def test_hash_file_closes_the_descriptor(tmp_path):
+    path = tmp_path / 'data'
+    path.write_bytes(b'x' * (capture.HASH_CHUNK_SIZE + 1))
+    fd = os.open(path, os.O_RDONLY)
+    assert capture.hash_file(fd) == (capture.HASH_CHUNK_SIZE + 1, hashlib.sha256(path.read_bytes()).hexdigest())
+    with pytest.raises(OSError):
+        os.fstat(fd)
@@ -0,0 +1,100 @@
+import gzip
+import os
+import zlib
+
+import pytest
+
+import compression
+import settings
+from test_static import get
+
+@pytest.mark.parametrize('accept_encoding, encoding', [
+    ('gzip', 'gzip'),
+    ('deflate', 'deflate'),
+    ('deflate, gzip', 'gzip'),
+    ('gzip;q=0.5, deflate', 'deflate'),
+    ('GZIP', 'gzip'),
+    ('*', 'gzip'),
+    ('*;q=0, deflate;q=0.1', 'deflate'),
+    ('gzip;q=0', None),
+    ('gzip;q=abc', None),
+    ('br, identity', None),
+    ('', None),
+])
+def test_negotiate(accept_encoding, encoding):
+    assert compression.negotiate(accept_encoding) == encoding
+
+@pytest.mark.parametrize('content_type, compressible', [
+    ('text/html; charset=utf-8', True), ('application/json', True), ('image/svg+xml', True),
+    ('image/png', False), ('application/octet-stream', False),
+])
+def test_is_compressible(content_type, compressible):
+    assert compression.is_compressible(content_type) == compressible
+
+def test_compress_round_trips():
+    data = b'hello ' * 1000
+    assert gzip.decompress(compression.compress(data, 'gzip')) == data
+    assert zlib.decompress(compression.compress(data, 'deflate')) == data
+
+def test_cache_evicts_least_recently_used():
+    cache = compression.CompressionCache(10)
+    cache.put('a', b'aaaa')
+    cache.put('b', b'bbbb')
+    assert cache.get('a') == b'aaaa'
+    cache.put('c', b'cccc')
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (b'aaaa', None, b'cccc')
+    cache.put('c', b'cc')
+    assert cache.size == 6
+    cache.put('huge', b'x' * 11)
+    assert cache.get('huge') is None and cache.size == 6
+
+@pytest.fixture
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(compression, 'cache', None)
+
+def test_compressed_content_is_cached(tmp_path, fresh_cache):
+    path = tmp_path / 'page.html'
+    path.write_bytes(b'<p>hello</p>' * 100)
+    with open(path, 'rb') as f:
+        stat_result = os.fstat(f.fileno())
+        first = compression.compressed_content(str(path), f, stat_result, 'gzip')
+        assert compression.compressed_content(str(path), f, stat_result, 'gzip') is first
+        assert zlib.decompress(compression.compressed_content(str(path), f, stat_result, 'deflate')) == path.read_bytes()
+    assert gzip.decompress(first) == path.read_bytes()
+
+def test_file_too_large_to_compress(tmp_path, fresh_cache, monkeypatch):
+    monkeypatch.setattr(settings, 'MAX_COMPRESS_SIZE', 100)
+    path = tmp_path / 'page.html'
+    path.write_bytes(b'x' * 101)
+    with open(path, 'rb') as f:
+        assert compression.compressed_content(str(path), f, os.fstat(f.fileno()), 'gzip') is None
+    status, headers, body = get(path, {'accept-encoding': 'gzip'})
+    assert status == 200 and 'Content-Encoding' not in headers and len(body) == 101
+
+def test_served_compressed_when_accepted(tmp_path):
+    path = tmp_path / 'page.html'
+    path.write_bytes(b'<p>hello</p>' * 100)
+    status, headers, body = get(path, {'accept-encoding': 'deflate'})
+    assert headers['Content-Encoding'] == 'deflate' and headers['Vary'] == 'Accept-Encoding'
+    assert int(headers['Content-Length']) == len(body)
+    assert zlib.decompress(body) == path.read_bytes()
+    status, headers, body = get(path)
+    assert 'Content-Encoding' not in headers and body == path.read_bytes()
+
+def test_precompressed_sibling_is_sent(tmp_path):
+    path = tmp_path / 'app.js'
+    path.write_bytes(b'let a = 1;\n' * 100)
+    sibling = tmp_path / 'app.js.gz'
+    sibling.write_bytes(gzip.compress(path.read_bytes(), compresslevel=1))
+    status, headers, body = get(path, {'accept-encoding': 'gzip'})
+    assert headers['Content-Encoding'] == 'gzip' and body == sibling.read_bytes()
+
+def test_stale_precompressed_sibling_is_ignored(tmp_path):
+    path = tmp_path / 'app.js'
+    path.write_bytes(b'let a = 1;\n' * 100)
+    sibling = tmp_path / 'app.js.gz'
+    sibling.write_bytes(b'not even gzip')
+    stat_result = path.stat()
+    os.utime(sibling, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns - 10**9))
+    status, headers, body = get(path, {'accept-encoding': 'gzip'})
+    assert headers['Content-Encoding'] == 'gzip' and gzip.decompress(body) == path.read_bytes()
@@ -0,0 +1,236 @@
+import contextlib
+import socket
+import threading
+
+import eventloop
+import framing
+from response import send_response, send_stream
+from test_framing import decode
+
+def hello(client_socket, request):
+    send_response(client_socket, request, 200, f"Hello {request.path}")
+
+@contextlib.contextmanager
+def running(consumer_for=None, dispatch=hello):
+    """An event loop serving dispatch on a loopback port, in a thread."""
+    server_socket = socket.create_server(('127.0.0.1', 0))
+    stop = threading.Event()
+    thread = threading.Thread(target=eventloop.serve, args=(server_socket, dispatch, stop, consumer_for))
+    thread.start()
+    try:
+        yield server_socket.getsockname()[1]
+    finally:
+        stop.set()
+        thread.join(5)
+        assert not thread.is_alive()
+
+def exchange(port, data):
+    """Sends data on a new connection; returns all that comes back until it closes."""
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(data)
+        received = b''
+        while chunk := sock.recv(65536):
+            received += chunk
+        return received
+
+def test_pipelined_requests_on_one_connection():
+    with running() as port:
+        received = exchange(port, b"GET /a HTTP/1.1\r\n\r\nGET /b HTTP/1.1\r\nConnection: close\r\n\r\n")
+    assert received.count(b"HTTP/1.1 200 OK") == 2
+    assert received.index(b"Hello /a") < received.index(b"Hello /b")
+
+def test_bad_request_gets_400_and_close():
+    with running() as port:
+        assert exchange(port, b"BROKEN\r\n\r\n").startswith(b"HTTP/1.1 400 Bad Request")
+
+def test_unexpected_error_only_closes_that_connection():
+    def consumer_for(request):
+        if request.path == '/boom':
+            raise RuntimeError("consumer failed")
+        return None
+    with running(consumer_for) as port:
+        assert exchange(port, b"GET /boom HTTP/1.1\r\n\r\n") == b''
+        assert b"Hello /after" in exchange(port, b"GET /after HTTP/1.1\r\nConnection: close\r\n\r\n")
+
+def test_reset_while_answering_a_bad_request(monkeypatch):
+    def reset(self, queue):
+        raise ConnectionResetError("peer reset")
+    with running() as port:
+        monkeypatch.setattr(eventloop.Connection, 'send_buffers', reset)
+        assert exchange(port, b"BROKEN\r\n\r\n") == b''
+        monkeypatch.undo()
+        assert b"Hello /after" in exchange(port, b"GET /after HTTP/1.1\r\nConnection: close\r\n\r\n")
+
+def test_handler_error_is_a_500():
+    def failing(client_socket, request):
+        raise ValueError("handler failed")
+    with running(dispatch=failing) as port:
+        assert exchange(port, b"GET / HTTP/1.1\r\n\r\n").startswith(b"HTTP/1.1 500 Internal Server Error")
+
+def test_content_length_with_superscript_digit():
+    with running() as port:
+        assert exchange(port, b"POST / HTTP/1.1\r\nContent-Length: \xb2\r\n\r\n").startswith(b"HTTP/1.1 400")
+        assert b"Hello /after" in exchange(port, b"GET /after HTTP/1.1\r\nConnection: close\r\n\r\n")
+
+def test_responses_to_http_1_0_close_the_connection():
+    with running() as port:
+        received = exchange(port, b"GET / HTTP/1.0\r\n\r\n")
+    assert b"Connection: close" in received
+    assert framing.BAD_REQUEST not in received
+
+def test_blocking_handler_does_not_hold_up_other_connections():
+    release = threading.Event()
+    def dispatch(client_socket, request):
+        if request.path == '/slow':
+            assert release.wait(5)
+        hello(client_socket, request)
+    def consumer_for(request):
+        request.blocking = request.path == '/slow'
+        return None
+    with running(consumer_for, dispatch) as port:
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as slow:
+            slow.sendall(b"GET /slow HTTP/1.1\r\nConnection: close\r\n\r\n")
+            assert b"Hello /fast" in exchange(port, b"GET /fast HTTP/1.1\r\nConnection: close\r\n\r\n")
+            release.set()
+            assert b"Hello /slow" in slow.recv(65536)
+
+class BlockingConsumer:
+    blocking = True
+
+    def __init__(self):
+        self.pieces = []
+        self.closed = False
+        self.thread = None
+
+    def feed(self, data):
+        self.thread = threading.current_thread()
+        self.pieces.append(bytes(data))
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        pass
+
+def test_blocking_consumer_is_fed_in_a_thread():
+    consumers = []
+    def consumer_for(request):
+        consumers.append(BlockingConsumer())
+        return consumers[-1]
+    def dispatch(client_socket, request):
+        consumer = request.body_consumer
+        assert consumer is consumers[-1] and consumer.closed
+        send_response(client_socket, request, 200, b"".join(consumer.pieces))
+    body = b"x" * 200_000
+    with running(consumer_for, dispatch) as port:
+        received = exchange(port, b"POST / HTTP/1.1\r\nContent-Length: 200000\r\nConnection: close\r\n\r\n" + body)
+        chunked = exchange(port, b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+                                 b"3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n")
+    assert received.endswith(body)
+    assert chunked.endswith(b"abcde")
+    assert consumers[0].thread is not threading.main_thread()
+
+def test_stream_of_a_blocking_handler_is_pulled_in_a_thread():
+    pulled_in = set()
+    def chunks():
+        for chunk in (b"one ", b"two ", b"three"):
+            pulled_in.add(threading.current_thread().name)
+            yield chunk
+    def consumer_for(request):
+        request.blocking = True
+        return None
+    def dispatch(client_socket, request):
+        send_stream(client_socket, request, 200, chunks(), content_length=13)
+    with running(consumer_for, dispatch) as port:
+        received = exchange(port, b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n")
+    assert received.endswith(b"\r\n\r\none two three")
+    assert all(name.startswith('offload') for name in pulled_in)
+
+def test_blocking_handler_error_is_a_500():
+    def failing(client_socket, request):
+        raise ValueError("handler failed")
+    def consumer_for(request):
+        request.blocking = True
+        return None
+    with running(consumer_for, failing) as port:
+        assert exchange(port, b"GET / HTTP/1.1\r\n\r\n").startswith(b"HTTP/1.1 500 Internal Server Error")
+
+def test_idle_keep_alive_connections_are_closed(monkeypatch):
+    monkeypatch.setattr(eventloop.settings, 'KEEP_ALIVE_TIMEOUT', 0.2)
+    monkeypatch.setattr(eventloop, 'SWEEP_INTERVAL', 0.05)
+    with running() as port:
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+            sock.sendall(b"GET /a HTTP/1.1\r\n\r\n")
+            received = b''
+            while chunk := sock.recv(65536):  # Ends once the server closes the idle connection
+                received += chunk
+    assert received.startswith(b"HTTP/1.1 200") and b"Hello /a" in received
+
+def test_large_file_reaches_a_slow_reader(tmp_path):
+    path = tmp_path / 'big.bin'
+    data = bytes(range(256)) * 40_000
+    path.write_bytes(data)
+    def dispatch(client_socket, request):
+        client_socket.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(data))
+        with open(path, 'rb') as f:
+            client_socket.sendfile(f)
+    with running(dispatch=dispatch) as port:
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+            sock.sendall(b"GET / HTTP/1.1\r\n\r\n")
+            threading.Event().wait(0.3)  # The socket buffers fill up and the loop has to wait for writability
+            received = b''
+            while not received.endswith(data):
+                chunk = sock.recv(65536)
+                assert chunk
+                received += chunk
+    assert received.partition(b"\r\n\r\n")[2] == data
+
+def test_connections_are_served_side_by_side():
+    with running() as port:
+        socks = [socket.create_connection(('127.0.0.1', port), timeout=5) for _ in range(20)]
+        try:
+            for i, sock in enumerate(socks):
+                sock.sendall(b"GET /%d HTTP/1.1\r\nConnection: close\r\n\r\n" % i)
+            for i, sock in reversed(list(enumerate(socks))):
+                assert b"Hello /%d" % i in sock.recv(65536)
+        finally:
+            for sock in socks:
+                sock.close()
+
+def test_stopping_closes_idle_connections():
+    with running() as port:
+        sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        sock.sendall(b"GET / HTTP/1.1\r\n\r\n")
+        assert sock.recv(65536).startswith(b"HTTP/1.1 200")
+    with sock:
+        assert sock.recv(65536) == b''  # running() only returns once serve() has
+
+def test_streamed_response_is_pulled_as_the_client_reads():
+    pulled = []
+    def chunks():
+        for n in range(500):
+            pulled.append(n)
+            yield bytes([n % 256]) * 65536
+    def dispatch(client_socket, request):
+        send_stream(client_socket, request, 200, chunks())
+    with running(dispatch=dispatch) as port:
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+            sock.sendall(b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n")
+            threading.Event().wait(0.3)
+            assert len(pulled) < 250  # Held back by the socket buffers, not all 32 MB at once
+            received = b''
+            while chunk := sock.recv(1 << 20):
+                received += chunk
+    assert len(pulled) == 500
+    body = b''.join(bytes([n % 256]) * 65536 for n in range(500))
+    assert decode(received.partition(b"\r\n\r\n")[2], limit=len(body)) == (body, b'')
+
+def test_failing_stream_hangs_up_without_the_last_chunk():
+    def chunks():
+        yield b"partial"
+        raise ValueError("source went away")
+    def dispatch(client_socket, request):
+        send_stream(client_socket, request, 200, chunks())
+    with running(dispatch=dispatch) as port:
+        received = exchange(port, b"GET / HTTP/1.1\r\n\r\n")
+    assert received.startswith(b"HTTP/1.1 200") and received.endswith(b"7\r\npartial\r\n")
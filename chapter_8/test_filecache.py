@@ -0,0 +1,115 @@
+import os
+
+import pytest
+
+import filecache
+import settings
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(settings, 'FILE_CACHE_ENTRIES', 3)
+    monkeypatch.setattr(settings, 'FILE_CACHE_BYTES', 1000)
+    monkeypatch.setattr(settings, 'FILE_CACHE_MEMORY_SIZE', 500)
+    monkeypatch.setattr(settings, 'FILE_CACHE_REVALIDATE', 60.0)
+    monkeypatch.setattr(filecache, 'cache', None)
+    yield
+    if filecache.cache is not None:
+        for entry in list(filecache.cache.entries.values()):
+            filecache.cache.remove(entry)
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+def test_hits_reuse_the_open_file(cache, tmp_path):
+    path = write(tmp_path / 'a.txt', b'a' * 100)
+    entry = filecache.get(path)
+    assert bytes(entry.data) == b'a' * 100 and entry.cached
+    filecache.release(entry)
+    assert not entry.file.closed
+    assert filecache.get(path) is entry
+
+@pytest.mark.parametrize('name', ['missing.txt', 'directory'])
+def test_no_entry_for_anything_but_a_regular_file(cache, tmp_path, name):
+    (tmp_path / 'directory').mkdir()
+    assert filecache.get(str(tmp_path / name)) is None
+
+def test_large_and_empty_files_are_not_read(cache, tmp_path):
+    large = filecache.get(write(tmp_path / 'large.bin', b'x' * 501))
+    empty = filecache.get(write(tmp_path / 'empty.bin', b''))
+    assert large.data is None and empty.data is None
+    assert filecache.cache.size == 0
+
+def test_changed_file_is_opened_again_once_revalidated(cache, tmp_path, monkeypatch):
+    path = write(tmp_path / 'a.txt', b'old')
+    entry = filecache.get(path)
+    write(tmp_path / 'new.txt', b'new!')
+    os.replace(tmp_path / 'new.txt', path)
+    assert filecache.get(path) is entry  # Not checked again yet
+    monkeypatch.setattr(settings, 'FILE_CACHE_REVALIDATE', 0.0)
+    fresh = filecache.get(path)
+    assert fresh is not entry and bytes(fresh.data) == b'new!'
+    assert entry.file.closed
+    assert filecache.get(path) is fresh  # Unchanged since
+
+def test_file_rewritten_in_place_is_served_as_it_was_read(cache, tmp_path):
+    path = write(tmp_path / 'a.txt', b'a' * 100)
+    entry = filecache.get(path)
+    with open(path, 'wb') as f:  # Truncated, as cp does, within FILE_CACHE_REVALIDATE
+        f.write(b'b')
+    assert filecache.get(path) is entry and entry.data == b'a' * 100
+
+def test_deleted_file_is_dropped(cache, tmp_path, monkeypatch):
+    path = write(tmp_path / 'a.txt', b'a')
+    filecache.get(path)
+    os.unlink(path)
+    monkeypatch.setattr(settings, 'FILE_CACHE_REVALIDATE', 0.0)
+    assert filecache.get(path) is None and path not in filecache.cache.entries
+
+def test_least_recently_used_entries_are_evicted(cache, tmp_path):
+    entries = [filecache.get(write(tmp_path / f'{n}.txt', b'x' * 10)) for n in range(3)]
+    filecache.get(entries[0].path)
+    filecache.get(write(tmp_path / '3.txt', b'x' * 10))
+    assert list(filecache.cache.entries) == [entries[2].path, entries[0].path, str(tmp_path / '3.txt')]
+    assert entries[1].file.closed
+
+def test_bytes_in_memory_are_bounded(cache, tmp_path):
+    first = filecache.get(write(tmp_path / 'a.bin', b'a' * 400))
+    filecache.get(write(tmp_path / 'b.bin', b'b' * 400))
+    assert filecache.cache.size == 800
+    filecache.get(write(tmp_path / 'c.bin', b'c' * 400))
+    assert filecache.cache.size == 800 and first.file.closed
+
+def test_an_entry_larger_than_the_cache_is_still_served(cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'FILE_CACHE_BYTES', 100)
+    entry = filecache.get(write(tmp_path / 'a.bin', b'a' * 400))
+    assert bytes(entry.data) == b'a' * 400 and not entry.file.closed
+
+def test_without_the_cache_release_closes(cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'FILE_CACHE_ENTRIES', 0)
+    path = write(tmp_path / 'a.txt', b'a')
+    entry = filecache.get(path)
+    assert not entry.cached and filecache.get(path) is not entry
+    filecache.release(entry)
+    assert entry.file.closed
+
+def test_precompressed_sibling(cache, tmp_path, monkeypatch):
+    path = write(tmp_path / 'app.js', b'js' * 10)
+    entry = filecache.get(path)
+    assert filecache.precompressed(entry) is None
+    write(tmp_path / 'app.js.gz', b'gz' * 5)
+    assert filecache.precompressed(entry) is None  # Looked up once
+    monkeypatch.setattr(settings, 'FILE_CACHE_REVALIDATE', 0.0)
+    assert filecache.get(path) is entry
+    gzip = filecache.precompressed(entry)
+    assert bytes(gzip.data) == b'gz' * 5 and filecache.cache.size == 30
+    os.unlink(tmp_path / 'app.js.gz')
+    assert filecache.get(path) is entry and gzip.file.closed and filecache.cache.size == 20
+    assert filecache.precompressed(entry) is None
+
+def test_older_precompressed_sibling_is_ignored(cache, tmp_path):
+    path = write(tmp_path / 'app.js', b'js')
+    write(tmp_path / 'app.js.gz', b'gz')
+    stat_result = os.stat(path)
+    os.utime(tmp_path / 'app.js.gz', ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns - 1))
+    assert filecache.precompressed(filecache.get(path)) is None
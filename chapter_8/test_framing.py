@@ -0,0 +1,290 @@
+import contextlib
+import socket
+
+import pytest
+
+import framing
+
+def read_all(data, consumer_for=None):
+    """Sends data over a socket pair and returns the requests read from it."""
+    client, server = socket.socketpair()
+    with client, server:
+        client.sendall(data)
+        client.shutdown(socket.SHUT_WR)
+        reader = framing.RequestReader(consumer_for)
+        requests = []
+        try:
+            while True:
+                request = framing.read_request(server, reader)
+                if request is None:
+                    return requests
+                requests.append(request)
+        finally:
+            reader.close()
+
+def request_with(headers):
+    return framing.Request('POST', '/', 'HTTP/1.1', headers, b'')
+
+def test_content_length():
+    assert framing.content_length(request_with({}), 100) == 0
+    assert framing.content_length(request_with({'content-length': '42'}), 100) == 42
+
+@pytest.mark.parametrize('value', ['', '-1', '+1', '1.0', '0x10', ' 1', '1 2', '²', '١', '1\n'])
+def test_content_length_rejects_anything_but_ascii_digits(value):
+    with pytest.raises(framing.BadRequest):
+        framing.content_length(request_with({'content-length': value}), 100)
+
+def test_content_length_over_limit():
+    with pytest.raises(framing.BodyTooLarge):
+        framing.content_length(request_with({'content-length': '101'}), 100)
+
+def test_parse_digits():
+    assert framing.parse_digits('007') == 7
+    assert framing.parse_digits(None) is None
+    assert framing.parse_digits('²') is None
+
+def test_header_number():
+    assert framing.header_number(request_with({'upload-offset': '12'}), 'upload-offset') == 12
+    assert framing.header_number(request_with({}), 'upload-offset') is None
+    with pytest.raises(framing.BadRequest):
+        framing.header_number(request_with({'upload-offset': '²'}), 'upload-offset')
+
+def test_superscript_content_length_is_a_bad_request():
+    with pytest.raises(framing.BadRequest):
+        read_all(b"POST / HTTP/1.1\r\nContent-Length: \xb2\r\n\r\n")
+
+@pytest.mark.parametrize('head', [
+    b"GET /\r\n\r\n",
+    b"GET / HTTP/1.1 extra\r\n\r\n",
+    b"GET / HTTP/1.1\r\nNo colon\r\n\r\n",
+    b"GET / HTTP/1.1\r\n: no name\r\n\r\n",
+    b"GET / HTTP/1.1\r\nName : space before colon\r\n\r\n",
+    b"POST / HTTP/1.1\r\nContent-Length: 5\r\ncontent-length: 0\r\n\r\nGET /smuggled HTTP/1.1\r\n\r\n",
+    b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\nTransfer-Encoding: chunked\r\n\r\n0\r\n\r\n",
+    b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\nContent-Length: 5\r\n\r\n0\r\n\r\n",
+    b"POST / HTTP/1.1\r\nContent-Length: 5\r\nTransfer-Encoding: chunked\r\n\r\n0\r\n\r\n",
+])
+def test_malformed_heads(head):
+    with pytest.raises(framing.BadRequest):
+        read_all(head)
+
+def test_pipelined_requests_with_bodies():
+    requests = read_all(b"POST /a HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc"
+                        b"GET /b HTTP/1.1\r\n\r\n"
+                        b"POST /c HTTP/1.1\r\nContent-Length: 0\r\n\r\n")
+    assert [(r.method, r.path) for r in requests] == [('POST', '/a'), ('GET', '/b'), ('POST', '/c')]
+
+def test_repeated_identical_content_length():
+    requests = read_all(b"POST /a HTTP/1.1\r\nContent-Length: 3\r\nContent-Length: 3\r\n\r\nabc")
+    assert [(r.path, bytes(r.body)) for r in requests] == [('/a', b'abc')]
+
+def test_body_cut_short():
+    with pytest.raises(framing.BadRequest):
+        read_all(b"POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\nabc")
+
+def test_headers_too_large(monkeypatch):
+    monkeypatch.setattr(framing.settings, 'MAX_HEADER_SIZE', 64)
+    with pytest.raises(framing.HeadersTooLarge):
+        read_all(b"GET / HTTP/1.1\r\nX-Long: " + b"a" * 200 + b"\r\n\r\n")
+
+def test_too_many_headers(monkeypatch):
+    monkeypatch.setattr(framing.settings, 'MAX_HEADER_COUNT', 2)
+    with pytest.raises(framing.HeadersTooLarge):
+        read_all(b"GET / HTTP/1.1\r\nA: 1\r\nB: 2\r\nC: 3\r\n\r\n")
+
+def feed_bytewise(data, consumer_for=None):
+    """Feeds data to a RequestReader one byte at a time, as recv_buffer() and
+    received() let an event loop do; returns the requests with their bodies."""
+    reader = framing.RequestReader(consumer_for)
+    requests = []
+    for byte in data:
+        reader.recv_buffer()[:1] = bytes([byte])
+        reader.received(1)
+        while (request := reader.next_request()) is not None:
+            requests.append((request.method, request.path, request.read()))
+    assert not reader.has_partial_request()
+    reader.close()
+    return requests
+
+def test_requests_arriving_a_byte_at_a_time():
+    data = (b"POST /a HTTP/1.1\r\nContent-Length: 5\r\n\r\nhello"
+            b"GET /b HTTP/1.1\r\nHost: x\r\n\r\n"
+            b"POST /c HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n0\r\n\r\n")
+    assert feed_bytewise(data) == [('POST', '/a', b'hello'), ('GET', '/b', b''), ('POST', '/c', b'abc')]
+
+def test_head_parsing():
+    request = framing.parse_head(b"GET /p?q=1 HTTP/1.1\r\nHost: example\r\nX-Thing:  spaced  \r\nACCEPT:*/*")
+    assert (request.method, request.path, request.version) == ('GET', '/p?q=1', 'HTTP/1.1')
+    assert request.headers == {'host': 'example', 'x-thing': 'spaced', 'accept': '*/*'}
+    assert request.keep_alive
+
+def test_body_larger_than_the_buffer(monkeypatch):
+    monkeypatch.setattr(framing.settings, 'BODY_SPOOL_SIZE', 10 * 1024 * 1024)
+    body = bytes(range(256)) * 200  # Over the receive buffer, within the socket pair's
+    [request] = read_all(b"POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body) + body)
+    assert request.read() == body
+
+@contextlib.contextmanager
+def first_request(data):
+    """Reads the first request of data. Its spooled body lasts until the
+    next request is read, so the reader is kept open meanwhile."""
+    client, server = socket.socketpair()
+    with client, server:
+        client.sendall(data)
+        client.shutdown(socket.SHUT_WR)
+        reader = framing.RequestReader()
+        try:
+            yield framing.read_request(server, reader)
+        finally:
+            reader.close()
+
+@pytest.fixture
+def small_spool(monkeypatch):
+    """Bodies of over 100 bytes are spooled, unless they fit the 2 KiB
+    receive buffer along with their head."""
+    monkeypatch.setattr(framing.settings, 'BODY_SPOOL_SIZE', 100)
+    monkeypatch.setattr(framing.settings, 'MAX_HEADER_SIZE', 1024)
+    monkeypatch.setattr(framing, 'RECV_SIZE', 1024)
+
+@pytest.mark.parametrize('framing_headers, body', [
+    (b"Content-Length: 50\r\n", b"a" * 50),
+    (b"Content-Length: 5000\r\n", bytes(range(250)) * 20),
+    (b"Transfer-Encoding: chunked\r\n", b"c" * 50),
+    (b"Transfer-Encoding: chunked\r\n", bytes(range(250)) * 20),
+], ids=['small', 'large', 'small-chunked', 'large-chunked'])
+def test_body_is_spooled_above_the_threshold(small_spool, framing_headers, body):
+    if b"chunked" in framing_headers:
+        encoded = b"".join(b"%x\r\n%s\r\n" % (len(body[i:i + 999]), body[i:i + 999]) for i in range(0, len(body), 999))
+        encoded += b"0\r\n\r\n"
+    else:
+        encoded = body
+    with first_request(b"POST / HTTP/1.1\r\n" + framing_headers + b"\r\n" + encoded) as request:
+        assert (request.body_file is not None) == (len(body) > 100)
+        assert request.read(10) == body[:10] and request.read(0) == b''
+        assert request.read() == body[10:] and request.read() == b''
+        assert b''.join(request.body_stream(33)) == body
+        assert max(map(len, request.body_stream(33))) == 33
+
+def test_spool_rolls_over_as_the_body_grows(small_spool):
+    request = request_with({})
+    spool = framing.BodySpool(request)
+    spool.feed(b'x' * 60)
+    assert spool.file is None
+    spool.feed(b'y' * 60)
+    assert spool.file is not None
+    spool.close()
+    assert request.read() == b'x' * 60 + b'y' * 60 and request.body == b''
+
+def test_spool_of_a_known_large_body_starts_on_disk(small_spool):
+    assert framing.BodySpool(request_with({}), 101).file is not None
+    assert framing.BodySpool(request_with({}), 100).file is None
+
+def test_spool_file_is_closed_once_the_next_request_is_read(small_spool):
+    first, second = read_all(b"POST / HTTP/1.1\r\nContent-Length: 5000\r\n\r\n" + b"x" * 5000 + b"GET / HTTP/1.1\r\n\r\n")
+    assert first.body_file.closed and second.body_file is None
+
+@pytest.mark.parametrize('pieces, fields', [
+    ([b'a=1&b=2'], {'a': '1', 'b': '2'}),
+    ([b'a=1&b', b'=2&c=', b'3'], {'a': '1', 'b': '2', 'c': '3'}),
+    ([b'na', b'me=J', b'ohn+Doe%21&x=%E2%82%AC'], {'name': 'John Doe!', 'x': '€'}),
+    ([b'a=1&a=2'], {'a': '2'}),
+    ([b'&&a&=b&'], {'a': '', '': 'b'}),
+    ([b'a=\xff'], {'a': '�'}),
+    ([], {}),
+])
+def test_parse_form(pieces, fields):
+    assert framing.parse_form(pieces) == fields
+
+def test_form_limits(monkeypatch):
+    monkeypatch.setattr(framing.settings, 'MAX_FORM_FIELD_SIZE', 10)
+    monkeypatch.setattr(framing.settings, 'MAX_FORM_PARTS', 3)
+    assert framing.parse_form([b'a=12345678&b=2&c=3'])
+    for pieces in ([b'a=123456789'], [b'a=1234', b'56789'], [b'a=' + b'1' * 20, b'&b=2'], [b'a&b&c&d']):
+        with pytest.raises(framing.BadRequest):
+            framing.parse_form(pieces)
+
+def test_spooled_form_is_parsed_in_pieces(small_spool):
+    body = b'&'.join(b'f%d=%d' % (n, n) for n in range(500))
+    with first_request(b"POST / HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body) + body) as request:
+        assert request.body_file is not None
+        assert request.form() == {f'f{n}': str(n) for n in range(500)}
+        assert request.form() is request.form()
+
+class Collector:
+    def __init__(self):
+        self.data = b''
+
+    def feed(self, data):
+        self.data += bytes(data)
+
+def decode(encoded, piece_size=None, limit=1 << 20):
+    """Runs encoded through a ChunkedDecoder as a reader would, piece_size
+    bytes arriving at a time; returns the data and the bytes after the body."""
+    collector = Collector()
+    decoder = framing.ChunkedDecoder(collector, limit)
+    buffer = b''
+    piece_size = piece_size or len(encoded)
+    for start in range(0, len(encoded), piece_size):
+        buffer += encoded[start:start + piece_size]
+        buffer = buffer[decoder.decode(buffer, 0, len(buffer)):]
+        if decoder.done:
+            return collector.data, buffer + encoded[start + piece_size:]
+    raise framing.BadRequest("Body cut short")
+
+CHUNKED = (b"5\r\nhello\r\n"
+           b"1;name=value;other\r\n \r\n"
+           b"00A\r\n0123456789\r\n"
+           b"f \r\n" + b"x" * 15 + b"\r\n"
+           b"0;last\r\nX-Checksum: 1\r\nX-Other: 2\r\n\r\n")
+
+@pytest.mark.parametrize('piece_size', [None, 1, 2, 3, 7])
+def test_chunked_body_in_pieces_of_any_size(piece_size):
+    data, rest = decode(CHUNKED + b"GET / HTTP/1.1\r\n\r\n", piece_size)
+    assert data == b"hello 0123456789" + b"x" * 15
+    assert rest == b"GET / HTTP/1.1\r\n\r\n"
+
+@pytest.mark.parametrize('encoded', [
+    b"\r\n0\r\n\r\n",  # No size
+    b"g\r\n",
+    b"-1\r\n",
+    b"+5\r\nhello\r\n0\r\n\r\n",
+    b"0x5\r\nhello\r\n0\r\n\r\n",
+    b"\xd9\xa1\r\n",  # Not an ASCII digit
+    b"1 1\r\n",
+    b"11111111111111111\r\n",  # More than 64 bits
+    b"5\r\nhelloXX0\r\n\r\n",  # Data not followed by CRLF
+    b"5\r\nhello\n0\r\n\r\n",
+    b"5" * 5000,  # Size line that never ends
+    b"0\r\n" + b"X-Long: " + b"a" * 5000,  # Trailer line that never ends
+])
+def test_malformed_chunked_bodies(encoded):
+    with pytest.raises(framing.BadRequest):
+        decode(encoded)
+
+def test_chunked_trailers_are_limited(monkeypatch):
+    monkeypatch.setattr(framing.settings, 'MAX_HEADER_SIZE', 100)
+    assert decode(b"0\r\n" + b"X-T: 1\r\n" * 12 + b"\r\n") == (b'', b'')
+    with pytest.raises(framing.HeadersTooLarge):
+        decode(b"0\r\n" + b"X-T: 1\r\n" * 13 + b"\r\n", 1)
+
+def test_chunked_body_over_the_limit():
+    assert decode(b"a\r\n0123456789\r\n0\r\n\r\n", limit=10)[0] == b"0123456789"
+    with pytest.raises(framing.BodyTooLarge):
+        decode(b"6\r\n012345\r\n5\r\n", limit=10)  # Refused before the data arrives
+
+@pytest.mark.parametrize('headers', [
+    {'transfer-encoding': 'gzip, chunked'},
+    {'transfer-encoding': 'identity'},
+    {'transfer-encoding': 'chunked', 'content-length': '5'},
+])
+def test_unsupported_or_ambiguous_framing(headers):
+    with pytest.raises(framing.BadRequest):
+        framing.is_chunked(request_with(headers))
+
+def test_chunked_framing_names_are_case_insensitive():
+    assert framing.is_chunked(request_with({'transfer-encoding': ' Chunked '}))
+    assert not framing.is_chunked(request_with({}))
+
+def test_chunked_request_cut_short():
+    with pytest.raises(framing.BadRequest):
+        read_all(b"POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nhel")
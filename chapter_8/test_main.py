@@ -0,0 +1,145 @@
+import socket
+import threading
+
+import pytest
+
+import accesslog
+import capture
+import main
+import metrics
+import settings
+from test_eventloop import exchange
+from response import send_response
+
+@pytest.fixture(autouse=True)
+def routes(monkeypatch):
+    monkeypatch.setattr(settings, 'STATIC_INDEX', False)
+    monkeypatch.setattr(main, 'routes', main.build_routes())
+
+def serve_one(data, dispatch):
+    """Runs main.handle_connection() for one TCP connection; returns what
+    the client received."""
+    with socket.create_server(('127.0.0.1', 0)) as listener:
+        client = socket.create_connection(listener.getsockname(), timeout=5)
+        server, addr = listener.accept()
+    with client, server:
+        thread = threading.Thread(target=main.handle_connection, args=(server, addr, None, dispatch))
+        thread.start()
+        client.sendall(data)
+        thread.join(5)
+        assert not thread.is_alive()
+        server.close()  # Like serve_blocking() does after handle_connection()
+        received = b''
+        while chunk := client.recv(65536):
+            received += chunk
+        return received
+
+def hello(client_socket, request):
+    send_response(client_socket, request, 200, "Hello")
+
+def test_keep_alive_and_close():
+    received = serve_one(b"GET / HTTP/1.1\r\n\r\nGET / HTTP/1.1\r\nConnection: close\r\n\r\n", hello)
+    assert received.count(b"200 OK") == 2
+
+def test_handler_error_is_a_500_and_does_not_escape():
+    def failing(client_socket, request):
+        raise ValueError("handler failed")
+    assert serve_one(b"GET / HTTP/1.1\r\n\r\n", failing).startswith(b"HTTP/1.1 500")
+
+def test_error_after_the_head_went_out_only_closes():
+    def half(client_socket, request):
+        send_response(client_socket, request, 200, "Hello")
+        raise ValueError("handler failed after responding")
+    received = serve_one(b"GET / HTTP/1.1\r\n\r\n", half)
+    assert received.startswith(b"HTTP/1.1 200") and b"500" not in received
+
+def test_malformed_request_is_a_400():
+    assert serve_one(b"BROKEN\r\n\r\n", hello).startswith(b"HTTP/1.1 400")
+
+def test_conflicting_content_lengths_are_a_400():
+    received = serve_one(b"POST / HTTP/1.1\r\nContent-Length: 5\r\nContent-Length: 0\r\n\r\n"
+                         b"GET /smuggled HTTP/1.1\r\n\r\n", hello)
+    assert received.startswith(b"HTTP/1.1 400") and b"200 OK" not in received
+
+def profile(query):
+    request = main.framing.Request('GET', '/debug/profile?' + query, 'HTTP/1.1', {'connection': 'close'}, b'')
+    client, server = socket.socketpair()
+    with client, server:
+        main.handle_profile(server, request)
+        server.shutdown(socket.SHUT_WR)
+        received = b''
+        while chunk := client.recv(65536):
+            received += chunk
+    return received
+
+@pytest.mark.parametrize('query', ['seconds=nan', 'seconds=inf', 'seconds=-1', 'seconds=0', 'seconds=x',
+                                   'interval=nan', 'interval=-inf', 'interval=0', 'seconds=1&interval=1e999'])
+def test_profile_rejects_bad_numbers(query):
+    assert profile(query).startswith(b"HTTP/1.1 400")
+
+def test_profile_samples():
+    assert profile('seconds=0.02&interval=0.005').startswith(b"HTTP/1.1 200")
+
+def test_http_1_0_keep_alive_on_request():
+    received = serve_one(b"GET /a HTTP/1.0\r\nConnection: keep-alive\r\n\r\nGET /b HTTP/1.0\r\n\r\n", hello)
+    first, _, second = received.partition(b"Hello")
+    assert b"Connection: keep-alive" in first and b"Connection: close" in second
+
+def test_pipelined_requests_are_answered_in_order():
+    def echo(client_socket, request):
+        send_response(client_socket, request, 200, request.path)
+    received = serve_one(b"GET /1 HTTP/1.1\r\n\r\nGET /2 HTTP/1.1\r\n\r\nGET /3 HTTP/1.1\r\nConnection: close\r\n\r\n", echo)
+    assert received.index(b"\r\n\r\n/1") < received.index(b"\r\n\r\n/2") < received.index(b"\r\n\r\n/3")
+
+def test_requests_per_connection_are_limited(monkeypatch):
+    monkeypatch.setattr(settings, 'MAX_REQUESTS_PER_CONNECTION', 2)
+    received = serve_one(b"GET / HTTP/1.1\r\n\r\n" * 3, hello)
+    assert received.count(b"200 OK") == 2
+    assert received.count(b"Connection: keep-alive") == 1 and received.count(b"Connection: close") == 1
+
+def test_idle_connection_times_out(monkeypatch):
+    monkeypatch.setattr(settings, 'KEEP_ALIVE_TIMEOUT', 0.2)
+    with socket.create_server(('127.0.0.1', 0)) as listener:
+        client = socket.create_connection(listener.getsockname(), timeout=5)
+        server, addr = listener.accept()
+    with client, server:
+        client.sendall(b"GET / HTTP/1.1\r\n\r\n")
+        thread = threading.Thread(target=main.handle_connection, args=(server, addr, None, hello))
+        thread.start()
+        thread.join(5)  # framing.read_request() gives up after KEEP_ALIVE_TIMEOUT
+        assert not thread.is_alive()
+        assert client.recv(65536).startswith(b"HTTP/1.1 200")
+
+def free_port():
+    with socket.create_server(('127.0.0.1', 0)) as sock:
+        return sock.getsockname()[1]
+
+def test_admin_requests_stay_out_of_uploads_logs_and_metrics(tmp_path, monkeypatch):
+    port = free_port()
+    monkeypatch.setattr(settings, 'ADMIN_PORT', port)
+    monkeypatch.setattr(settings, 'UPLOADS_DIRECTORY', str(tmp_path))
+    recorded = []
+    monkeypatch.setattr(accesslog, 'log', lambda request, addr: recorded.append(request))
+    monkeypatch.setattr(capture, 'record', recorded.append)
+    before = (dict(metrics.responses), dict(metrics.requests), metrics.connections_accepted)
+    stop = threading.Event()
+    thread = threading.Thread(target=main.serve_admin, args=(stop,))
+    thread.start()
+    try:
+        body = b'--XyZ\r\nContent-Disposition: form-data; name="f"; filename="a.bin"\r\n\r\nx\r\n--XyZ--\r\n'
+        for _ in range(50):  # Until it listens
+            try:
+                received = exchange(port, b"POST /debug/profile HTTP/1.1\r\nContent-Type: multipart/form-data; "
+                                          b"boundary=XyZ\r\nContent-Length: %d\r\nConnection: close\r\n\r\n"
+                                          % len(body) + body)
+                break
+            except ConnectionRefusedError:
+                stop.wait(0.05)
+        assert received.startswith(b"HTTP/1.1 405")
+        assert exchange(port, b"GET /debug/profile?seconds=0.01 HTTP/1.1\r\nConnection: close\r\n\r\n"
+                        ).startswith(b"HTTP/1.1 200")
+    finally:
+        stop.set()
+        thread.join(5)
+    assert list(tmp_path.iterdir()) == [] and recorded == []
+    assert (dict(metrics.responses), dict(metrics.requests), metrics.connections_accepted) == before
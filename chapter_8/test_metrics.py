@@ -0,0 +1,64 @@
+import os
+import re
+
+import pytest
+
+import main
+import metrics
+import settings
+from test_main import serve_one
+
+@pytest.mark.parametrize('micros', [0, 1, 15, 16, 17, 100, 1000, 123_456, 10**9, metrics.MAX_MICROS])
+def test_value_falls_in_its_bucket(micros):
+    index = metrics.bucket_index(micros)
+    assert micros < metrics.bucket_bound(index)
+    assert index == 0 or micros >= metrics.bucket_bound(index - 1)
+
+def test_buckets_are_contiguous_and_precise():
+    for index in range(1, metrics.Histogram.SIZE):
+        lower, upper = metrics.bucket_bound(index - 1), metrics.bucket_bound(index)
+        assert metrics.bucket_index(lower) == index and metrics.bucket_index(upper - 1) == index
+        assert upper - lower <= max(1, lower / 2 ** metrics.SUB_BUCKET_BITS)
+
+def test_record_clamps_out_of_range_durations():
+    histogram = metrics.Histogram()
+    histogram.record(-1.0)  # A clock that went backwards
+    histogram.record(10**7)
+    assert histogram.counts[0] == 1 and histogram.counts[-1] == 1
+    assert histogram.count == 2 and histogram.highest == metrics.Histogram.SIZE - 1
+
+@pytest.fixture
+def fresh(monkeypatch):
+    monkeypatch.setattr(metrics, 'phases', {phase: metrics.Histogram() for phase in metrics.PHASES})
+    monkeypatch.setattr(metrics, 'duration', metrics.Histogram())
+    monkeypatch.setattr(metrics, 'requests', dict.fromkeys(metrics.METHODS + ('other',), 0))
+    monkeypatch.setattr(metrics, 'responses', {})
+
+def test_render(fresh):
+    metrics.count_request('GET')
+    metrics.count_request('BREW')
+    metrics.count_response(404)
+    metrics.observe('read', 0.000_010)
+    metrics.observe('read', 0.5)
+    text = metrics.render()
+    assert re.search(r'http_requests_total\{worker="\d+",method="GET"\} 1\n', text)
+    assert re.search(r'method="other"\} 1\n', text)
+    assert re.search(r'status="404"\} 1\n', text)
+    read = [line for line in text.splitlines() if 'phase="read"' in line]
+    buckets = [int(line.rpartition(' ')[2]) for line in read if '_bucket' in line]
+    assert buckets == sorted(buckets) and buckets[-1] == 2
+    assert read[-1].endswith('_count{worker="%d",phase="read"} 2' % os.getpid())
+    assert 'le="1.1e-05"} 1' in text and 'le="+Inf"} 2' in '\n'.join(read)
+    assert text.endswith('\n')
+
+def test_requests_are_counted_and_timed(fresh, monkeypatch):
+    monkeypatch.setattr(settings, 'STATIC_INDEX', False)
+    monkeypatch.setattr(main, 'routes', main.build_routes())
+    received = serve_one(b"GET /missing HTTP/1.1\r\n\r\nPOST /form HTTP/1.1\r\nContent-Length: 3\r\n\r\na=1"
+                         b"GET /metrics HTTP/1.1\r\nConnection: close\r\n\r\n", main.dispatch_request)
+    text = received.rpartition(b"\r\n\r\n")[2].decode()
+    assert re.search(r'method="GET"\} 2\n', text) and re.search(r'method="POST"\} 1\n', text)
+    assert re.search(r'status="404"\} 1\n', text) and re.search(r'status="200"\} 1\n', text)
+    assert re.search(r'http_request_duration_seconds_count\{worker="\d+"\} 2\n', text)
+    for phase, count in (('accept', 1), ('read', 3), ('parse', 3), ('handle', 2), ('send', 2)):
+        assert re.search(r'_count\{worker="\d+",phase="%s"\} %d\n' % (phase, count), text)  # /metrics is read already
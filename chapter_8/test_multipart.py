@@ -0,0 +1,117 @@
+import os
+import threading
+
+import pytest
+
+import main
+import multipart
+import settings
+import test_eventloop
+
+BOUNDARY = b'XyZ'
+
+@pytest.fixture(autouse=True)
+def no_fsync(monkeypatch):
+    monkeypatch.setattr(settings, 'UPLOAD_FSYNC', 'none')
+
+def form(*parts):
+    """Encodes (name, filename or None, data) parts as a multipart body."""
+    body = b''
+    for name, filename, data in parts:
+        disposition = b'form-data; name="%s"' % name
+        if filename is not None:
+            disposition += b'; filename="%s"' % filename
+        body += b'--%s\r\nContent-Disposition: %s\r\n\r\n%s\r\n' % (BOUNDARY, disposition, data)
+    return body + b'--%s--\r\n' % BOUNDARY
+
+def parse(directory, body, piece_size=None):
+    parser = multipart.MultipartParser(BOUNDARY, str(directory), len(body))
+    piece_size = piece_size or max(1, len(body))
+    for start in range(0, len(body), piece_size):
+        parser.feed(memoryview(body[start:start + piece_size]))
+    parser.close()
+    return parser
+
+def stored(directory, filename):
+    return (directory / 'names' / filename).read_bytes()
+
+@pytest.mark.parametrize('content_type, boundary', [
+    ('multipart/form-data; boundary=abc', b'abc'),
+    ('multipart/form-data; boundary="a b"', b'a b'),
+    ('multipart/form-data; charset=utf-8; boundary=abc', b'abc'),
+    ('multipart/form-data', None),
+    ('text/plain; boundary=abc', None),
+])
+def test_parse_boundary(content_type, boundary):
+    assert multipart.parse_boundary(content_type) == boundary
+
+@pytest.mark.parametrize('filename, safe', [
+    ('a.txt', 'a.txt'), ('../../etc/passwd', 'passwd'), ('C:\\Users\\x\\b.txt', 'b.txt'),
+    ('..', None), ('dir/', None), ('', None), ('a\0b', None),
+])
+def test_safe_filename(filename, safe):
+    assert multipart.safe_filename(filename) == safe
+
+@pytest.mark.parametrize('piece_size', [None, 1, 7, 4096])
+def test_fields_and_files_in_pieces_of_any_size(tmp_path, piece_size):
+    data = os.urandom(20_000) + b'\r\n--Xy\r\n-XyZ--XyZ'  # Delimiter lookalikes stay content
+    body = form((b'title', None, b'Hello'), (b'file', b'data.bin', data), (b'note', None, b''))
+    parser = parse(tmp_path, b'preamble\r\n' + body + b'epilogue', piece_size)
+    assert parser.fields == {'title': 'Hello', 'note': ''}
+    assert [(f.name, f.filename, f.size) for f in parser.files] == [('file', 'data.bin', len(data))]
+    assert stored(tmp_path, 'data.bin') == data
+
+def test_filename_is_made_safe(tmp_path):
+    parser = parse(tmp_path, form((b'file', b'..%2F..%2Fescape.txt', b'x')))
+    assert parser.files[0].filename == 'escape.txt'
+    assert stored(tmp_path, 'escape.txt') == b'x'
+
+@pytest.mark.parametrize('body', [
+    form((b'file', b'a.txt', b'x'))[:-9],  # No closing boundary
+    b'--XyZ\r\nContent-Disposition: form-data; name="a"\r\n\r\nvalue\r\n--XyZ',
+    b'--XyZjunk\r\n',
+    b'--XyZ\r\n' + b'X-Long: ' + b'a' * (multipart.MAX_PART_HEADER_SIZE + 1),
+    form((b'file', b'..', b'x')),
+    b'',
+])
+def test_malformed_bodies(tmp_path, body):
+    with pytest.raises(multipart.MultipartError):
+        parse(tmp_path, body)
+    assert os.listdir(tmp_path / 'tmp') == []
+
+def test_field_size_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'MAX_FORM_FIELD_SIZE', 10)
+    parse(tmp_path, form((b'a', None, b'x' * 10)))
+    with pytest.raises(multipart.MultipartError):
+        parse(tmp_path, form((b'a', None, b'x' * 11)))
+
+def test_part_count_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'MAX_FORM_PARTS', 2)
+    parse(tmp_path, form((b'a', None, b'1'), (b'b', None, b'2')))
+    with pytest.raises(multipart.MultipartError):
+        parse(tmp_path, form((b'a', None, b'1'), (b'b', None, b'2'), (b'c', None, b'3')))
+
+def test_abort_discards_the_part_being_written(tmp_path):
+    parser = multipart.MultipartParser(BOUNDARY, str(tmp_path))
+    parser.feed(b'--XyZ\r\nContent-Disposition: form-data; name="f"; filename="cut.bin"\r\n\r\n' + b'x' * 100_000)
+    parser.abort()
+    assert os.listdir(tmp_path / 'tmp') == []
+    assert not (tmp_path / 'names' / 'cut.bin').exists()
+
+def test_event_loop_writes_and_syncs_uploads_off_its_thread(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'UPLOAD_FSYNC', 'file')
+    monkeypatch.setattr(settings, 'UPLOADS_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(settings, 'STATIC_INDEX', False)
+    monkeypatch.setattr(main, 'routes', main.build_routes())
+    synced_in = []
+    fsync = os.fsync
+    def recording_fsync(fd):
+        synced_in.append(threading.current_thread().name)
+        fsync(fd)
+    monkeypatch.setattr(os, 'fsync', recording_fsync)
+    body = form((b'file', b'a.bin', b'x' * 100_000))
+    head = b"POST /upload HTTP/1.1\r\nContent-Type: multipart/form-data; boundary=XyZ\r\n"
+    with test_eventloop.running(main.body_consumer, main.dispatch_request) as port:
+        received = test_eventloop.exchange(port, head + b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+    assert received.startswith(b"HTTP/1.1 200") and stored(tmp_path, 'a.bin') == b'x' * 100_000
+    assert synced_in and all(name.startswith('offload') for name in synced_in)
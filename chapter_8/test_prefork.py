@@ -0,0 +1,121 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+import main
+import prefork
+
+# A supervisor of two workers that answer with their pid; it prints the port
+SUPERVISOR = """
+import os, sys
+import eventloop, main, prefork
+from response import send_response
+
+reuse_port = sys.argv[2] == 'reuse'
+def create_socket():
+    server_socket = main.create_server_socket(int(sys.argv[1]), reuse_port, '127.0.0.1')
+    print(server_socket.getsockname()[1], flush=True)
+    return server_socket
+def dispatch(client_socket, request):
+    send_response(client_socket, request, 200, str(os.getpid()))
+serve = lambda server_socket, stop: eventloop.serve(server_socket, dispatch, stop)
+prefork.supervise(create_socket, serve, 2, reuse_port)
+"""
+
+def free_port():
+    with socket.create_server(('127.0.0.1', 0)) as sock:
+        return sock.getsockname()[1]
+
+@pytest.fixture
+def supervisor(request):
+    port, mode = request.param
+    process = subprocess.Popen([sys.executable, '-c', SUPERVISOR, str(port), mode], cwd=os.path.dirname(main.__file__),
+                               stdout=subprocess.PIPE, text=True)
+    port = int(process.stdout.readline())
+    yield process, port
+    if process.poll() is None:
+        process.kill()
+    process.wait()
+    process.stdout.close()
+
+def worker_pids(port, attempts=40):
+    """The pids of the workers that answer a round of new connections."""
+    pids = set()
+    for _ in range(attempts):
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+                sock.sendall(b"GET / HTTP/1.1\r\nConnection: close\r\n\r\n")
+                received = b''
+                while chunk := sock.recv(65536):
+                    received += chunk
+        except ConnectionError:
+            continue  # A worker that was going away
+        if received:  # Or one that was closing its idle connections on the way out
+            pids.add(int(received.rpartition(b"\r\n\r\n")[2]))
+    return pids
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+
+@pytest.mark.parametrize('supervisor', [(0, 'shared'), (free_port(), 'reuse')], indirect=True)
+def test_workers_serve_and_stop_on_sigterm(supervisor):
+    process, port = supervisor
+    pids = worker_pids(port)
+    assert pids and all(pid != process.pid for pid in pids)
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(10) == 0
+
+@pytest.mark.parametrize('supervisor', [(0, 'shared')], indirect=True)
+def test_crashed_worker_is_replaced(supervisor):
+    process, port = supervisor
+    pid = worker_pids(port, 1).pop()
+    os.kill(pid, signal.SIGKILL)
+    wait_for(lambda: pid not in worker_pids(port, 10) and len(worker_pids(port)) >= 1)
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(10) == 0
+
+@pytest.mark.parametrize('supervisor', [(0, 'shared')], indirect=True)
+def test_sighup_replaces_every_worker(supervisor):
+    process, port = supervisor
+    before = worker_pids(port)
+    process.send_signal(signal.SIGHUP)
+    wait_for(lambda: not worker_pids(port, 10) & before)
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(10) == 0
+
+def test_workers_are_stopped_against_one_deadline():
+    pids = []
+    for _ in range(3):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)  # Like a worker whose clients read slowly
+            while True:
+                time.sleep(1)
+        pids.append(pid)
+    start = time.monotonic()
+    prefork.stop_workers(pids, timeout=0.5)
+    assert time.monotonic() - start < 1.5
+    for pid in pids:
+        with pytest.raises(ChildProcessError):
+            os.waitpid(pid, os.WNOHANG)
+
+CRASHING_WORKER = """
+import os, prefork
+def serve(server_socket, stop):
+    raise RuntimeError("serve failed")
+prefork.run_worker(None, object(), serve, os.open(os.devnull, os.O_WRONLY))
+"""
+
+def test_crash_message_is_flushed_before_exiting():
+    process = subprocess.run([sys.executable, '-c', CRASHING_WORKER], cwd=os.path.dirname(main.__file__),
+                             capture_output=True, text=True, timeout=10)
+    assert process.returncode == 1
+    assert "crashed: RuntimeError('serve failed')" in process.stdout
@@ -0,0 +1,54 @@
+import collections
+import threading
+import time
+
+import framing
+import profiler
+import router
+from test_router import Sink
+
+def spin_until(stop):
+    while not stop.is_set():
+        pass
+
+def test_sample_sees_the_other_threads():
+    stop = threading.Event()
+    thread = threading.Thread(target=spin_until, args=(stop,), name='busy')
+    thread.start()
+    try:
+        stacks = profiler.sample(0.05, 0.001)
+    finally:
+        stop.set()
+        thread.join()
+    busy = {stack: count for stack, count in stacks.items() if stack.startswith('busy;')}
+    assert busy and all(';spin_until (test_profiler.py:' in stack for stack in busy)
+    assert not any(';sample (profiler.py:' in stack for stack in stacks)  # Not its own thread
+
+def test_format_collapsed():
+    stacks = collections.Counter({'main;a;b': 2, 'main;a': 5})
+    assert profiler.format_collapsed(stacks) == "main;a 5\nmain;a;b 2\n"
+    assert profiler.format_collapsed(collections.Counter()) == ""
+
+def handled(client_socket, request):
+    return [b"traced"]
+
+def test_trace_profiles_dispatched_handlers():
+    routes = router.Router()
+    routes.add('GET', '/', handled)
+    routes.compile()
+    original = routes.dispatch
+    reports = []
+    thread = threading.Thread(target=lambda: reports.append(profiler.trace(routes, 0.3)))
+    thread.start()
+    time.sleep(0.1)
+    sink = Sink()
+    routes.dispatch(sink, framing.Request('GET', '/', 'HTTP/1.1', {}, b''))
+    thread.join()
+    assert sink.data.endswith(b"6\r\ntraced\r\n0\r\n\r\n")
+    assert 'handled' in reports[0] and 'cumulative' in reports[0]
+    assert routes.dispatch == original and 'dispatch' not in vars(routes)
+
+def test_trace_without_requests():
+    routes = router.Router()
+    routes.compile()
+    assert profiler.trace(routes, 0.01) == "No requests were handled.\n"
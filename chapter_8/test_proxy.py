@@ -0,0 +1,225 @@
+import http.server
+import socket
+import threading
+import time
+
+import pytest
+
+import main
+import proxy
+import settings
+from test_eventloop import exchange, running
+from test_framing import decode
+
+release = threading.Event()
+
+class UpstreamHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/api/slow':
+            release.wait(5)
+        if self.path == '/api/bad-length':
+            self.send_response(200)
+            self.send_header('Content-Length', '\u00b2')
+            self.end_headers()
+            return
+        if self.path == '/api/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for n in range(1, 50):
+                self.wfile.write(b"%x;ext\r\n%s\r\n" % (n * 100, b"c" * n * 100))
+            self.wfile.write(b"0\r\nX-Trailer: 1\r\n\r\n")
+            return
+        if self.path == '/api/until-close':
+            self.send_response(200)
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(b"u" * 100_000)
+            self.close_connection = True
+            return
+        if self.path == '/api/down':
+            self.send_error(503)
+            return
+        if self.path == '/api/headers':
+            body = ''.join(f"{name.lower()}: {value}\n" for name, value in self.headers.items()).encode()
+        elif self.path == '/api/port':
+            body = str(self.client_address[1]).encode()
+        else:
+            body = f"upstream {self.path}".encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '1234')
+        self.end_headers()
+
+    def do_POST(self):
+        if self.headers['Transfer-Encoding'] == 'chunked':
+            body = b''
+            while size := int(self.rfile.readline(), 16):
+                body += self.rfile.read(size + 2)[:-2]
+            self.rfile.readline()
+        else:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture(autouse=True)
+def upstream(monkeypatch):
+    monkeypatch.setattr(UpstreamHandler, 'timeout', None)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), UpstreamHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    monkeypatch.setattr(settings, 'PROXY_ROUTES', {'/api': [f"127.0.0.1:{server.server_address[1]}"]})
+    monkeypatch.setattr(settings, 'PROXY_HEALTH_INTERVAL', 0)
+    monkeypatch.setattr(settings, 'STATIC_INDEX', False)
+    monkeypatch.setattr(proxy, 'backends', {})
+    monkeypatch.setattr(main, 'routes', main.build_routes())
+    release.clear()
+    yield
+    release.set()
+    proxy.stop()
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+def serving():
+    return running(main.body_consumer, main.dispatch_request)
+
+def test_proxied_get_and_post():
+    with serving() as port:
+        assert exchange(port, b"GET /api/a HTTP/1.1\r\nConnection: close\r\n\r\n").endswith(b"upstream /api/a")
+        received = exchange(port, b"POST /api/b HTTP/1.1\r\nContent-Length: 100000\r\nConnection: close\r\n\r\n"
+                                  + b"y" * 100_000)
+        assert received.startswith(b"HTTP/1.1 200") and received.endswith(b"y" * 100_000)
+
+def test_slow_upstream_does_not_hold_up_the_event_loop():
+    with serving() as port:
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as slow:
+            slow.sendall(b"GET /api/slow HTTP/1.1\r\nConnection: close\r\n\r\n")
+            assert exchange(port, b"GET /api/fast HTTP/1.1\r\nConnection: close\r\n\r\n").endswith(b"upstream /api/fast")
+            assert b"404" in exchange(port, b"GET /missing HTTP/1.1\r\nConnection: close\r\n\r\n")
+            release.set()
+            received = b''
+            while chunk := slow.recv(65536):
+                received += chunk
+            assert received.endswith(b"upstream /api/slow")
+
+def test_upstream_content_length_with_superscript_digit_is_a_502():
+    with serving() as port:
+        assert exchange(port, b"GET /api/bad-length HTTP/1.1\r\nConnection: close\r\n\r\n").startswith(b"HTTP/1.1 502")
+
+def test_proxied_requests_are_routed_once_and_blocking():
+    request = main.framing.Request('GET', '/api/x', 'HTTP/1.1', {}, b'')
+    consumer = main.body_consumer(request)
+    assert isinstance(consumer, proxy.Exchange) and request.blocking
+    assert request.route[0] is main.routes
+    consumer.abort()
+
+def get(port, path, headers=b""):
+    return exchange(port, b"GET " + path + b" HTTP/1.1\r\n" + headers + b"Connection: close\r\n\r\n")
+
+def test_hop_by_hop_headers_are_dropped_and_forwarded_ones_added():
+    with serving() as port:
+        received = get(port, b"/api/headers", b"Host: example\r\nKeep-Alive: 5\r\nTE: trailers\r\n"
+                                              b"X-Forwarded-For: 10.0.0.1\r\nX-Forwarded-Proto: https\r\nX-Custom: 1\r\n")
+    headers = received.partition(b"\r\n\r\n")[2].decode()
+    assert 'x-forwarded-for: 10.0.0.1, 127.0.0.1\n' in headers and 'x-forwarded-proto: http\n' in headers
+    assert 'x-forwarded-host: example\n' in headers and 'x-custom: 1\n' in headers and 'host: example\n' in headers
+    assert 'keep-alive' not in headers and 'te:' not in headers and 'connection: close' not in headers
+
+def test_upstream_connections_are_pooled():
+    with serving() as port:
+        first, second = get(port, b"/api/port"), get(port, b"/api/port")
+    assert first.rpartition(b"\r\n\r\n")[2] == second.rpartition(b"\r\n\r\n")[2]
+
+def test_connection_the_upstream_closed_while_idle_is_not_reused(monkeypatch):
+    monkeypatch.setattr(UpstreamHandler, 'timeout', 0.1)  # The upstream drops idle connections
+    with serving() as port:
+        first = get(port, b"/api/port")
+        time.sleep(0.3)
+        second = get(port, b"/api/port")
+    assert second.startswith(b"HTTP/1.1 200")
+    assert first.rpartition(b"\r\n\r\n")[2] != second.rpartition(b"\r\n\r\n")[2]
+
+def test_chunked_response_is_relayed():
+    with serving() as port:
+        received = get(port, b"/api/chunked")
+    head, _, body = received.partition(b"\r\n\r\n")
+    assert b"Transfer-Encoding: chunked" in head
+    assert decode(body) == (b"".join(b"c" * n * 100 for n in range(1, 50)), b"")
+
+def test_response_running_until_the_upstream_closes():
+    with serving() as port:
+        received = get(port, b"/api/until-close")
+    assert decode(received.partition(b"\r\n\r\n")[2]) == (b"u" * 100_000, b"")
+
+def test_chunked_request_body_is_forwarded():
+    with serving() as port:
+        received = exchange(port, b"POST /api/echo HTTP/1.1\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+                                  b"3\r\nabc\r\n4;x\r\ndefg\r\n0\r\n\r\n")
+    assert received.startswith(b"HTTP/1.1 200") and received.endswith(b"\r\n\r\nabcdefg")
+
+def test_head_keeps_the_content_length_without_a_body():
+    with serving() as port:
+        received = exchange(port, b"HEAD /api/a HTTP/1.1\r\nConnection: close\r\n\r\n")
+    assert b"Content-Length: 1234\r\n" in received and received.endswith(b"\r\n\r\n")
+
+def test_unreachable_upstream(monkeypatch):
+    monkeypatch.setattr(settings, 'PROXY_ROUTES', {'/api': [closed_address()]})
+    monkeypatch.setattr(proxy, 'backends', {})
+    monkeypatch.setattr(main, 'routes', main.build_routes())
+    with serving() as port:
+        assert get(port, b"/api/a").startswith(b"HTTP/1.1 503")
+
+def closed_address():
+    with socket.create_server(('127.0.0.1', 0)) as listener:
+        return f"127.0.0.1:{listener.getsockname()[1]}"
+
+def test_choose_takes_the_least_busy_healthy_upstream_in_turn():
+    backend = proxy.Backend(['a:1', 'b:2', 'c:3'])
+    a, b, c = backend.upstreams
+    c.healthy = False
+    assert {backend.choose(set()), backend.choose(set())} == {a, b}
+    b.active = 0
+    assert backend.choose(set()) is b
+    assert backend.choose({b}) is a and (a.active, b.active, c.active) == (2, 1, 0)
+    assert backend.choose({a, b}) is None
+
+def test_refused_upstream_is_skipped_and_marked_down(monkeypatch):
+    monkeypatch.setattr(settings, 'PROXY_HEALTH_INTERVAL', 60)
+    dead = closed_address()
+    monkeypatch.setattr(settings, 'PROXY_ROUTES', {'/api': [dead, settings.PROXY_ROUTES['/api'][0]]})
+    monkeypatch.setattr(proxy, 'backends', {})
+    monkeypatch.setattr(main, 'routes', main.build_routes())
+    with serving() as port:
+        for _ in range(3):
+            assert get(port, b"/api/a").endswith(b"upstream /api/a")
+    assert [u.healthy for u in proxy.backend_for('/api').upstreams] == [False, True]
+
+def test_health_check(monkeypatch):
+    monkeypatch.setattr(settings, 'PROXY_HEALTH_PATH', '/api/health')
+    proxy.check(proxy.Upstream(settings.PROXY_ROUTES['/api'][0]))
+    with pytest.raises(OSError):
+        proxy.check(proxy.Upstream(closed_address()))
+    monkeypatch.setattr(settings, 'PROXY_HEALTH_PATH', '/api/down')
+    with pytest.raises(proxy.UpstreamError):
+        proxy.check(proxy.Upstream(settings.PROXY_ROUTES['/api'][0]))
+
+@pytest.mark.parametrize('value', ['/api', '/api=', 'api=h:1', '/api=h', '/api=h:x', '/api=h:\u00b2', '/api=:1'])
+def test_parse_routes_rejects(value):
+    with pytest.raises(ValueError):
+        proxy.parse_routes([value])
+
+def test_parse_routes():
+    assert proxy.parse_routes(['/api/=a:1,b:2', '/api=c:3']) == {'/api': ['a:1', 'b:2', 'c:3']}
@@ -0,0 +1,62 @@
+import asyncio
+import base64
+import json
+
+import multipart
+import replay
+from response import send_response
+from test_eventloop import running
+
+def entry(**record):
+    return replay.Entry(dict({'time': 0.0, 'method': 'POST', 'path': '/'}, **record), 0.0)
+
+def test_random_body_is_generated_in_chunks():
+    head, length, pieces = entry(body_size=200_000).encode()
+    assert b"content-length: 200000\r\n" in head
+    sizes = [len(piece) for piece in pieces]
+    assert sum(sizes) == length == 200_000
+    assert max(sizes) <= replay.BODY_CHUNK_SIZE
+
+def test_captured_body_is_sent_as_it_was():
+    head, length, pieces = entry(body=base64.b64encode(b"a=1").decode()).encode()
+    assert (length, b"".join(pieces)) == (3, b"a=1")
+
+def test_body_less_requests():
+    head, length, pieces = entry(method='GET').encode()
+    assert b"content-length" not in head and length == 0 and list(pieces) == []
+    assert b"content-length: 0\r\n" in entry().encode()[0]
+
+def test_form_length_is_known_up_front_and_the_form_parses(tmp_path):
+    form = {'fields': {'title': 'x'},
+            'files': [{'name': 'file', 'filename': 'big.bin', 'size': 150_000},
+                      {'name': 'file', 'filename': 'empty.txt', 'size': 0}]}
+    content_type = 'multipart/form-data; boundary=captured'
+    length, pieces = replay.build_form(content_type, form)
+    parser = multipart.MultipartParser(b'captured', str(tmp_path), length)
+    fed = 0
+    for piece in pieces:
+        assert len(piece) <= replay.BODY_CHUNK_SIZE
+        parser.feed(memoryview(piece))
+        fed += len(piece)
+    parser.close()
+    assert fed == length
+    assert parser.fields == {'title': 'x'}
+    assert [(f.filename, f.size) for f in parser.files] == [('big.bin', 150_000), ('empty.txt', 0)]
+
+def test_replay_against_a_server(tmp_path):
+    received = []
+    def dispatch(client_socket, request):
+        received.append(len(request.read()))
+        send_response(client_socket, request, 200, "OK")
+    capture = tmp_path / 'captured.jsonl'
+    capture.write_text('\n'.join(json.dumps(record) for record in [
+        {'time': 1.0, 'method': 'POST', 'path': '/a', 'headers': {}, 'body_size': 300_000, 'status': 200},
+        {'time': 1.1, 'method': 'GET', 'path': '/b', 'headers': {}, 'status': 404},
+        {'dropped': 3},
+    ]) + '\n')
+    entries = replay.load(capture)
+    with running(dispatch=dispatch) as port:
+        stats, _ = asyncio.run(replay.replay(entries, '127.0.0.1', port, 0, 1, 5.0))
+    assert received == [300_000, 0]
+    assert stats['errors'] == 0 and stats['mismatches'] == 1
+    assert stats['statuses'] == {200: 2}
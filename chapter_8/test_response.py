@@ -0,0 +1,123 @@
+import io
+
+import pytest
+
+import framing
+import response
+
+class PartialSocket:
+    """Takes at most limit bytes per sendmsg(), like a socket with a full buffer."""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.data = b''
+        self.calls = []
+
+    def sendmsg(self, buffers, ancdata=(), flags=0):
+        data = b''.join(bytes(buffer) for buffer in buffers)
+        if self.limit is not None:
+            data = data[:self.limit]
+        self.calls.append(('sendmsg', len(buffers), flags))
+        self.data += data
+        return len(data)
+
+    def sendall(self, data, flags=0):
+        self.calls.append(('sendall', len(data), flags))
+        self.data += bytes(data)
+
+    def sendfile(self, f, offset, count):
+        self.calls.append(('sendfile', offset, count))
+        f.seek(offset)
+        self.data += f.read(count)
+
+def request(version='HTTP/1.1', **headers):
+    return framing.Request('GET', '/', version, headers, b'')
+
+def test_status_lines():
+    assert response.status_line(404) == b"HTTP/1.1 404 Not Found\r\n"
+    assert response.status_line(418) == b"HTTP/1.1 418 I'm a Teapot\r\n"
+    assert response.status_line(599) == b"HTTP/1.1 599 Unknown\r\n"
+    assert response.status_line(599) is response.status_line(599)
+
+def test_head_parts():
+    r = request(connection='close')
+    parts = response.head_parts(r, 200, 'text/html', 12, [('ETag', '"x"')])
+    assert b''.join(parts) == (b"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: 12\r\n"
+                               b'ETag: "x"\r\nConnection: close\r\n\r\n')
+    assert (r.status, r.response_size) == (200, 12)
+    assert b''.join(response.head_parts(request(), 304)) == b"HTTP/1.1 304 Not Modified\r\nConnection: keep-alive\r\n\r\n"
+
+def test_send_buffers_sends_the_rest_when_the_socket_takes_part():
+    sock = PartialSocket(limit=5)
+    response.send_buffers(sock, [b'hello ', memoryview(b'world'), b'!'])
+    assert sock.data == b'hello world!'
+    assert sock.calls == [('sendmsg', 3, 0), ('sendall', 7, 0)]
+
+def test_send_response_is_one_sendmsg():
+    sock = PartialSocket()
+    response.send_response(sock, request(), 200, "héllo")
+    assert sock.calls == [('sendmsg', 5, 0)]
+    assert sock.data.endswith(b"Content-Length: 6\r\nConnection: keep-alive\r\n\r\nh\xc3\xa9llo")
+
+def test_send_file():
+    sock = PartialSocket()
+    response.send_file(sock, request(), 206, 'application/octet-stream', io.BytesIO(b'0123456789'), 3, 4)
+    assert sock.calls[-1] == ('sendfile', 3, 4) and sock.calls[0][2] == response.MSG_MORE
+    assert sock.data.endswith(b"\r\n\r\n3456")
+    sock = PartialSocket()
+    response.send_file(sock, request(), 200, 'text/plain', io.BytesIO(b''), 0, 0)
+    assert [call[0] for call in sock.calls] == ['sendmsg']
+
+def stream(chunks, r=None, content_length=None):
+    r = r or request()
+    sock = PartialSocket()
+    response.send_stream(sock, r, 200, chunks, content_length=content_length)
+    return r, sock.data.partition(b"\r\n\r\n")
+
+def test_chunked_stream_skips_empty_chunks():
+    r, (head, _, body) = stream([b'ab', b'', memoryview(b'cde')])
+    assert b"Transfer-Encoding: chunked" in head and b"Content-Length" not in head
+    assert body == b"2\r\nab\r\n3\r\ncde\r\n0\r\n\r\n"
+    assert r.response_size == 5 and r.keep_alive
+
+def test_empty_stream():
+    _, (_, _, body) = stream(iter([]))
+    assert body == b"0\r\n\r\n"
+
+def test_stream_with_a_known_length():
+    r, (head, _, body) = stream([b'ab', b'cd'], content_length=4)
+    assert b"Content-Length: 4" in head and b"Transfer-Encoding" not in head
+    assert body == b'abcd' and r.keep_alive
+
+def test_stream_to_an_http_10_client_ends_with_the_connection():
+    r, (head, _, body) = stream([b'ab', b'cd'], request('HTTP/1.0', connection='keep-alive'))
+    assert b"Transfer-Encoding" not in head and b"Connection: close" in head
+    assert body == b'abcd' and not r.keep_alive
+
+def test_failing_stream_hangs_up(capsys):
+    def chunks():
+        yield b'ab'
+        raise OSError("disk gone")
+    with pytest.raises(ConnectionAbortedError):
+        stream(chunks())
+    assert 'disk gone' in capsys.readouterr().out
+
+def test_stream_buffers_are_pulled_lazily():
+    pulled = []
+    def chunks():
+        for chunk in (b'a', b'b'):
+            pulled.append(chunk)
+            yield chunk
+    buffers = response.stream_buffers(request(), [b'HEAD'], chunks(), True)
+    assert pulled == []
+    assert next(buffers) == [b'HEAD', b"1\r\n", b'a', b"\r\n"] and pulled == [b'a']
+    assert list(buffers) == [[b"1\r\n", b'b', b"\r\n"], [b"0\r\n\r\n"]]
+
+def test_prebuilt_response():
+    prebuilt = response.PrebuiltResponse(405, "No.", headers=[('Allow', 'GET')])
+    r = request(connection='close')
+    sock = PartialSocket()
+    response.send_prebuilt(sock, r, prebuilt)
+    assert sock.data == (b"HTTP/1.1 405 Method Not Allowed\r\nContent-Type: text/plain\r\nContent-Length: 3\r\n"
+                         b"Allow: GET\r\nConnection: close\r\n\r\nNo.")
+    assert (r.status, r.response_size) == (405, 3)
@@ -0,0 +1,357 @@
+import base64
+import fcntl
+import hashlib
+import os
+import socket
+import threading
+
+import pytest
+
+import framing
+import main
+import resumable
+import settings
+import test_eventloop
+import uploadstore
+
+OCTETS = {'content-type': resumable.OFFSET_CONTENT_TYPE}
+
+@pytest.fixture(autouse=True)
+def uploads(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'UPLOADS_DIRECTORY', str(tmp_path))
+    monkeypatch.setattr(settings, 'RESUMABLE_PATH', '/files')
+    monkeypatch.setattr(settings, 'UPLOAD_FSYNC', 'none')
+    monkeypatch.setattr(resumable, 'last_sweep', 0.0)
+    resumable.hashes.clear()
+    return tmp_path
+
+def call(handler, method, headers=None, params=None, body_consumer=None):
+    """Runs handler for a request over a socket pair; returns the status,
+    the headers and the body of its response."""
+    request = framing.Request(method, '/files', 'HTTP/1.1', dict(headers or {}, connection='close'), b'')
+    request.params = params or {}
+    request.body_consumer = body_consumer
+    client, server = socket.socketpair()
+    with client, server:
+        handler(server, request)
+        server.shutdown(socket.SHUT_WR)
+        data = b''
+        while chunk := client.recv(65536):
+            data += chunk
+    head, _, body = data.partition(b'\r\n\r\n')
+    lines = head.decode('latin1').split('\r\n')
+    return int(lines[0].split()[1]), dict(line.split(': ', 1) for line in lines[1:]), body
+
+def create(length, filename=None):
+    headers = {'upload-length': str(length)}
+    if filename is not None:
+        headers['upload-metadata'] = 'filename ' + base64.b64encode(filename.encode()).decode()
+    status, response_headers, _ = call(resumable.handle_create, 'POST', headers)
+    assert status == 201
+    return response_headers['Location'].rsplit('/', 1)[1]
+
+def patch(upload_id, offset, data, headers=None, abort=False):
+    request_headers = dict(OCTETS, **{'upload-offset': str(offset), 'content-length': str(len(data))})
+    request_headers.update(headers or {})
+    request = framing.Request('PATCH', '/files/' + upload_id, 'HTTP/1.1', request_headers, b'')
+    writer = resumable.ChunkWriter(upload_id, request)
+    if data:
+        writer.feed(memoryview(data))
+    if abort:
+        writer.abort()
+        return None
+    writer.close()
+    return call(resumable.handle_patch, 'PATCH', request_headers, {'id': upload_id}, writer)
+
+def head(upload_id):
+    return call(resumable.handle_head, 'HEAD', params={'id': upload_id})
+
+def finalize(upload_id, data):
+    checksum = 'sha256 ' + hashlib.sha256(data).hexdigest()
+    return call(resumable.handle_finalize, 'POST', {'upload-checksum': checksum}, {'id': upload_id})
+
+def test_off_by_default(monkeypatch):
+    monkeypatch.undo()
+    assert settings.RESUMABLE_PATH == ''
+    monkeypatch.setattr(settings, 'STATIC_INDEX', False)
+    handler, _ = main.build_routes().match('POST', '/files')
+    assert handler is main.handle_post_request
+
+def test_routes_when_configured(monkeypatch):
+    monkeypatch.setattr(settings, 'STATIC_INDEX', False)
+    routes = main.build_routes()
+    assert routes.match('POST', '/files')[0] is resumable.handle_create
+    assert routes.match('HEAD', '/files/abc')[0] is resumable.handle_head
+    assert routes.match('PATCH', '/files/abc')[0] is resumable.handle_patch
+    assert routes.match('POST', '/files/abc/finalize')[0] is resumable.handle_finalize
+
+def test_create_reserves_no_space(uploads):
+    upload_id = create(10 * 1024 ** 3)
+    assert os.path.getsize(uploads / 'partial' / (upload_id + '.part')) == 0
+    assert os.stat(uploads / 'partial' / (upload_id + '.part')).st_blocks == 0
+
+@pytest.mark.parametrize('headers', [{}, {'upload-length': ''}, {'upload-length': '-1'},
+                                     {'upload-length': '²'}, {'upload-length': '1e3'},
+                                     {'upload-length': '10', 'upload-metadata': 'filename !!!'}])
+def test_create_rejects_bad_headers(headers):
+    assert call(resumable.handle_create, 'POST', headers)[0] == 400
+
+def test_create_over_the_upload_limit(monkeypatch):
+    monkeypatch.setattr(settings, 'MAX_UPLOAD_SIZE', 100)
+    assert call(resumable.handle_create, 'POST', {'upload-length': '101'})[0] == 413
+
+def test_sequential_upload_and_finalize(uploads):
+    data = os.urandom(300_000)
+    upload_id = create(len(data), 'big.bin')
+    for offset in range(0, len(data), 100_000):
+        status, headers, _ = patch(upload_id, offset, data[offset:offset + 100_000])
+        assert status == 204
+        assert headers['Upload-Offset'] == str(offset + 100_000)
+    status, _, body = finalize(upload_id, data)
+    assert status == 200, body
+    assert (uploads / 'names' / 'big.bin').read_bytes() == data
+    assert os.listdir(uploads / 'partial') == []
+    assert head(upload_id)[0] == 404
+
+def test_pieces_out_of_order_and_gaps(uploads):
+    data = os.urandom(1000)
+    upload_id = create(len(data))
+    patch(upload_id, 600, data[600:])
+    patch(upload_id, 0, data[:200])
+    status, headers, body = head(upload_id)
+    assert (status, body) == (200, b'')
+    assert headers['Upload-Offset'] == '200'
+    assert headers['Upload-Ranges'] == '0-199,600-999'
+    assert finalize(upload_id, data)[0] == 409
+    patch(upload_id, 200, data[200:600])
+    assert head(upload_id)[1]['Upload-Ranges'] == '0-999'
+    assert finalize(upload_id, data)[0] == 200
+    assert (uploads / 'names' / upload_id).read_bytes() == data
+
+def test_dropped_piece_keeps_what_arrived():
+    data = os.urandom(1000)
+    upload_id = create(len(data))
+    request = framing.Request('PATCH', '/', 'HTTP/1.1', dict(OCTETS, **{'upload-offset': '0',
+                                                                       'content-length': '1000'}), b'')
+    writer = resumable.ChunkWriter(upload_id, request)
+    writer.feed(data[:300])
+    writer.abort()
+    assert head(upload_id)[1]['Upload-Offset'] == '300'
+
+def test_state_survives_a_restart():
+    data = os.urandom(1000)
+    upload_id = create(len(data))
+    patch(upload_id, 0, data[:500])
+    resumable.hashes.clear()  # All a new process would not have
+    assert head(upload_id)[1]['Upload-Offset'] == '500'
+    patch(upload_id, 500, data[500:])
+    assert finalize(upload_id, data)[0] == 200
+
+@pytest.mark.parametrize('headers, status', [
+    ({'content-type': 'text/plain'}, 415),
+    ({'upload-offset': ''}, 400),
+    ({'upload-offset': '-1'}, 400),
+    ({'upload-offset': '²'}, 400),
+    ({'upload-offset': '+1'}, 400),
+    ({'upload-offset': '0x1'}, 400),
+    ({'upload-offset': '1.0'}, 400),
+    ({'upload-offset': '1', 'content-length': '²'}, 400),
+    ({'upload-offset': '99'}, 400),
+])
+def test_bad_patches(headers, status):
+    upload_id = create(100)
+    assert patch(upload_id, 0, b'xx', headers)[0] == status
+    assert head(upload_id)[1]['Upload-Offset'] == '0'
+
+def test_piece_running_past_the_end():
+    upload_id = create(10)
+    request = framing.Request('PATCH', '/', 'HTTP/1.1', dict(OCTETS, **{'upload-offset': '5'}), b'')
+    writer = resumable.ChunkWriter(upload_id, request)  # Chunked: no Content-Length to check up front
+    writer.feed(b'abc')
+    writer.feed(b'defgh')
+    writer.close()
+    assert call(resumable.handle_patch, 'PATCH', params={'id': upload_id}, body_consumer=writer)[0] == 400
+    assert head(upload_id)[1]['Upload-Ranges'] == '5-7'
+
+def test_overlapping_and_empty_pieces():
+    data = os.urandom(100)
+    upload_id = create(len(data))
+    patch(upload_id, 0, data[:60])
+    assert patch(upload_id, 40, data[40:])[1]['Upload-Offset'] == '100'
+    assert patch(upload_id, 100, b'')[0] == 204
+    assert patch(upload_id, 101, b'')[0] == 400
+    assert head(upload_id)[1]['Upload-Ranges'] == '0-99'
+    assert finalize(upload_id, data)[0] == 200
+
+@pytest.mark.parametrize('value, metadata', [
+    ('', {}),
+    ('filename YS50eHQ=', {'filename': 'a.txt'}),
+    (' filename YS50eHQ= , empty,, type dGV4dA==', {'filename': 'a.txt', 'empty': '', 'type': 'text'}),
+])
+def test_parse_metadata(value, metadata):
+    assert resumable.parse_metadata(value) == metadata
+
+@pytest.mark.parametrize('value', ['filename YS50eHQ', 'filename !!!', 'filename /w=='])
+def test_parse_metadata_rejects(value):
+    with pytest.raises(resumable.UploadError):
+        resumable.parse_metadata(value)
+
+@pytest.mark.parametrize('upload_id', ['0' * 32, '../../etc', 'ABC', ''])
+def test_unknown_uploads(upload_id):
+    assert head(upload_id)[0] == 404
+    assert patch(upload_id, 0, b'x')[0] == 404
+
+def test_checksum_mismatch_keeps_the_upload():
+    upload_id = create(3)
+    patch(upload_id, 0, b'abc')
+    assert finalize(upload_id, b'abd')[0] == 460
+    assert head(upload_id)[0] == 200
+    assert finalize(upload_id, b'abc')[0] == 200
+
+@pytest.mark.parametrize('checksum', ['', 'md5 abc', 'sha256', 'sha256 xyz', 'sha256 ' + 'a' * 63])
+def test_bad_checksums(checksum):
+    upload_id = create(0)
+    assert call(resumable.handle_finalize, 'POST', {'upload-checksum': checksum}, {'id': upload_id})[0] == 400
+
+def test_base64_checksum():
+    upload_id = create(3)
+    patch(upload_id, 0, b'abc')
+    checksum = 'sha256 ' + base64.b64encode(hashlib.sha256(b'abc').digest()).decode()
+    assert call(resumable.handle_finalize, 'POST', {'upload-checksum': checksum}, {'id': upload_id})[0] == 200
+
+def test_delete():
+    upload_id = create(10)
+    assert call(resumable.handle_delete, 'DELETE', params={'id': upload_id})[0] == 204
+    assert head(upload_id)[0] == 404
+
+def test_expired_uploads_are_swept(uploads, monkeypatch):
+    upload_id = create(10)
+    monkeypatch.setattr(settings, 'RESUMABLE_EXPIRY', -1.0)
+    assert head(upload_id)[0] == 404
+    monkeypatch.setattr(resumable, 'last_sweep', 0.0)
+    resumable.sweep()
+    assert os.listdir(uploads / 'partial') == []
+
+@pytest.mark.parametrize('ranges, start, end, merged', [
+    ([], 0, 10, [[0, 10]]),
+    ([[0, 10]], 10, 20, [[0, 20]]),
+    ([[0, 10], [20, 30]], 5, 25, [[0, 30]]),
+    ([[20, 30]], 0, 10, [[0, 10], [20, 30]]),
+    ([[0, 10], [20, 30]], 12, 15, [[0, 10], [12, 15], [20, 30]]),
+])
+def test_add_range(ranges, start, end, merged):
+    assert resumable.add_range(ranges, start, end) == merged
+
+def writer_for(upload_id, offset, length):
+    request = framing.Request('PATCH', '/', 'HTTP/1.1', dict(OCTETS, **{'upload-offset': str(offset),
+                                                                       'content-length': str(length)}), b'')
+    return resumable.ChunkWriter(upload_id, request)
+
+def test_no_finalize_while_a_patch_is_running(uploads):
+    upload_id = create(3)
+    patch(upload_id, 0, b'abc')
+    writer = writer_for(upload_id, 0, 3)
+    assert writer.error is None
+    status, _, body = finalize(upload_id, b'abc')
+    assert status == 409 and b"still being written" in body
+    writer.abort()
+    assert finalize(upload_id, b'abc')[0] == 200
+    assert os.listdir(uploads / 'partial') == []
+
+def test_no_patch_while_finalizing(uploads):
+    upload_id = create(3)
+    patch(upload_id, 0, b'abc')
+    fd = os.open(uploads / 'partial' / (upload_id + '.part'), os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)  # As handle_finalize() holds it
+        assert writer_for(upload_id, 0, 3).error.status == 409
+    finally:
+        os.close(fd)
+
+def test_patch_that_opened_the_file_before_it_was_finalized(uploads):
+    upload_id = create(3)
+    patch(upload_id, 0, b'abc')
+    fd = os.open(uploads / 'partial' / (upload_id + '.part'), os.O_RDWR)
+    try:
+        assert finalize(upload_id, b'abc')[0] == 200
+        with pytest.raises(resumable.UploadError) as raised:
+            resumable.lock_for_writing(fd, upload_id)  # The fd is the stored object now
+        assert raised.value.status == 404
+    finally:
+        os.close(fd)
+    assert writer_for(upload_id, 0, 3).error.status == 404
+
+def test_patches_do_not_read_back(monkeypatch):
+    data = os.urandom(1000)
+    upload_id = create(len(data))
+    catch_up = resumable.catch_up
+    monkeypatch.setattr(resumable, 'catch_up', None)
+    patch(upload_id, 500, data[500:])
+    patch(upload_id, 0, data[:500])
+    monkeypatch.setattr(resumable, 'catch_up', catch_up)  # Finalizing reads back the piece that came first
+    assert finalize(upload_id, data)[0] == 200
+
+def in_another_worker(upload_id, offset, data):
+    """Writes a piece as another worker would: unseen by this one's running hash."""
+    entry = resumable.hashes.pop(upload_id, None)
+    patch(upload_id, offset, data)
+    resumable.forget(upload_id)
+    if entry is not None:
+        resumable.hashes[upload_id] = entry
+
+@pytest.mark.parametrize('foreign_first', [False, True])
+def test_bytes_rewritten_by_another_worker_are_hashed_from_disk(uploads, foreign_first):
+    data = os.urandom(1000)
+    upload_id = create(len(data))
+    if foreign_first:
+        in_another_worker(upload_id, 0, b'x' * 1000)
+        patch(upload_id, 0, data)  # Starts a running hash over bytes the other worker wrote first
+    else:
+        patch(upload_id, 0, data)
+    in_another_worker(upload_id, 100, b'x' * 100)
+    assembled = data[:100] + b'x' * 100 + data[200:]
+    assert finalize(upload_id, data)[0] == 460
+    assert finalize(upload_id, assembled)[0] == 200
+    store = uploadstore.store_for(str(uploads))
+    assert open(store.object_path(hashlib.sha256(assembled).hexdigest()), 'rb').read() == assembled
+
+def test_running_hash_survives_patches_of_its_own_worker(monkeypatch):
+    data = os.urandom(1000)
+    upload_id = create(len(data))
+    for offset in range(0, 1000, 250):
+        patch(upload_id, offset, data[offset:offset + 250])
+    assert resumable.hashes[upload_id][0] == 1000
+    monkeypatch.setattr(os, 'pread', None)  # Nothing is read back
+    assert finalize(upload_id, data)[0] == 200
+
+def test_finalize_is_a_blocking_handler():
+    assert resumable.handle_finalize.blocking
+
+def test_sweep_keeps_the_files_of_live_uploads(uploads, monkeypatch):
+    upload_id = create(10)
+    patch(upload_id, 0, b'abc')
+    lock_path = uploads / 'partial' / (upload_id + '.lock')
+    os.utime(lock_path, (0, 0))
+    monkeypatch.setattr(settings, 'RESUMABLE_EXPIRY', 3600.0)
+    resumable.sweep()
+    assert lock_path.exists()
+    assert patch(upload_id, 3, b'def')[0] == 204
+
+def test_event_loop_writes_and_syncs_pieces_off_its_thread(monkeypatch):
+    monkeypatch.setattr(settings, 'UPLOAD_FSYNC', 'file')
+    monkeypatch.setattr(settings, 'STATIC_INDEX', False)
+    monkeypatch.setattr(main, 'routes', main.build_routes())
+    upload_id = create(100_000)
+    synced_in = []
+    fsync = os.fsync
+    def recording_fsync(fd):
+        synced_in.append(threading.current_thread().name)
+        fsync(fd)
+    monkeypatch.setattr(os, 'fsync', recording_fsync)
+    with test_eventloop.running(main.body_consumer, main.dispatch_request) as port:
+        received = test_eventloop.exchange(port, b"PATCH /files/%s HTTP/1.1\r\nUpload-Offset: 0\r\n"
+                                                 b"Content-Type: %s\r\nContent-Length: 100000\r\n"
+                                                 b"Connection: close\r\n\r\n" % (upload_id.encode(), OCTETS['content-type'].encode())
+                                                 + b"p" * 100_000)
+    assert received.startswith(b"HTTP/1.1 204") and b"Upload-Offset: 100000" in received
+    assert synced_in and all(name.startswith('offload') for name in synced_in)
@@ -0,0 +1,128 @@
+import pytest
+
+import framing
+import router
+
+def handler(name):
+    def handle(client_socket, request):
+        return [name.encode()]
+    handle.__name__ = name
+    return handle
+
+users, user, user_files, me, files, uploads, www = (handler(name) for name in
+                                                    ('users', 'user', 'user_files', 'me', 'files', 'uploads', 'www'))
+
+@pytest.fixture
+def routes(tmp_path):
+    (tmp_path / 'docs').mkdir()
+    (tmp_path / 'docs' / 'index.html').write_text('index')
+    (tmp_path / 'a.txt').write_text('a')
+    (tmp_path / 'with space.txt').write_text('b')
+    routes = router.Router()
+    routes.add('GET', '/users', users)
+    routes.add('GET', '/users/{id}', user)
+    routes.add('DELETE', '/users/{id}', user)
+    routes.add('GET', '/users/{id}/files', user_files)
+    routes.add('GET', '/users/me', me)
+    routes.mount('/files', files, methods=('GET', 'PUT'))
+    routes.mount('/uploads/', uploads, methods=('POST',))
+    routes.mount('/', www, directory=str(tmp_path))
+    routes.compile()
+    return routes
+
+@pytest.mark.parametrize('method, path, expected, params', [
+    ('GET', '/users', users, {}),
+    ('GET', '/users?sort=name', users, {}),
+    ('GET', '/users/42', user, {'id': '42'}),
+    ('DELETE', '/users/42', user, {'id': '42'}),
+    ('GET', '/users/me', me, {}),  # Static segments win over parameters
+    ('GET', '/users/a%2Fb', user, {'id': 'a/b'}),
+    ('GET', '/users/42/files', user_files, {'id': '42'}),
+    ('GET', '/files', files, {'path': '/'}),
+    ('GET', '/files/', files, {'path': '/'}),
+    ('PUT', '/files/a/b.txt', files, {'path': '/a/b.txt'}),
+    ('POST', '/uploads/x', uploads, {'path': '/x'}),
+    ('GET', '/a.txt', www, {'path': '/a.txt'}),
+    ('GET', '/with%20space.txt', www, {'path': '/with%20space.txt'}),  # Left for the handler to decode
+    ('GET', '/docs/', www, {'path': '/docs/'}),
+    ('GET', '/docs/index.html', www, {'path': '/docs/index.html'}),
+])
+def test_match(routes, method, path, expected, params):
+    assert routes.match(method, path) == (expected, params)
+
+@pytest.mark.parametrize('method, path', [
+    ('GET', '/missing.txt'),
+    ('GET', '/docs'),  # Only with the trailing slash
+    ('GET', '/a.txt/more'),
+    ('GET', '/users/42/files/extra'),
+    ('GET', '/users/'),  # An empty segment is not a parameter
+    ('GET', '/docs/../a.txt'),
+    ('GET', '/uploads/x'),  # The / mount's index has no such file
+])
+def test_not_found(routes, method, path):
+    handler, response = routes.match(method, path)
+    assert handler is None and response is router.NOT_FOUND
+
+@pytest.mark.parametrize('method, path, allow', [
+    ('POST', '/users', 'GET'),
+    ('PUT', '/users/42', 'DELETE, GET'),
+    ('POST', '/files/a', 'GET, PUT'),
+    ('PUT', '/uploads/x', 'GET, POST'),  # Under the / mount too
+    ('DELETE', '/a.txt', 'GET'),
+])
+def test_method_not_allowed(routes, method, path, allow):
+    handler, response = routes.match(method, path)
+    assert handler is None and response.status == 405
+    assert b"Allow: %s\r\n" % allow.encode() in response.variants[True]
+
+def test_conflicting_parameter_names():
+    routes = router.Router()
+    routes.add('GET', '/users/{id}', user)
+    with pytest.raises(ValueError):
+        routes.add('GET', '/users/{name}/files', user_files)
+
+def test_unindexed_mount_takes_every_path():
+    routes = router.Router()
+    routes.mount('/', www)
+    routes.compile()
+    assert routes.match('GET', '/anything/at/all') == (www, {'path': '/anything/at/all'})
+    assert routes.match('POST', '/')[1].status == 405
+
+def test_files_added_later_are_found_after_compiling_again(routes, tmp_path):
+    (tmp_path / 'new.txt').write_text('new')
+    assert routes.match('GET', '/new.txt')[0] is None
+    routes.compile()
+    assert routes.match('GET', '/new.txt')[0] is www
+
+class Sink:
+    def __init__(self):
+        self.data = b''
+
+    def sendall(self, data, flags=0):
+        self.data += bytes(data)
+
+    def sendmsg(self, buffers, ancdata=(), flags=0):
+        for data in buffers:
+            self.sendall(data)
+        return sum(map(len, buffers))
+
+def test_route_is_matched_once(routes, monkeypatch):
+    request = framing.Request('GET', '/users/7', 'HTTP/1.1', {}, b'')
+    assert routes.route(request) == (user, {'id': '7'})
+    monkeypatch.setattr(routes, 'match', lambda method, path: pytest.fail("matched again"))
+    sink = Sink()
+    assert routes.dispatch(sink, request) is None
+    assert request.params == {'id': '7'} and sink.data.endswith(b"4\r\nuser\r\n0\r\n\r\n")
+
+def test_dispatch_sends_prebuilt_errors(routes):
+    request = framing.Request('GET', '/nowhere', 'HTTP/1.1', {'connection': 'close'}, b'')
+    sink = Sink()
+    routes.dispatch(sink, request)
+    assert sink.data == router.NOT_FOUND.variants[False]
+    assert (request.status, request.response_size) == (404, router.NOT_FOUND.size)
+
+def test_blocking_marks_the_handler():
+    @router.blocking
+    def slow(client_socket, request):
+        pass
+    assert slow.blocking and not getattr(user, 'blocking', False)
@@ -0,0 +1,173 @@
+import email.utils
+import os
+import socket
+
+import pytest
+
+import framing
+import settings
+import static
+
+def get(path, headers=None):
+    """Serves path to a GET with headers over a socket pair; returns the
+    status, the headers and the body of the response."""
+    request = framing.Request('GET', '/', 'HTTP/1.1', dict(headers or {}, connection='close'), b'')
+    client, server = socket.socketpair()
+    with client, server:
+        static.serve_file(server, request, str(path))
+        server.shutdown(socket.SHUT_WR)
+        data = b''
+        while chunk := client.recv(65536):
+            data += chunk
+    head, _, body = data.partition(b'\r\n\r\n')
+    lines = head.decode('latin1').split('\r\n')
+    response_headers = dict(line.split(': ', 1) for line in lines[1:])
+    return int(lines[0].split()[1]), response_headers, body
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(bytes(range(100)))
+    return path
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-9', [(0, 10)]),
+    ('bytes=90-', [(90, 100)]),
+    ('bytes=-10', [(90, 100)]),
+    ('bytes=-1000', [(0, 100)]),
+    ('bytes=95-1000', [(95, 100)]),
+    ('bytes=0-0, 10-19', [(0, 1), (10, 20)]),
+    ('BYTES = 5-5', [(5, 6)]),
+    ('bytes=100-', []),
+    ('bytes=-0', []),
+])
+def test_parse_range(header, expected):
+    assert static.parse_range(header, 100) == expected
+
+@pytest.mark.parametrize('header', [
+    'items=0-9',
+    'bytes=',
+    'bytes=5',
+    'bytes=-',
+    'bytes=9-5',
+    'bytes=abc-5',
+    'bytes=5-abc',
+    'bytes=²-',
+    'bytes=-²',
+    'bytes=0-²',
+    'bytes=+1-2',
+    'bytes=' + ','.join(['0-1'] * (static.MAX_RANGES + 1)),
+])
+def test_parse_range_ignores_invalid_headers(header):
+    assert static.parse_range(header, 100) is None
+
+def test_invalid_range_is_ignored(data_file):
+    status, headers, body = get(data_file, {'range': 'bytes=²-'})
+    assert status == 200
+    assert body == data_file.read_bytes()
+
+def test_single_range(data_file):
+    status, headers, body = get(data_file, {'range': 'bytes=10-19'})
+    assert status == 206
+    assert headers['Content-Range'] == 'bytes 10-19/100'
+    assert body == bytes(range(10, 20))
+
+def test_multiple_ranges(data_file):
+    status, headers, body = get(data_file, {'range': 'bytes=0-1,98-'})
+    assert status == 206
+    assert headers['Content-Type'].startswith('multipart/byteranges; boundary=')
+    assert int(headers['Content-Length']) == len(body)
+    assert b'Content-Range: bytes 0-1/100\r\n\r\n\x00\x01\r\n' in body
+    assert b'Content-Range: bytes 98-99/100\r\n\r\nbc\r\n' in body
+
+def test_unsatisfiable_range(data_file):
+    status, headers, _ = get(data_file, {'range': 'bytes=200-'})
+    assert status == 416
+    assert headers['Content-Range'] == 'bytes */100'
+
+def test_if_range_mismatch_sends_whole_file(data_file):
+    status, _, body = get(data_file, {'range': 'bytes=0-9', 'if-range': '"other"'})
+    assert status == 200
+    assert len(body) == 100
+
+def test_range_of_a_file_too_large_to_map(tmp_path):
+    path = tmp_path / 'large.bin'
+    data = os.urandom(settings.FILE_CACHE_MEMORY_SIZE + 1000)
+    path.write_bytes(data)
+    status, headers, body = get(path, {'range': 'bytes=100-199,-10'})
+    assert status == 206
+    assert b'\r\n\r\n' + data[100:200] + b'\r\n' in body
+    assert b'\r\n\r\n' + data[-10:] + b'\r\n' in body
+    status, headers, body = get(path, {'range': f'bytes={len(data) - 5}-'})
+    assert headers['Content-Range'] == f'bytes {len(data) - 5}-{len(data) - 1}/{len(data)}'
+    assert body == data[-5:]
+
+def test_range_of_an_empty_file_is_unsatisfiable(tmp_path):
+    path = tmp_path / 'empty.bin'
+    path.write_bytes(b'')
+    status, headers, _ = get(path, {'range': 'bytes=0-'})
+    assert status == 416 and headers['Content-Range'] == 'bytes */0'
+
+def test_range_of_a_compressible_file_is_not_encoded(tmp_path):
+    path = tmp_path / 'page.html'
+    path.write_text('<p>hello</p>' * 200)
+    status, headers, body = get(path, {'range': 'bytes=0-11', 'accept-encoding': 'gzip'})
+    assert status == 206 and 'Content-Encoding' not in headers
+    assert body == b'<p>hello</p>'
+
+def test_validators_are_sent(data_file):
+    status, headers, _ = get(data_file)
+    stat_result = data_file.stat()
+    assert status == 200
+    assert headers['ETag'] == static.make_etag(stat_result)
+    assert headers['Last-Modified'] == email.utils.formatdate(stat_result.st_mtime, usegmt=True)
+
+@pytest.mark.parametrize('if_none_match, not_modified', [
+    ('{etag}', True),
+    ('W/{etag}', True),
+    ('"other", {etag}', True),
+    ('*', True),
+    (' * ', True),
+    ('"other"', False),
+    ('', False),
+    ('{etag}x', False),
+])
+def test_if_none_match(data_file, if_none_match, not_modified):
+    etag = static.make_etag(data_file.stat())
+    status, headers, body = get(data_file, {'if-none-match': if_none_match.format(etag=etag)})
+    if not_modified:
+        assert (status, body) == (304, b'')
+        assert headers['ETag'] == etag and 'Content-Length' not in headers
+    else:
+        assert status == 200 and len(body) == 100
+
+@pytest.mark.parametrize('offset, not_modified', [(0, True), (3600, True), (-3600, False)])
+def test_if_modified_since(data_file, offset, not_modified):
+    since = email.utils.formatdate(data_file.stat().st_mtime + offset, usegmt=True)
+    status, _, _ = get(data_file, {'if-modified-since': since})
+    assert status == (304 if not_modified else 200)
+
+@pytest.mark.parametrize('if_modified_since', ['yesterday', '', 'Mon, 99 Foo 2024 25:61:61 GMT'])
+def test_malformed_if_modified_since_is_ignored(data_file, if_modified_since):
+    status, _, body = get(data_file, {'if-modified-since': if_modified_since})
+    assert status == 200 and len(body) == 100
+
+def test_if_none_match_wins_over_if_modified_since(data_file):
+    since = email.utils.formatdate(data_file.stat().st_mtime + 3600, usegmt=True)
+    status, _, _ = get(data_file, {'if-none-match': '"other"', 'if-modified-since': since})
+    assert status == 200
+
+def test_each_encoding_has_its_own_etag(tmp_path):
+    path = tmp_path / 'page.html'
+    path.write_text('<p>hello</p>' * 200)
+    _, identity, _ = get(path)
+    status, encoded, _ = get(path, {'accept-encoding': 'gzip'})
+    assert status == 200 and encoded['Content-Encoding'] == 'gzip'
+    assert encoded['ETag'] != identity['ETag']
+    assert get(path, {'accept-encoding': 'gzip', 'if-none-match': encoded['ETag']})[0] == 304
+    assert get(path, {'if-none-match': encoded['ETag']})[0] == 200
+
+def test_if_range_with_last_modified(data_file):
+    last_modified = email.utils.formatdate(data_file.stat().st_mtime, usegmt=True)
+    assert get(data_file, {'range': 'bytes=0-9', 'if-range': last_modified})[0] == 206
+    assert get(data_file, {'range': 'bytes=0-9', 'if-range': 'W/' + static.make_etag(data_file.stat())})[0] == 200
@@ -0,0 +1,113 @@
+import hashlib
+import os
+
+import pytest
+
+import settings
+import uploadstore
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'UPLOAD_FSYNC', 'none')
+    return uploadstore.UploadStore(str(tmp_path))
+
+def upload(store, filename, data, piece_size=1000, size_hint=None):
+    stored = store.open(filename, size_hint)
+    for start in range(0, len(data), piece_size):
+        stored.write(data[start:start + piece_size])
+    stored.finish()
+    return stored
+
+def contents(store, filename):
+    with open(store.name_path(filename), 'rb') as f:
+        return f.read()
+
+def objects(store):
+    return sorted(name for _, _, names in os.walk(store.objects) for name in names)
+
+def test_upload_is_stored_by_digest(store):
+    data = os.urandom(5000)
+    stored = upload(store, 'a.bin', data)
+    assert stored.digest == hashlib.sha256(data).hexdigest() and stored.written and stored.size == 5000
+    assert store.lookup('a.bin') == stored.digest
+    assert contents(store, 'a.bin') == data and objects(store) == [stored.digest]
+    assert os.listdir(store.tmp) == []
+
+def test_same_contents_under_another_name_are_stored_once(store):
+    data = os.urandom(5000)
+    first, second = upload(store, 'a.bin', data), upload(store, 'b.bin', data)
+    assert first.written and not second.written
+    assert objects(store) == [first.digest] and contents(store, 'b.bin') == data
+
+def test_same_contents_under_the_same_name_write_nothing(store, monkeypatch):
+    data = os.urandom(5000)
+    upload(store, 'a.bin', data)
+    link = os.lstat(store.name_path('a.bin'))
+    monkeypatch.setattr(uploadstore.StoredFile, 'start_file', lambda self: pytest.fail("wrote a file"))
+    stored = upload(store, 'a.bin', data)
+    assert not stored.written and stored.digest == hashlib.sha256(data).hexdigest()
+    assert os.lstat(store.name_path('a.bin')).st_ino == link.st_ino  # Not even relinked
+
+@pytest.mark.parametrize('change', [
+    lambda data: data[:2500] + b'X' + data[2501:],  # Differs halfway
+    lambda data: b'X' + data[1:],  # At the first byte
+    lambda data: data[:-1],  # A prefix of the old contents
+    lambda data: data + b'more',  # Goes on past them
+    lambda data: b'',
+])
+def test_changed_contents_under_the_same_name(store, change):
+    old = os.urandom(5000)
+    upload(store, 'a.bin', old)
+    new = change(old)
+    stored = upload(store, 'a.bin', new, piece_size=700)
+    assert stored.written and contents(store, 'a.bin') == new
+    assert len(objects(store)) == 2 and os.listdir(store.tmp) == []
+
+def test_missing_object_behind_a_name_is_written_again(store):
+    data = os.urandom(100)
+    stored = upload(store, 'a.bin', data)
+    os.unlink(store.object_path(stored.digest))
+    assert upload(store, 'a.bin', data).written and contents(store, 'a.bin') == data
+
+def test_preallocated_space_is_given_back(store, monkeypatch):
+    monkeypatch.setattr(settings, 'UPLOAD_PREALLOCATE', True)
+    stored = upload(store, 'a.bin', b'x' * 100, size_hint=1_000_000)
+    assert os.path.getsize(store.object_path(stored.digest)) == 100
+
+@pytest.mark.parametrize('written', [0, 2500, 5000])
+def test_abort_leaves_nothing_behind(store, written):
+    old = os.urandom(5000)
+    upload(store, 'a.bin', old)
+    stored = store.open('a.bin')
+    stored.write(old[:written // 2] + b'X' * (written - written // 2))
+    stored.abort()
+    assert os.listdir(store.tmp) == [] and contents(store, 'a.bin') == old
+    stored = store.open('new.bin')
+    stored.write(b'x' * written)
+    stored.abort()
+    assert os.listdir(store.tmp) == [] and store.lookup('new.bin') is None
+
+@pytest.mark.parametrize('has_copy_file_range', [True, False])
+def test_copy_prefix(tmp_path, monkeypatch, has_copy_file_range):
+    if not has_copy_file_range:
+        monkeypatch.delattr(os, 'copy_file_range', raising=False)
+    monkeypatch.setattr(settings, 'UPLOAD_CHUNK_SIZE', 1000)
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    data = os.urandom(5500)
+    src.write_bytes(data)
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        uploadstore.copy_prefix(s.fileno(), d.fileno(), 4321)
+        assert d.tell() == 4321
+        with pytest.raises(OSError):
+            uploadstore.copy_prefix(s.fileno(), d.fileno(), 6000)
+    assert dst.read_bytes()[:4321] == data[:4321]
+
+def test_full_fsync(store, monkeypatch):
+    synced = []
+    monkeypatch.setattr(settings, 'UPLOAD_FSYNC', 'full')
+    monkeypatch.setattr(uploadstore, 'fsync_directory', synced.append)
+    stored = upload(store, 'a.bin', b'data')
+    assert synced == [os.path.dirname(store.object_path(stored.digest)), store.names]
+
+def test_store_for_reuses_stores(tmp_path):
+    assert uploadstore.store_for(str(tmp_path)) is uploadstore.store_for(str(tmp_path))
@@ -0,0 +1,192 @@
+"""Content-addressed storage for uploaded files.
+
+Under the uploads directory:
+
+    objects/ab/abcdef...  file contents, named by their SHA-256
+    names/<filename>      symlink to the object last uploaded under that name
+    tmp/                  files being written, and links being swapped in
+    partial/              resumable uploads in progress (see resumable)
+
+Contents are hashed while they stream in and written to a temporary file
+that is renamed into objects/ when complete, so an object is either all
+there or not there at all, and identical contents are stored once.
+
+names/ is the filename -> hash index. When a file is uploaded under a
+name that already has an object, the incoming bytes are compared with that
+object instead of being written; if they turn out identical, nothing is
+written at all. Only at the first differing byte does a temporary file get
+created, seeded with the matching prefix copied from the old object.
+"""
+import hashlib
+import os
+import tempfile
+
+import settings
+
+FSYNC_POLICIES = ('none', 'file', 'full')  # full also syncs the directories after renames
+
+class UploadStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.objects = os.path.join(directory, 'objects')
+        self.names = os.path.join(directory, 'names')
+        self.tmp = os.path.join(directory, 'tmp')
+        for path in (self.objects, self.names, self.tmp):
+            os.makedirs(path, exist_ok=True)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def name_path(self, filename):
+        return os.path.join(self.names, filename)
+
+    def lookup(self, filename):
+        """Returns the digest of the object stored under filename, or None."""
+        try:
+            return os.path.basename(os.readlink(self.name_path(filename)))
+        except OSError:
+            return None
+
+    def open(self, filename, size_hint=None):
+        """Starts storing an upload; size_hint is an upper bound of its size."""
+        return StoredFile(self, filename, size_hint)
+
+    def add_object(self, temp_path, digest):
+        """Moves a complete temporary file into place; returns False if an
+        object with the same contents already existed."""
+        path = self.object_path(digest)
+        if os.path.exists(path):
+            os.unlink(temp_path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        if settings.UPLOAD_FSYNC == 'full':
+            fsync_directory(os.path.dirname(path))
+        return True
+
+    def link(self, filename, digest):
+        """Points names/filename at the object, replacing any older link."""
+        if self.lookup(filename) == digest:
+            return
+        target = os.path.relpath(self.object_path(digest), self.names)
+        temp_link = os.path.join(self.tmp, f"link-{os.urandom(8).hex()}")
+        os.symlink(target, temp_link)
+        os.replace(temp_link, self.name_path(filename))
+        if settings.UPLOAD_FSYNC == 'full':
+            fsync_directory(self.names)
+
+class StoredFile:
+    """One upload being written to an UploadStore.
+
+    write() pieces of the contents, then finish() or abort(). After
+    finish(), digest is the SHA-256 of the contents and written tells
+    whether new data went to disk.
+    """
+
+    def __init__(self, store, filename, size_hint=None):
+        self.store = store
+        self.filename = filename
+        self.size_hint = size_hint
+        self.size = 0
+        self.hash = hashlib.sha256()
+        self.digest = None
+        self.written = False
+        self.file = None
+        self.temp_path = None
+        # While every byte so far matches the object already stored under this name
+        self.candidate = None
+        previous = store.lookup(filename)
+        if previous is not None:
+            try:
+                self.candidate = open(store.object_path(previous), 'rb')
+            except OSError:
+                pass
+        if self.candidate is None:
+            self.start_file()
+
+    def start_file(self):
+        """Creates the temporary file, copying in the prefix that matched."""
+        fd, self.temp_path = tempfile.mkstemp(dir=self.store.tmp, prefix='upload-')
+        try:
+            if self.size_hint and settings.UPLOAD_PREALLOCATE and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fd, 0, self.size_hint)
+                except OSError:
+                    pass  # Not supported by the file system, or no room to reserve; just write
+            if self.candidate is not None:
+                copy_prefix(self.candidate.fileno(), fd, self.size)
+                self.candidate.close()
+                self.candidate = None
+        except BaseException:
+            os.close(fd)
+            os.unlink(self.temp_path)
+            raise
+        self.file = os.fdopen(fd, 'wb', buffering=settings.UPLOAD_CHUNK_SIZE)
+
+    def write(self, data):
+        self.hash.update(data)
+        if self.candidate is not None:
+            if os.pread(self.candidate.fileno(), len(data), self.size) == data:
+                self.size += len(data)
+                return
+            self.start_file()
+        self.file.write(data)
+        self.size += len(data)
+
+    def finish(self):
+        self.digest = self.hash.hexdigest()
+        if self.candidate is not None:
+            if os.fstat(self.candidate.fileno()).st_size == self.size:
+                self.candidate.close()
+                self.candidate = None
+                return  # Same contents as before under the same name: nothing to do
+            self.start_file()  # A prefix of the old contents
+        self.file.flush()
+        if self.size_hint and self.size_hint > self.size:
+            os.ftruncate(self.file.fileno(), self.size)  # Give back what was preallocated
+        if settings.UPLOAD_FSYNC != 'none':
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        self.written = self.store.add_object(self.temp_path, self.digest)
+        self.store.link(self.filename, self.digest)
+
+    def abort(self):
+        if self.candidate is not None:
+            self.candidate.close()
+            self.candidate = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.unlink(self.temp_path)
+
+def copy_prefix(src_fd, dst_fd, count):
+    """Copies the first count bytes of src_fd to dst_fd, in the kernel when
+    the platform allows it."""
+    offset = 0
+    while offset < count:
+        if hasattr(os, 'copy_file_range'):
+            copied = os.copy_file_range(src_fd, dst_fd, count - offset, offset, offset)
+        else:
+            data = os.pread(src_fd, min(count - offset, settings.UPLOAD_CHUNK_SIZE), offset)
+            copied = os.pwrite(dst_fd, data, offset)
+        if not copied:
+            raise OSError(f"Stored object is shorter than {count} bytes")
+        offset += copied
+    os.lseek(dst_fd, count, os.SEEK_SET)
+
+def fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+stores = {}
+
+def store_for(directory):
+    """Returns the UploadStore for directory, creating it on first use."""
+    store = stores.get(directory)
+    if store is None:
+        store = stores[directory] = UploadStore(directory)
+    return store